@@ -0,0 +1,122 @@
+import random
+import time
+
+from slot_allocator import SlotAllocator
+
+VTABLE_ENTRIES = 65536
+RECIRCULATION_COUNT = 2
+
+
+# first fit scan over a list marking each slot, as done by the controller
+# before the slot allocator (extended to free and to variable slot counts)
+class FirstFitPool(object):
+
+    def __init__(self, n_slots):
+        self.mem_pool = [0] * n_slots
+        self.allocated = {}
+
+    def alloc(self, n):
+        for idx in range(len(self.mem_pool) - n + 1):
+            if not any(self.mem_pool[idx:idx + n]):
+                self.mem_pool[idx:idx + n] = [1] * n
+                self.allocated[idx] = n
+                return idx
+        return None
+
+    def free(self, start):
+        n = self.allocated.pop(start)
+        self.mem_pool[start:start + n] = [0] * n
+        return n
+
+    # place entries back to back from slot 0 while they fit, which is what the
+    # first fit scan does on an empty pool (without scanning)
+    def fill(self, sizes):
+        start = sum(self.allocated.values())
+        for n in sizes:
+            if start + n > len(self.mem_pool):
+                return
+            self.mem_pool[start:start + n] = [1] * n
+            self.allocated[start] = n
+            start += n
+
+
+def fill(pool, sizes):
+    if isinstance(pool, FirstFitPool):
+        pool.fill(sizes)
+        return
+    for n in sizes:
+        if pool.alloc(n) is None:
+            return
+
+
+def timed(fn, n_ops):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    return n_ops / elapsed if elapsed > 0 else float('inf')
+
+
+# fill the pool with entries of size slots up to the given occupancy and
+# measure the inserts/sec of the next n_ops inserts
+def fill_rate(pool, size, occupancy, n_ops):
+    fill(pool, [size] * max(int(occupancy * VTABLE_ENTRIES) // size - n_ops, 0))
+    return timed(lambda: [pool.alloc(size) for _ in range(n_ops)], n_ops)
+
+
+# fill the pool with entries of random sizes (as many as fit) and then free
+# a random entry and insert a new one n_ops times
+def churn_rate(pool, sizes, n_ops, rng):
+    fill(pool, (rng.choice(sizes) for _ in range(VTABLE_ENTRIES)))
+
+    live = list(pool.allocated)
+    # victims are picked up front so that the choice is not measured
+    victims = [rng.random() for _ in range(n_ops)]
+    new_sizes = [rng.choice(sizes) for _ in range(n_ops)]
+
+    def churn():
+        for victim, size in zip(victims, new_sizes):
+            idx = int(victim * len(live))
+            pool.free(live[idx])
+            live[idx] = live[-1]
+            live.pop()
+            start = pool.alloc(size)
+            if start is not None:
+                live.append(start)
+
+    return timed(churn, n_ops)
+
+
+def main(n_ops, legacy_ops, sizes, seed):
+    size = RECIRCULATION_COUNT * 2
+
+    print(f"inserts/sec of {size} slot entries by occupancy of the {VTABLE_ENTRIES} slots")
+    print(f"{'occupancy':<12}{'first fit':>14}{'buddy':>14}")
+    for occupancy in (0.0, 0.25, 0.5, 0.75, 0.99):
+        legacy = fill_rate(FirstFitPool(VTABLE_ENTRIES), size, occupancy, legacy_ops)
+        buddy = fill_rate(SlotAllocator(VTABLE_ENTRIES), size, occupancy, n_ops)
+        print(f"{occupancy:<12.0%}{legacy:>14.0f}{buddy:>14.0f}")
+
+    allocator = SlotAllocator(VTABLE_ENTRIES)
+    rate = churn_rate(allocator, sizes, n_ops, random.Random(seed))
+    legacy = churn_rate(FirstFitPool(VTABLE_ENTRIES), sizes, legacy_ops, random.Random(seed))
+    print(f"\nchurn (free + insert of {sizes} slot entries) on a full pool")
+    print(f"{'first fit':<12}{legacy:>14.0f} ops/sec")
+    print(f"{'buddy':<12}{rate:>14.0f} ops/sec")
+
+    print("\nbuddy allocator after churn:")
+    for name, value in allocator.stats().items():
+        print(f"  {name:<24}{value:.3f}" if isinstance(value, float) else f"  {name:<24}{value}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--ops', type=int, required=False, default=20000, help='operations measured per run')
+    parser.add_argument('--legacy-ops', type=int, required=False, default=200, help='operations measured per run of the first fit scan')
+    parser.add_argument('--sizes', type=int, nargs='+', required=False, default=[1, 2, 4, 8], help='slot counts of the churned entries')
+    parser.add_argument('--seed', type=int, required=False, default=0)
+    args = parser.parse_args()
+
+    main(args.ops, args.legacy_ops, args.sizes, args.seed)
@@ -0,0 +1,171 @@
+import contextlib
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from controller import NCacheController, NETCACHE_READ_QUERY, NETCACHE_WRITE_QUERY
+from sim_admission import packet, zipf_ranks, NETCACHE_PORT_SERVER, NETCACHE_PORT_CLIENT
+from soft_switch import NetCacheSwitch, NETCACHE_HEADER, RETURN
+
+# the server end of the coherence channel lives with the kv server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kv_store'))
+from coherence import CoherenceChannel
+
+# values carry the version of their write (repeated over the 512 bytes)
+VERSION = struct.Struct('>Q')
+NETCACHE_VALUE_BYTES = 512
+
+
+def versioned(version):
+    return VERSION.pack(version) * (NETCACHE_VALUE_BYTES // VERSION.size)
+
+
+# mixed workload over keys cached in the switch model: writes go through the
+# server, which writes them through to the switch via the controller
+# ('write-through') or only updates its own copy ('none', no coherence);
+# reads go to the switch and its misses to the server. A read is stale when
+# it returns a version older than the last write acked before the read was
+# sent (a read concurrent with a write in flight may return either value)
+class CoherenceBench(object):
+
+    def __init__(self, coherent, n_keys, seed):
+        self.coherent = coherent
+        self.rng = np.random.default_rng(seed)
+        self.keys = [f"{n:08}".encode('utf-8') for n in range(n_keys)]
+        self.raw_keys = [key.rjust(16, b'\x00') for key in self.keys]
+
+        self.switch = NetCacheSwitch()
+        self.path = os.path.join(tempfile.mkdtemp(), 'server_cont.s')
+        self.controller = NCacheController('s1', thrift_apis=[self.switch], refresh_interval=0,
+                server_channel=self.path)
+        self.switch.clone_handler = self.controller.recv_netcache
+        self.controller.set_value_tables()
+
+        self.versions = [0] * n_keys
+        self.acked = [0] * n_keys
+        self.latencies = []
+        self.stale = 0
+        self.from_server = 0
+
+        self.channel = None
+        if coherent:
+            self.channel = CoherenceChannel(self.path, self.serve_buffered)
+            self.channel.start()
+            self.controller.start_coherence()
+            while self.channel.conn is None:
+                time.sleep(0.01)
+
+    # the server pushes every key once, the controller caches all of them
+    def populate(self):
+        values = self.channel.values if self.channel is not None else {}
+        for n, key in enumerate(self.keys):
+            values[self.raw_keys[n]] = versioned(0)
+            self.switch.process(packet(NETCACHE_WRITE_QUERY, key, versioned(0)), NETCACHE_PORT_SERVER)
+        self.controller.commit()
+        self.values = values
+
+    def check(self, value, floor):
+        if VERSION.unpack_from(value)[0] < floor:
+            self.stale += 1
+
+    def serve_buffered(self, key, request):
+        _, floor = request
+        self.check(self.values[key], floor)
+
+    def write(self, n):
+        self.versions[n] += 1
+        version = self.versions[n]
+        start = time.perf_counter()
+
+        def done():
+            self.latencies.append(time.perf_counter() - start)
+            self.acked[n] = max(self.acked[n], version)
+
+        if self.channel is None:
+            self.values[self.raw_keys[n]] = versioned(version)
+            done()
+        else:
+            self.channel.write(self.raw_keys[n], versioned(version), done)
+
+    def read(self, n):
+        floor = self.acked[n]
+        verdict, data = self.switch.process(packet(NETCACHE_READ_QUERY, self.keys[n]), NETCACHE_PORT_CLIENT)
+        if verdict == RETURN:
+            self.check(memoryview(data)[NETCACHE_HEADER.size:], floor)
+            return
+        # a miss (or a read of an entry being updated) answered by the server
+        self.from_server += 1
+        if self.channel is not None and self.channel.hold(self.raw_keys[n], ('read', floor)):
+            return
+        self.check(self.values[self.raw_keys[n]], floor)
+
+    def run(self, n_ops, write_ratio, skew, timeout=30.0):
+        ranks = zipf_ranks(len(self.keys), n_ops, skew, self.rng)
+        writes = self.rng.random(n_ops) < write_ratio
+
+        start = time.perf_counter()
+        for n, is_write in zip(ranks, writes):
+            if is_write:
+                self.write(n)
+            else:
+                self.read(n)
+        deadline = time.perf_counter() + timeout
+        while self.channel is not None and self.channel.pending() and time.perf_counter() < deadline:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+
+        n_writes = int(writes.sum())
+        n_reads = n_ops - n_writes
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            'ops/sec': n_ops / elapsed,
+            'writes/sec': len(self.latencies) / elapsed,
+            'write ms': latencies.mean(),
+            'write p99 ms': np.percentile(latencies, 99),
+            'stale %': 100.0 * self.stale / n_reads if n_reads else 0.0,
+            'server %': 100.0 * self.from_server / n_reads if n_reads else 0.0,
+            'unacked': n_writes - len(self.latencies),
+        }
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+
+
+def main(n_keys, n_ops, write_ratios, skew, seed):
+    rows = []
+    for write_ratio in write_ratios:
+        for mode in ('none', 'write-through'):
+            # the controller prints every insertion
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                bench = CoherenceBench(mode == 'write-through', n_keys, seed)
+                bench.populate()
+                stats = bench.run(n_ops, write_ratio, skew)
+                bench.close()
+            rows.append((write_ratio, mode, stats))
+
+    print(f"{n_keys} cached keys, {n_ops} operations per run, zipf skew {skew}")
+    columns = list(rows[0][2])
+    print(f"{'writes':<8}{'mode':<15}" + ''.join(f"{column:>14}" for column in columns))
+    for write_ratio, mode, stats in rows:
+        print(f"{write_ratio:<8.2f}{mode:<15}" + ''.join(f"{stats[column]:>14.2f}" for column in columns))
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--keys', type=int, required=False, default=10000, help='keys cached in the switch')
+    parser.add_argument('--ops', type=int, required=False, default=50000, help='operations per run')
+    parser.add_argument('--writes', type=float, nargs='+', required=False, default=[0.01, 0.1, 0.5],
+            help='fractions of writes in the workload')
+    parser.add_argument('--skew', type=float, required=False, default=0.9)
+    parser.add_argument('--seed', type=int, required=False, default=0)
+    args = parser.parse_args()
+
+    main(args.keys, args.ops, args.writes, args.skew, args.seed)
@@ -0,0 +1,67 @@
+import random
+import time
+
+from id_pool import IdPool
+
+VTABLE_ENTRIES = 65536
+
+
+# key index allocation as done by the controller before the id pool: the
+# range of free ids is materialized, one id popped and a shorter range built
+def legacy_inserts(n_inserts):
+    ids_pool = range(0, VTABLE_ENTRIES)
+    for _ in range(n_inserts):
+        ids_pool_list = list(ids_pool)
+        key_index = ids_pool_list.pop()
+        ids_pool = range(len(ids_pool_list))
+
+
+def pool_inserts(n_inserts):
+    ids_pool = IdPool(VTABLE_ENTRIES)
+    for _ in range(n_inserts):
+        key_index = ids_pool.alloc()
+    return ids_pool
+
+
+# free a random id and allocate one again on a full pool (the legacy range
+# can not take ids back)
+def pool_churn(n_ops, seed):
+    ids_pool = pool_inserts(VTABLE_ENTRIES)
+    rng = random.Random(seed)
+    victims = [rng.randrange(VTABLE_ENTRIES) for _ in range(n_ops)]
+
+    start = time.perf_counter()
+    for idx in victims:
+        ids_pool.free(idx)
+        ids_pool.alloc()
+    return time.perf_counter() - start
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main(n_inserts, churn_ops, seed):
+    legacy = timed(legacy_inserts, n_inserts)
+    pool = timed(pool_inserts, n_inserts)
+    churn = pool_churn(churn_ops, seed)
+
+    print(f"{n_inserts} key index allocations")
+    print(f"{'range rebuild':<16}{legacy:>12.6f} sec {n_inserts / legacy:>14.0f} inserts/sec")
+    print(f"{'id pool':<16}{pool:>12.6f} sec {n_inserts / pool:>14.0f} inserts/sec")
+    print(f"{'id pool churn':<16}{churn:>12.6f} sec {churn_ops / churn:>14.0f} free+alloc/sec")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--inserts', type=int, required=False, default=VTABLE_ENTRIES)
+    parser.add_argument('--churn-ops', type=int, required=False, default=100000)
+    parser.add_argument('--seed', type=int, required=False, default=0)
+    args = parser.parse_args()
+
+    main(args.inserts, args.churn_ops, args.seed)
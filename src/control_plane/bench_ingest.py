@@ -0,0 +1,159 @@
+import contextlib
+import io
+import socket
+import struct
+import time
+
+from packet_ingest import (PacketIngest, NETCACHE_HEADER, NETCACHE_VALUE_BYTES, NETCACHE_PORT, netcache_offset,
+        parse_netcache, read_pcap)
+
+NETCACHE_WRITE_QUERY = 1
+
+
+def ip_checksum(header):
+    total = sum(struct.unpack(f'>{len(header) // 2}H', header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+# cloned write reports of n_keys distinct keys, built on the ethernet, ip and
+# udp headers of the captured frames (whose payloads are shorter than a
+# netcache header)
+def build_frames(templates, n_keys):
+    frames = []
+    for n in range(n_keys):
+        template = templates[n % len(templates)]
+        ihl = (template[14] & 0x0f) * 4
+        l4 = 14 + ihl
+
+        key = f"{n:08}".encode('utf-8')
+        value = bytes((n + i) & 0xff for i in range(NETCACHE_VALUE_BYTES))
+        payload = NETCACHE_HEADER.pack(NETCACHE_WRITE_QUERY, n, key.rjust(16, b'\x00')) + value
+
+        ip = bytearray(template[14:l4])
+        struct.pack_into('>H', ip, 2, ihl + 8 + len(payload))
+        struct.pack_into('>H', ip, 10, 0)
+        struct.pack_into('>H', ip, 10, ip_checksum(bytes(ip)))
+        sport = struct.unpack_from('>H', template, l4)[0]
+        udp = struct.pack('>HHHH', sport, NETCACHE_PORT, 8 + len(payload), 0)
+
+        frames.append(template[:14] + bytes(ip) + udp + payload)
+    return frames
+
+
+def rate(n, elapsed):
+    return n / elapsed if elapsed > 0 else float('inf')
+
+
+# decode of every frame as done by the ingest workers
+def parse_rate(frames):
+    start = time.perf_counter()
+    for frame in frames:
+        offset = netcache_offset(frame, len(frame))
+        op, key, value = parse_netcache(frame, offset)
+        bytes(value)
+    return rate(len(frames), time.perf_counter() - start)
+
+
+# decode of every frame as done by the scapy sniff callback (None when the
+# controller cannot be imported)
+def legacy_parse_rate(frames):
+    try:
+        from scapy.all import Ether
+        from controller import NCacheController
+        from mock_thrift import MockThriftAPI
+    except ImportError:
+        return None
+
+    controller = NCacheController('s1', thrift_apis=[MockThriftAPI(latency=0)])
+    controller.handle_update = lambda op, key, value: None
+    start = time.perf_counter()
+    for frame in frames:
+        controller.recv_switch_updates(Ether(frame))
+    return rate(len(frames), time.perf_counter() - start)
+
+
+def make_handler(insert):
+    if not insert:
+        return lambda op, key, value: None
+
+    # the inserts of a controller over a switch with no rpc latency
+    from controller import NCacheController
+    from mock_thrift import MockThriftAPI
+    controller = NCacheController('s1', thrift_apis=[MockThriftAPI(latency=0)])
+    controller.set_value_tables()
+    return controller.handle_update
+
+
+# send the frames on iface through a raw socket (at send_rate frames/sec, 0 =
+# as fast as possible) while a PacketIngest bound to the same interface
+# handles them, returns (sent, stats, seconds until the last report was handled)
+def replay(frames, iface, send_rate, workers, n_buffers, insert, timeout=30.0):
+    ingest = PacketIngest(iface, make_handler(insert), n_buffers=n_buffers, workers=workers)
+    ingest.start()
+
+    sender = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    sender.bind((iface, 0))
+    interval = 1.0 / send_rate if send_rate > 0 else 0.0
+
+    start = time.perf_counter()
+    for n, frame in enumerate(frames):
+        if interval:
+            delay = start + n * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        sender.send(frame)
+
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        stats = ingest.stats()
+        if stats['handled'] + stats['dropped'] + stats['errors'] >= len(frames) and ingest.pending() == 0:
+            break
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    ingest.stop()
+    sender.close()
+    return len(frames), ingest.stats(), elapsed
+
+
+def main(pcap, n_keys, iface, send_rate, workers, n_buffers, insert):
+    templates = [frame for _, frame in read_pcap(pcap)]
+    frames = build_frames(templates, n_keys)
+    print(f"{n_keys} write reports built on the {len(templates)} frames of {pcap}")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy = legacy_parse_rate(frames)
+    print(f"{'scapy decode':<16}" + (f"{legacy:>12.0f} frames/sec" if legacy is not None else f"{'n/a':>12} (scapy or p4utils missing)"))
+    print(f"{'struct decode':<16}{parse_rate(frames):>12.0f} frames/sec")
+
+    try:
+        # the controller prints every insertion
+        with contextlib.redirect_stdout(io.StringIO()):
+            sent, stats, elapsed = replay(frames, iface, send_rate, workers, n_buffers, insert)
+    except PermissionError:
+        print("raw sockets need CAP_NET_RAW, skipping the replay")
+        return
+    print(f"\nreplay on {iface} ({'inserts' if insert else 'no-op handler'}, {workers} workers, {n_buffers} buffers)")
+    print(f"{'sent':<16}{sent:>12}")
+    for name, value in stats.items():
+        print(f"{name:<16}{value:>12}")
+    print(f"{'reports/sec':<16}{rate(stats['handled'], elapsed):>12.0f}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--pcap', type=str, required=False, default='../p4/switch_capture.pcap')
+    parser.add_argument('--keys', type=int, required=False, default=20000, help='number of write reports replayed')
+    parser.add_argument('--iface', type=str, required=False, default='lo')
+    parser.add_argument('--rate', type=float, required=False, default=0, help='frames/sec sent (0 = as fast as possible)')
+    parser.add_argument('--workers', type=int, required=False, default=1)
+    parser.add_argument('--buffers', type=int, required=False, default=4096, help='receive buffers of the ingest ring')
+    parser.add_argument('--insert', help='insert the reported keys through a controller over mock_thrift', action='store_true')
+    args = parser.parse_args()
+
+    main(args.pcap, args.keys, args.iface, args.rate, args.workers, args.buffers, args.insert)
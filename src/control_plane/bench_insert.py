@@ -0,0 +1,80 @@
+import contextlib
+import io
+import os
+import time
+
+from controller import NCacheController, RECIRCULATION_COUNT, VTABLE_NAME_PREFIX, VTABLE_SLOT_SIZE
+from mock_thrift import MockThriftAPI
+
+
+# cache insertion as done by the controller before batching: one rpc per slot
+# of every value table, lookup table and validity register
+def legacy_insert(controller, api, key, value, vt_index, key_index):
+    cnt = 0
+    for h in range(0, RECIRCULATION_COUNT * 2, 2):
+        for i in range(controller.vtables_num):
+            for j in range(2):
+                api.register_write(VTABLE_NAME_PREFIX + str(i), vt_index + j + h,
+                        controller.str_to_int(value[cnt:cnt + VTABLE_SLOT_SIZE]))
+                cnt += VTABLE_SLOT_SIZE
+
+    match = [str(controller.key_to_int(key))]
+    params = ['255', str(vt_index), str(key_index)]
+    api.table_add("ingress_lookup_table", "ingress_set_lookup_metadata", match, params)
+    api.table_add("egress_lookup_table", "egress_set_lookup_metadata", match, params)
+    api.register_write("ingress_cache_status", key_index, 1)
+    api.register_write("egress_cache_status", key_index, 1)
+
+
+def make_values(n_keys, value_bytes):
+    # kv vectors fill value_bytes of the 512 bytes of value and value2, the
+    # rest is zero padding
+    return [(f"{i:016}", os.urandom(value_bytes).ljust(512, b'\x00')) for i in range(n_keys)]
+
+
+def run_legacy(items, latency):
+    api = MockThriftAPI(latency=latency)
+    controller = NCacheController('s1', thrift_apis=[api])
+    start = time.perf_counter()
+    for idx, (key, value) in enumerate(items):
+        legacy_insert(controller, api, key, value, idx * RECIRCULATION_COUNT * 2, idx)
+    return time.perf_counter() - start, api.calls
+
+
+def run_batched(items, latency, connections, batch_keys):
+    api = MockThriftAPI(latency=latency)
+    apis = [api] + [api.connect() for _ in range(connections - 1)]
+    controller = NCacheController('s1', thrift_apis=apis, batch_keys=batch_keys, flush_interval=3600)
+    start = time.perf_counter()
+    for key, value in items:
+        controller.insert(key, value, False)
+    controller.commit()
+    return time.perf_counter() - start, sum(a.calls for a in apis)
+
+
+def main(n_keys, value_bytes, latency, connections, batch_keys):
+    items = make_values(n_keys, value_bytes)
+
+    # the controller prints every insertion
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy_time, legacy_rpcs = run_legacy(items, latency)
+        batched_time, batched_rpcs = run_batched(items, latency, connections, batch_keys)
+
+    print(f"{n_keys} inserts of {value_bytes} byte values, {latency * 1e6:.0f} us per rpc")
+    print(f"{'per slot rpcs':<16}{legacy_rpcs:>10} rpcs {legacy_time:>10.3f} sec {n_keys / legacy_time:>10.0f} inserts/sec")
+    print(f"{'batched':<16}{batched_rpcs:>10} rpcs {batched_time:>10.3f} sec {n_keys / batched_time:>10.0f} inserts/sec")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--keys', type=int, required=False, default=2592, help='number of keys inserted')
+    parser.add_argument('--value-bytes', type=int, required=False, default=256, help='non zero bytes of each value')
+    parser.add_argument('--latency', type=float, required=False, default=0.0001, help='seconds per thrift rpc')
+    parser.add_argument('--connections', type=int, required=False, default=4, help='thrift connections of the batched controller')
+    parser.add_argument('--batch-keys', type=int, required=False, default=64)
+    args = parser.parse_args()
+
+    main(args.keys, args.value_bytes, args.latency, args.connections, args.batch_keys)
@@ -1,8 +1,16 @@
 from p4utils.utils.topology import NetworkGraph
 from p4utils.utils.sswitch_thrift_API import SimpleSwitchThriftAPI
 from p4utils.utils.helper import load_topo
-from scapy.all import sniff, Packet, Ether, IP, UDP, TCP, BitField, Raw
+from scapy.all import Packet, Ether, IP, UDP, TCP, BitField, Raw
 from crc import Crc
+from slot_allocator import SlotAllocator
+from id_pool import IdPool
+from thrift_batch import BatchedThriftWriter, STAGE_VALUES, STAGE_COMMIT
+from packet_ingest import PacketIngest, parse_netcache
+from hot_keys import HotKeyTracker
+from eviction import EVICTION_POLICIES
+from instrumentation import Instruments
+from collections import OrderedDict
 
 import threading
 import struct
@@ -14,6 +22,7 @@ import time
 # P4 SWITCH ACTION TABLE NAMES DEFINITIONS
 INGRESS_LOOKUP_TABLE = "ingress_lookup_table"
 EGRESS_LOOKUP_TABLE = "egress_lookup_table"
+CACHE_HITS_REGISTER = "cache_hits"
 
 VTABLE_NAME_PREFIX = 'vt'
 VTABLE_SLOT_SIZE = 8   # in bytes
@@ -25,11 +34,49 @@ RECIRCULATION_COUNT = 2
 NETCACHE_READ_QUERY = 0
 NETCACHE_WRITE_QUERY = 1
 NETCACHE_FLUSH_QUERY = 2
+NETCACHE_READ_FAIL = 3
 NETCACHE_INIT_QUERY = 6
 NETCACHE_VALUE_SIZE = 2048
+# op | seq | key | value | value2
+NETCACHE_HEADER_BYTES = 1 + 4 + 16 + 2 * NETCACHE_VALUE_SIZE // 8
+
+# popularity of the keys is collected over intervals of this length, at the
+# end of which cold cached keys are replaced by hot uncached ones
+STATISTICS_REFRESH_INTERVAL = 30.0   # in seconds
+# misses of an uncached key within an interval that make it hot
+HOT_KEY_THRESHOLD = 3
+# values of the uncached keys kept by the controller for admission
+MAX_CANDIDATES = 4096
 
 UNIX_CHANNEL = '/tmp/server_cont.s'
-CACHE_INSERT_COMPLETE = 'INSERT_OK'
+# messages of the coherence channel with the server (see kv_store/coherence.py):
+# type (1 byte) | count (4 bytes) followed by count entries
+COHERENCE_HEADER = struct.Struct('>BI')
+COHERENCE_HELLO = 0
+COHERENCE_UPDATE = 1       # key (16 bytes) | value (512 bytes) entries
+COHERENCE_INSERT_OK = 2    # key (16 bytes) entries
+COHERENCE_VERSION = 1
+COHERENCE_UPDATE_ENTRY = 16 + 2 * NETCACHE_VALUE_SIZE // 8
+# seconds between attempts to reach the server
+COHERENCE_RETRY_INTERVAL = 1.0
+
+# unix socket answered with a snapshot of the instruments (see
+# kv_store/instrumentation.py)
+STATS_SOCKET = '/tmp/controller_stats.s'
+
+# names of the per op counters of the instruments
+OP_NAMES = {NETCACHE_READ_QUERY: 'read', NETCACHE_WRITE_QUERY: 'write', NETCACHE_FLUSH_QUERY: 'flush',
+        NETCACHE_READ_FAIL: 'read_fail'}
+
+
+def recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("coherence channel closed")
+        data += chunk
+    return bytes(data)
 
 
 class NetcacheHeader(Packet):
@@ -40,12 +87,39 @@ class NetcacheHeader(Packet):
 
 class NCacheController(object):
 
-    def __init__(self, sw_name, vtables_num=16):
-        self.topo = load_topo('../p4/topology.json')
+    def __init__(self, sw_name, vtables_num=16, thrift_apis=None, thrift_connections=4, batch_keys=64,
+            flush_interval=0.01, hot_threshold=HOT_KEY_THRESHOLD, refresh_interval=STATISTICS_REFRESH_INTERVAL,
+            max_candidates=MAX_CANDIDATES, eviction='lru', server_channel=UNIX_CHANNEL, verbose=False):
         self.sw_name = sw_name
-        self.thrift_port = self.topo.get_thrift_port(self.sw_name)
-        self.cpu_port = self.topo.get_cpu_port_index(self.sw_name)
-        self.controller = SimpleSwitchThriftAPI(self.thrift_port)
+        if thrift_apis is None:
+            self.topo = load_topo('../p4/topology.json')
+            self.thrift_port = self.topo.get_thrift_port(self.sw_name)
+            self.cpu_port = self.topo.get_cpu_port_index(self.sw_name)
+            thrift_apis = [SimpleSwitchThriftAPI(self.thrift_port) for _ in range(thrift_connections)]
+        else:
+            # connections to a switch that is not part of the topology (e.g.
+            # mock_thrift.MockThriftAPI)
+            self.topo = None
+            self.thrift_port = thrift_apis[0].thrift_port
+            self.cpu_port = None
+        self.controller = thrift_apis[0]
+
+        # per op counters and timings of the reports, the write-throughs and
+        # the thrift calls (see instrumentation.py and start_stats), and
+        # whether every insertion is printed
+        self.instruments = Instruments('controller')
+        self.verbose = verbose
+
+        # cache insertions are queued and their register and table writes are
+        # sent in batches of batch_keys keys (or every flush_interval seconds)
+        # over all the thrift connections
+        self.writer = BatchedThriftWriter(thrift_apis, max_ops=VTABLE_ENTRIES, register_size=VTABLE_ENTRIES,
+                instruments=self.instruments)
+        self.batch_keys = batch_keys
+        self.flush_interval = flush_interval
+        self.pending_keys = 0
+        self.pending_inform = False
+        self.lock = threading.Lock()
 
         self.vtables = []
         self.vtables_num = vtables_num
@@ -54,34 +128,148 @@ class NCacheController(object):
         # create a pool of ids (as much as the total amount of keys)
         # this pool will be used to assign index to keys which will be
         # used to index the cached key counter and the validity register
-        self.ids_pool = range(0, VTABLE_ENTRIES)
+        self.ids_pool = IdPool(VTABLE_ENTRIES)
 
-        # array of bitmap, which marks available slots per cache line
-        # as 0 bits and occupied slots as 1 bits
-        self.mem_pool = [0] * VTABLE_ENTRIES
+        # allocator of the value table slots (the same slots are used in
+        # every value table, so a single allocator covers all of them)
+        self.mem_pool = SlotAllocator(VTABLE_ENTRIES)
 
         # dictionary storing the value table index, bitmap and counter/validity
         # register index in the P4 switch that corresponds to each key
         self.key_map = {}
 
-        self.setup()
+        # popularity of the cached keys (hits counted by the switch) and of
+        # the uncached ones (misses reported by the switch), and the latest
+        # value written for the uncached keys so that they can be cached once
+        # they turn hot (candidates are only kept once the cache is full, see admit)
+        self.hot_keys = HotKeyTracker(hot_threshold)
+        self.refresh_interval = refresh_interval
+        self.candidates = OrderedDict()
+        self.max_candidates = max_candidates
+
+        # picks the keys removed from the switch when room is needed (see
+        # eviction.py), keys are evicted batch_keys at a time
+        self.eviction = EVICTION_POLICIES[eviction]()
 
+        # connection to the server for the write-through of the values written
+        # to it (see coherence_loop)
+        self.server_channel = server_channel
+        self.server_conn = None
+        self.server_lock = threading.Lock()
+
+        self.instruments.add_source('thrift', self.writer.stats)
+        self.instruments.add_source('slots', self.mem_pool.stats)
+
+        self.setup()
 
-    def inform_server(self):
+        flusher_t = threading.Thread(target=self.flush_loop, daemon=True)
+        flusher_t.start()
+        if refresh_interval > 0:
+            statistics_t = threading.Thread(target=self.statistics_loop, daemon=True)
+            statistics_t.start()
+
+
+    # an INSERT_OK without keys tells the server that a batch of insertions was
+    # committed (nothing is sent while the server is not connected)
+    def inform_server(self, keys=()):
+        message = COHERENCE_HEADER.pack(COHERENCE_INSERT_OK, len(keys)) + b''.join(
+                key.rjust(16, b'\x00') for key in keys)
+        with self.server_lock:
+            if self.server_conn is None:
+                return False
+            try:
+                self.server_conn.sendall(message)
+            except socket.error:
+                #print('Error: Unable to contact server for cache operation completion')
+                return False
+        return True
+
+    # connect to the server and exchange the protocol version
+    def connect_server(self):
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            sock.connect(UNIX_CHANNEL)
-        except socket.error as msg:
-            #print('Error: Unable to contact server for cache operation completion')
-            return
-
-        sock.sendall(CACHE_INSERT_COMPLETE)
+            sock.connect(self.server_channel)
+            sock.sendall(COHERENCE_HEADER.pack(COHERENCE_HELLO, COHERENCE_VERSION))
+            kind, version = COHERENCE_HEADER.unpack(recv_exactly(sock, COHERENCE_HEADER.size))
+        except socket.error:
+            sock.close()
+            return None
+        if kind != COHERENCE_HELLO or version != COHERENCE_VERSION:
+            print(f"Error: server speaks coherence protocol ({kind}, {version})")
+            sock.close()
+            return None
+        return sock
+
+    # serve the updates of the server over the unix channel (reconnecting
+    # whenever the server goes away): each batch of updates is written
+    # through to the switch and acked with an INSERT_OK of its keys
+    def coherence_loop(self):
+        while True:
+            sock = self.connect_server()
+            if sock is None:
+                time.sleep(COHERENCE_RETRY_INTERVAL)
+                continue
+            with self.server_lock:
+                self.server_conn = sock
+
+            try:
+                while True:
+                    kind, count = COHERENCE_HEADER.unpack(recv_exactly(sock, COHERENCE_HEADER.size))
+                    if kind != COHERENCE_UPDATE:
+                        print(f"Error: unexpected coherence message type {kind}")
+                        break
+                    payload = recv_exactly(sock, count * COHERENCE_UPDATE_ENTRY)
+                    updates = []
+                    for offset in range(0, len(payload), COHERENCE_UPDATE_ENTRY):
+                        key = payload[offset:offset + 16].lstrip(b'\x00')
+                        updates.append((key, payload[offset + 16:offset + COHERENCE_UPDATE_ENTRY]))
+                    self.instruments.count('coherence_updates', len(updates))
+                    self.inform_server(self.write_through(updates))
+            except socket.error:
+                pass
+
+            with self.server_lock:
+                self.server_conn = None
+            sock.close()
+
+    def start_coherence(self):
+        coherence_t = threading.Thread(target=self.coherence_loop, daemon=True)
+        coherence_t.start()
+        return coherence_t
+
+    # serve the snapshots of the instruments on socket_path (and dump them to
+    # controller.stats.json every interval seconds)
+    def start_stats(self, interval=0, socket_path=STATS_SOCKET):
+        return self.instruments.start(interval, 'controller.stats.json', socket_path)
 
     def setup(self):
         if self.cpu_port:
             self.controller.mirroring_add(CONTROLLER_MIRROR_SESSION, self.cpu_port)
 
 
+    # send the queued writes of the inserted keys to the switch, the server is
+    # informed once the whole batch is in the cache
+    def commit(self):
+        with self.lock:
+            if self.pending_keys == 0:
+                return
+            start = time.perf_counter_ns()
+            self.writer.flush()
+            self.instruments.add('commit', time.perf_counter_ns() - start)
+            inform = self.pending_inform
+            self.pending_keys = 0
+            self.pending_inform = False
+
+        if inform:
+            self.inform_server()
+
+    # commits the last keys of a burst of insertions that did not fill a batch
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.commit()
+
+
     # set a static allocation scheme for l2 forwarding where the mac address of
     # each host is associated with the port connecting this host to the switch
     def set_forwarding_table(self):
@@ -97,20 +285,18 @@ class NCacheController(object):
 
 
     # this function manages the mapping between between slots in register arrays
-    # and the cached items by implementing the First Fit algorithm described in
-    # Memory Management section of 4.4.2 (netcache paper)
+    # and the cached items (Memory Management section of 4.4.2 of the netcache
+    # paper), slots are handed out by a buddy allocator instead of a first fit
+    # scan of the whole pool so that inserts do not slow down as the cache fills
     def first_fit(self, key, value_size):
-        n_idx = 2
+        # every key occupies 2 slots per value table on each pass through the
+        # pipeline (value on the first pass, value2 after recirculation)
+        n_idx = RECIRCULATION_COUNT * 2
         if value_size <= 0:
             return None
         if key in self.key_map:
             return None
-        for idx in range(len(self.mem_pool) - n_idx + 1):
-            if self.mem_pool[idx] == 0:
-                for jdx in range(n_idx):
-                    self.mem_pool[idx + jdx] = 1
-                return idx
-        return None
+        return self.mem_pool.alloc(n_idx)
 
 
     # converts a list of 1s and 0s represented as strings and converts it
@@ -139,14 +325,65 @@ class NCacheController(object):
 
     # given a key and its associated value, we update the lookup table on
     # the switch and we also update the value registers with the value
-    # given as argument (stored in multiple slots)
+    # given as argument (stored in multiple slots); the writes are queued and
+    # sent to the switch in batches (see commit)
     def insert(self, key, value, cont=True):
+        with self.lock:
+            committed = self.queue_insert(key, value, cont)
+        if committed:
+            self.commit()
+
+    def queue_insert(self, key, value, cont):
+        # a new value of a cached key takes the place of its entry
+        if key in self.key_map:
+            self.queue_evict([key])
+        # make room by evicting the keys picked by the eviction policy
+        if not self.has_room():
+            self.queue_evict(self.eviction.victims(self.batch_keys))
+
         # find where to put the value for given key
         mem_info = self.first_fit(key, len(value))
-        # if key already exists or not space available then stop
+        # if not space available then stop
         if mem_info == None:
-            return
+            return False
         vt_index = mem_info
+
+        # allocate an id from the pool to index the counter and validity register
+        # (give the slots back if every id is taken)
+        key_index = self.ids_pool.alloc()
+        if key_index is None:
+            self.mem_pool.free(vt_index)
+            return False
+
+        self.queue_value(vt_index, value)
+
+        bitmap = 0b11111111
+        # add the new key to the cache lookup table of the p4 switch (matching
+        # all the 128 bits of the key, prompt tagged kv keys exceed 8 bytes)
+        self.writer.table_add(INGRESS_LOOKUP_TABLE, "ingress_set_lookup_metadata",
+            [str(self.key_to_int(key))], [str(bitmap), str(vt_index), str(key_index)])
+        self.writer.table_add(EGRESS_LOOKUP_TABLE, "egress_set_lookup_metadata",
+            [str(self.key_to_int(key))], [str(bitmap), str(vt_index), str(key_index)])
+
+        # mark cache entry for this key as valid
+        self.writer.register_write("ingress_cache_status", key_index, 1, STAGE_COMMIT)
+        self.writer.register_write("egress_cache_status", key_index, 1, STAGE_COMMIT)
+
+        self.key_map[key] = vt_index, bitmap, key_index
+        self.eviction.add(key)
+
+        # inform the server about the successful cache insertion (once the
+        # batch is committed)
+        self.pending_inform = self.pending_inform or cont
+        self.pending_keys += 1
+        self.instruments.count('inserted')
+        if self.verbose:
+            print(f"Inserted key-value pair to cache: ({str(key)}, {str(value)}) ")
+        return self.pending_keys >= self.batch_keys
+
+
+
+    def queue_value(self, vt_index, value):
         # keep track of number of bytes of the value written so far
         cnt = 0
         # store the value of the key in the vtables of the switch while
@@ -156,35 +393,49 @@ class NCacheController(object):
             for i in range(self.vtables_num):
                 for j in range(2):
                     partial_val = value[cnt:cnt+VTABLE_SLOT_SIZE]
-                    self.controller.register_write(VTABLE_NAME_PREFIX + str(i),
+                    self.writer.register_write(VTABLE_NAME_PREFIX + str(i),
                             vt_index + j + h, self.str_to_int(partial_val))
 
                     cnt += VTABLE_SLOT_SIZE
 
-        # allocate an id from the pool to index the counter and validity register
-        # (we take the last element of list because in python list is implemented
-        # to optimize for inserting and removing elements from the end of the list)
-        ids_pool_list = list(self.ids_pool)
-        key_index = ids_pool_list.pop()
-        self.ids_pool = range(len(ids_pool_list))
-    
-        bitmap = 0b11111111
-        # add the new key to the cache lookup table of the p4 switch
-        self.controller.table_add(INGRESS_LOOKUP_TABLE, "ingress_set_lookup_metadata",
-            [str(self.str_to_int(key[8:]))], [str(bitmap), str(vt_index), str(key_index)])
-        self.controller.table_add(EGRESS_LOOKUP_TABLE, "egress_set_lookup_metadata",
-            [str(self.str_to_int(key[8:]))], [str(bitmap), str(vt_index), str(key_index)])
-
-        # mark cache entry for this key as valid
-        self.controller.register_write("ingress_cache_status", key_index, 1)
-        self.controller.register_write("egress_cache_status", key_index, 1)
-
-        self.key_map[key] = vt_index, bitmap, key_index
-
-        # inform the server about the successful cache insertion
-        if cont:
-            self.inform_server()
-        print(f"Inserted key-value pair to cache: ({str(key[8:])}, {str(value)}) ")
+    # write-through of the new values of keys written to the server: the
+    # cached keys are invalidated first (their reads go to the server from
+    # then on), their value slots are rewritten in place and they are
+    # validated again; returns the keys once the switch is coherent with the
+    # server (the values of the uncached candidates are replaced as well, so
+    # that an older value is never inserted later on)
+    def write_through(self, updates):
+        start = time.perf_counter_ns()
+        with self.lock:
+            # the queued insertions go first, they may carry older values
+            self.writer.flush()
+
+            cached = []
+            for key, value in updates:
+                entry = self.key_map.get(key)
+                if entry is None:
+                    if key in self.candidates:
+                        self.candidates[key] = value
+                    continue
+                _, _, key_index = entry
+                self.writer.register_write("ingress_cache_status", key_index, 0, STAGE_VALUES)
+                self.writer.register_write("egress_cache_status", key_index, 0, STAGE_VALUES)
+                cached.append((entry, value))
+            self.writer.flush()
+
+            for (vt_index, _, key_index), value in cached:
+                self.queue_value(vt_index, value)
+                self.writer.register_write("ingress_cache_status", key_index, 1, STAGE_COMMIT)
+                self.writer.register_write("egress_cache_status", key_index, 1, STAGE_COMMIT)
+            self.writer.flush()
+        self.instruments.add('write_through', time.perf_counter_ns() - start)
+        return [key for key, _ in updates]
+
+    # integer value of the 128 bit key field of the netcache header
+    def key_to_int(self, key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return int.from_bytes(key, 'big')
 
 
     # converts a string to a bytes representation and afterwards returns
@@ -238,31 +489,137 @@ class NCacheController(object):
         return words
 
 
-    # flush the entire kv cache
+    # flush the entire kv cache: the status registers and the lookup tables
+    # are cleared with one call each instead of deleting the keys one by one,
+    # after which every slot and id is free again
     def flush(self):
-        '''
-        for key in list(self.key_map.keys()):
-            # delete entry from the lookup_table
-            entry_handle = self.controller.get_handle_from_match(
-                    NETCACHE_LOOKUP_TABLE, [str(self.str_to_int(key)), ])
-
-            if entry_handle is not None:
-                self.controller.table_delete(NETCACHE_LOOKUP_TABLE, entry_handle)
-
-            # delete mapping of key from controller's dictionary
-            vt_idx, bitmap, key_idx = self.key_map[key]
-            del self.key_map[key]
-
-            # deallocate space from memory pool
-            self.mem_pool[vt_idx] = self.mem_pool[vt_idx] ^ bitmap
-
-            # free the id used to index the validity/counter register and append
-            # it back to the id pool of the controller
-            self.ids_pool.append(key_idx)
-
-            # mark cache entry as valid again (should be the last thing to do)
-            self.controller.register_write("cache_status", key_idx, 1)
-        '''
+        with self.lock:
+            self.writer.flush()
+            for register in ("ingress_cache_status", "egress_cache_status", CACHE_HITS_REGISTER):
+                self.writer.register_reset(register)
+            self.writer.table_clear(INGRESS_LOOKUP_TABLE)
+            self.writer.table_clear(EGRESS_LOOKUP_TABLE)
+
+            n_keys = len(self.key_map)
+            self.key_map.clear()
+            self.mem_pool.reset()
+            self.ids_pool.reset()
+            self.eviction.reset()
+            self.candidates.clear()
+            self.pending_keys = 0
+            self.pending_inform = False
+        print(f"Flushed {n_keys} keys from the cache")
+        return n_keys
+
+    # there is room in the switch for one more key
+    def has_room(self):
+        return self.mem_pool.largest_free_block() >= RECIRCULATION_COUNT * 2 and len(self.ids_pool) > 0
+
+    # keys written to the server are cached while there is room in the switch,
+    # afterwards their value is kept as a candidate until they turn hot (new
+    # values of cached keys are always written)
+    def admit(self, key, value):
+        with self.lock:
+            if key in self.key_map or self.has_room():
+                self.candidates.pop(key, None)
+                committed = self.queue_insert(key, value, True)
+            else:
+                self.candidates[key] = value
+                self.candidates.move_to_end(key)
+                while len(self.candidates) > self.max_candidates:
+                    self.candidates.popitem(last=False)
+                committed = False
+        if committed:
+            self.commit()
+
+    # a read of an uncached key, the first time the key turns hot in the
+    # interval it takes the place of the key picked by the eviction policy (if
+    # its value is known and it was read more often than that key in the last
+    # interval)
+    def report_miss(self, key):
+        if not self.hot_keys.miss(key):
+            return
+        with self.lock:
+            if key not in self.candidates:
+                return
+            if not self.has_room():
+                victims = self.eviction.victims(1)
+                if not victims or self.hot_keys.hits_of(victims[0]) >= self.hot_keys.estimate(key):
+                    return
+                self.queue_evict(victims)
+            committed = self.queue_insert(key, self.candidates.pop(key), False)
+        if committed:
+            self.commit()
+
+    # remove keys from the cache: their entries are invalidated and deleted
+    # from the lookup tables, and once that has reached the switch their
+    # slots and ids are handed back to the pools
+    def evict(self, keys):
+        with self.lock:
+            return self.queue_evict(keys)
+
+    def queue_evict(self, keys):
+        # the queued insertions go first so that none of them is reordered
+        # with the deletion of the same entry
+        self.writer.flush()
+
+        evicted = []
+        for key in keys:
+            entry = self.key_map.pop(key, None)
+            if entry is None:
+                continue
+            self.eviction.remove(key)
+            vt_index, bitmap, key_index = entry
+            self.writer.register_write("ingress_cache_status", key_index, 0, STAGE_VALUES)
+            self.writer.register_write("egress_cache_status", key_index, 0, STAGE_VALUES)
+            self.writer.table_delete(INGRESS_LOOKUP_TABLE, [str(self.key_to_int(key))])
+            self.writer.table_delete(EGRESS_LOOKUP_TABLE, [str(self.key_to_int(key))])
+            evicted.append(entry)
+        self.writer.flush()
+        self.instruments.count('evicted', len(evicted))
+
+        for vt_index, bitmap, key_index in evicted:
+            self.mem_pool.free(vt_index)
+            self.ids_pool.free(key_index)
+        return len(evicted)
+
+    # at the end of every interval the hits of the cached keys are collected
+    # from the switch and the hot candidates replace cold cached keys
+    def statistics_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh_statistics()
+
+    # the counters are read and reset holding the lock, so that no insertion
+    # or eviction hands a key index over to another key in the meantime
+    def refresh_statistics(self):
+        with self.lock:
+            counters = self.writer.register_read(CACHE_HITS_REGISTER)
+            self.writer.register_reset(CACHE_HITS_REGISTER)
+
+            hits = {key: counters[key_index] for key, (_, _, key_index) in self.key_map.items()}
+            self.hot_keys.set_hits(hits)
+            self.eviction.record_hits(hits)
+
+            hot = sorted(((self.hot_keys.estimate(key), key) for key in self.candidates), reverse=True)
+            hot = [(count, key) for count, key in hot if count >= self.hot_keys.threshold]
+            while hot and self.has_room():
+                _, key = hot.pop(0)
+                self.queue_insert(key, self.candidates.pop(key), False)
+            # the hottest candidates take the place of the keys picked by the
+            # eviction policy that were read less often
+            replaced = [(key, victim) for (count, key), victim in zip(hot, self.eviction.victims(len(hot)))
+                    if count > self.hot_keys.hits_of(victim)]
+            self.queue_evict([victim for _, victim in replaced])
+            for key, _ in replaced:
+                self.queue_insert(key, self.candidates.pop(key), False)
+        self.commit()
+
+        ratio = self.hot_keys.refresh()
+        _, n_hits, n_misses, _ = self.hot_keys.history[-1]
+        print(f"Hit ratio {ratio:.3f} ({n_hits} hits, {n_misses} misses) over the last {self.refresh_interval:.0f}"
+                f" seconds, {len(replaced)} cold keys replaced, {len(self.key_map)} keys cached")
+        return ratio
 
     # handling reports from the switch corresponding to hot keys, updates to
     # key-value pairs or deletions - this function receives a packet, extracts
@@ -278,13 +635,31 @@ class NCacheController(object):
             ncache_header = NetcacheHeader(pkt[TCP].payload)
 
         key = self.int_to_packed(ncache_header.key, max_width=128)
-        value = self.int_to_packed(ncache_header.value, max_width=NETCACHE_VALUE_SIZE)
-
-        op = ncache_header.op
-
+        # keep value and value2 at their full width: packed kv packets carry
+        # several float vectors and stripping zero bytes would corrupt them
+        value = (ncache_header.value.to_bytes(NETCACHE_VALUE_SIZE // 8, 'big') +
+                ncache_header.value2.to_bytes(NETCACHE_VALUE_SIZE // 8, 'big'))
+
+        self.handle_update(ncache_header.op, key, value)
+
+    # same as recv_switch_updates for the raw netcache header of a packet
+    # cloned by the software model of the switch (see soft_switch.py)
+    def recv_netcache(self, data):
+        data = bytes(data[:NETCACHE_HEADER_BYTES]).ljust(NETCACHE_HEADER_BYTES, b'\x00')
+        op, key, value = parse_netcache(data)
+        self.handle_update(op, key, bytes(value))
+
+    def handle_update(self, op, key, value):
+        self.instruments.count(OP_NAMES.get(op, 'invalid'))
+        start = time.perf_counter_ns()
         if op == NETCACHE_WRITE_QUERY:
             #print("Received write for key = " + str(key))
-            self.insert(key, value)
+            self.admit(key, value)
+            self.instruments.add('admit', time.perf_counter_ns() - start)
+
+        elif op in (NETCACHE_READ_QUERY, NETCACHE_READ_FAIL):
+            self.report_miss(key)
+            self.instruments.add('report_miss', time.perf_counter_ns() - start)
 
         elif op == NETCACHE_FLUSH_QUERY:
             print("Received query to flush")
@@ -294,24 +669,34 @@ class NCacheController(object):
             print("Error: unrecognized operation field of netcache header")
 
 
-    # sniff infinitely the interface connected to the P4 switch and when a valid netcache
-    # packet is captured, handle the packet via a callback to recv_switch_updates function
-    def hot_reports_loop(self):
+    # receive infinitely the packets cloned to the interface connected to the P4
+    # switch and handle the netcache header of each one via a callback to
+    # handle_update (see packet_ingest.py, the headers are parsed in place from
+    # a raw socket instead of being dissected by scapy)
+    def hot_reports_loop(self, workers=1):
         cpu_port_intf = str(self.topo.get_cpu_port_intf(self.sw_name))
-        sniff(iface=cpu_port_intf, prn=self.recv_switch_updates, filter="port 50000")
+        ingest = PacketIngest(cpu_port_intf, self.handle_update, workers=workers)
+        for thread in ingest.start():
+            thread.join()
 
     def dummy_populate_vtables(self):
-        test_keys_l = "0000000012345678"
+        test_keys_l = "12345678"
         test_values_512 = "aaaaaaaabbbbbbbbccccccccddddddddeeeeeeeeffffffffgggggggghhhhhhhhiiiiiiiijjjjjjjjkkkkkkkkllllllllmmmmmmmmnnnnnnnnooooooooppppppppqqqqqqqqrrrrrrrrssssssssttttttttuuuuuuuuvvvvvvvvwwwwwwwwxxxxxxxxyyyyyyyyzzzzzzzz111111112222222233333333444444445555555566666666666666665555555544444444333333332222222211111111zzzzzzzzyyyyyyyyxxxxxxxxwwwwwwwwvvvvvvvvuuuuuuuuttttttttssssssssrrrrrrrrqqqqqqqqppppppppoooooooonnnnnnnnmmmmmmmmllllllllkkkkkkkkjjjjjjjjiiiiiiiihhhhhhhhggggggggffffffffeeeeeeeeddddddddccccccccbbbbbbbbaaaaaaaa"
         test_values_256 = "aaaaaaaabbbbbbbbccccccccddddddddeeeeeeeeffffffffgggggggghhhhhhhhiiiiiiiijjjjjjjjkkkkkkkkllllllllmmmmmmmmnnnnnnnnooooooooppppppppqqqqqqqqrrrrrrrrssssssssttttttttuuuuuuuuvvvvvvvvwwwwwwwwxxxxxxxxyyyyyyyyzzzzzzzz111111112222222233333333444444445555555566666666"
         test_values_128 = "aaaaaaaabbbbbbbbccccccccddddddddeeeeeeeeffffffffgggggggghhhhhhhhiiiiiiiijjjjjjjjkkkkkkkkllllllllmmmmmmmmnnnnnnnnoooooooopppppppp"
         self.insert(test_keys_l, test_values_512, False)
+        self.commit()
 
 
     def main(self):
         self.set_forwarding_table()
         self.set_value_tables()
         self.dummy_populate_vtables()
+        # keep the cache coherent with the server while handling the reports
+        # of the switch
+        self.start_coherence()
+        self.start_stats()
+        self.hot_reports_loop()
 
 
 if __name__ == "__main__":
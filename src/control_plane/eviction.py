@@ -0,0 +1,133 @@
+import heapq
+import random
+from collections import OrderedDict
+
+
+# eviction policies pick the cached keys to remove when room is needed; the
+# controller tells them about the keys it caches (add) and removes (remove),
+# and about the hits the switch counted for the cached keys over the last
+# statistics interval (record_hits), as it never sees the reads served by
+# the switch one by one
+
+# least recently used: keys are ordered by the last time they were cached or
+# hit (the keys hit in an interval are ordered by their number of hits)
+class LRUPolicy(object):
+
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def add(self, key):
+        self.order[key] = None
+        self.order.move_to_end(key)
+
+    def remove(self, key):
+        self.order.pop(key, None)
+
+    def record_hits(self, hits):
+        for key, count in sorted(hits.items(), key=lambda item: item[1]):
+            if count > 0 and key in self.order:
+                self.order.move_to_end(key)
+
+    def victims(self, n):
+        victims = []
+        for key in self.order:
+            if len(victims) == n:
+                break
+            victims.append(key)
+        return victims
+
+    def reset(self):
+        self.order.clear()
+
+    def __len__(self):
+        return len(self.order)
+
+
+# least frequently used: keys are ordered by their hits, halved at the end of
+# every interval so that keys that were hot long ago eventually age out
+class LFUPolicy(object):
+
+    def __init__(self, decay=0.5):
+        self.decay = decay
+        self.counts = {}
+
+    def add(self, key):
+        self.counts[key] = 0
+
+    def remove(self, key):
+        self.counts.pop(key, None)
+
+    def record_hits(self, hits):
+        for key in self.counts:
+            self.counts[key] = self.counts[key] * self.decay + hits.get(key, 0)
+
+    def victims(self, n):
+        return heapq.nsmallest(n, self.counts, key=self.counts.get)
+
+    def reset(self):
+        self.counts.clear()
+
+    def __len__(self):
+        return len(self.counts)
+
+
+# sampling: the victim is the key with the fewest hits in the last interval
+# among sample keys drawn at random, which approximates LFU without ranking
+# every cached key
+class SamplePolicy(object):
+
+    def __init__(self, sample=8, seed=None):
+        self.sample = sample
+        self.rng = random.Random(seed)
+        # cached keys in a list (for sampling) with the position of each key
+        self.keys = []
+        self.positions = {}
+        self.hits = {}
+
+    def add(self, key):
+        if key not in self.positions:
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+
+    def remove(self, key):
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+        last = self.keys.pop()
+        if position < len(self.keys):
+            self.keys[position] = last
+            self.positions[last] = position
+        self.hits.pop(key, None)
+
+    def record_hits(self, hits):
+        self.hits = {key: count for key, count in hits.items() if key in self.positions}
+
+    # coldest first
+    def victims(self, n):
+        count = lambda key: self.hits.get(key, 0)
+        # sampling would mostly draw keys already picked
+        if n * 2 >= len(self.keys):
+            return sorted(self.keys, key=count)[:n]
+
+        victims = set()
+        while len(victims) < n:
+            sample = [self.rng.choice(self.keys) for _ in range(self.sample)]
+            sample = [key for key in sample if key not in victims]
+            if sample:
+                victims.add(min(sample, key=count))
+        return sorted(victims, key=count)
+
+    def reset(self):
+        self.keys = []
+        self.positions.clear()
+        self.hits = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+
+EVICTION_POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'sample': SamplePolicy,
+}
@@ -0,0 +1,128 @@
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+
+# row indices of a key in a table of depth rows of width counters (or bits),
+# derived from two 64 bit hashes as h1 + i * h2 (Kirsch and Mitzenmacher)
+def key_indices(key, depth, width):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % width for i in range(depth)]
+
+
+# count-min sketch of the number of times each key was seen, estimates never
+# undercount and overcount by at most e/width of the total count with
+# probability 1 - e**-depth (counters are only raised to the new minimum, the
+# conservative update, which tightens the overcount of the rarer keys)
+class CountMinSketch(object):
+
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = np.arange(depth)
+        self.counters = np.zeros((depth, width), dtype=np.uint32)
+        self.total = 0
+
+    # count the key, returns its new estimate
+    def add(self, key, count=1):
+        cols = key_indices(key, self.depth, self.width)
+        cells = self.counters[self.rows, cols]
+        estimate = int(cells.min()) + count
+        self.counters[self.rows, cols] = np.maximum(cells, estimate)
+        self.total += count
+        return estimate
+
+    def estimate(self, key):
+        return int(self.counters[self.rows, key_indices(key, self.depth, self.width)].min())
+
+    def reset(self):
+        self.counters[:] = 0
+        self.total = 0
+
+
+# bloom filter of the keys already reported as hot, so that a key crossing
+# the threshold is acted upon once per statistics interval
+class BloomFilter(object):
+
+    def __init__(self, n_bits=1 << 18, n_hashes=3):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.bits = np.zeros(n_bits, dtype=bool)
+
+    # set the bits of the key, returns whether they were all set before
+    def add(self, key):
+        cols = key_indices(key, self.n_hashes, self.n_bits)
+        present = bool(self.bits[cols].all())
+        self.bits[cols] = True
+        return present
+
+    def __contains__(self, key):
+        return bool(self.bits[key_indices(key, self.n_hashes, self.n_bits)].all())
+
+    def reset(self):
+        self.bits[:] = False
+
+
+# popularity of the keys over a statistics interval as in the netcache
+# design: misses of the keys that are not cached go through a count-min
+# sketch and a bloom filter that reports each key once it has been seen
+# threshold times, while the cached keys have exact hit counters (read from
+# the switch); refresh() closes the interval, records its hit ratio and
+# starts counting the misses from zero
+class HotKeyTracker(object):
+
+    def __init__(self, threshold=3, sketch_width=4096, sketch_depth=4, bloom_bits=1 << 18, bloom_hashes=3):
+        self.threshold = threshold
+        self.sketch = CountMinSketch(sketch_width, sketch_depth)
+        self.reported = BloomFilter(bloom_bits, bloom_hashes)
+        # cached key -> hits in the last interval
+        self.hits = {}
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        # (end of the interval, hits, misses, hit ratio)
+        self.history = []
+
+    # a miss of an uncached key, returns True the first time the key turns hot
+    # in the interval
+    def miss(self, key):
+        with self.lock:
+            self.misses += 1
+            if self.sketch.add(key) < self.threshold:
+                return False
+            return not self.reported.add(key)
+
+    def estimate(self, key):
+        with self.lock:
+            return self.sketch.estimate(key)
+
+    def is_hot(self, key):
+        return self.estimate(key) >= self.threshold
+
+    def set_hits(self, hits):
+        with self.lock:
+            self.hits = dict(hits)
+
+    def hits_of(self, key):
+        with self.lock:
+            return self.hits.get(key, 0)
+
+    def refresh(self):
+        with self.lock:
+            hits = sum(self.hits.values())
+            total = hits + self.misses
+            ratio = hits / total if total else 0.0
+            self.history.append((time.time(), hits, self.misses, ratio))
+
+            # the hits are kept until the next set_hits, the cached keys are
+            # compared by their hits in the last interval
+            self.sketch.reset()
+            self.reported.reset()
+            self.misses = 0
+            return ratio
@@ -0,0 +1,39 @@
+from array import array
+
+
+# pool of the integer ids 0..n-1 (the indices of the counter and validity
+# registers of the cached keys); free ids are kept in an array used as a
+# stack, so that both alloc and free are O(1), and a byte per id tracks
+# which ones are allocated to catch double frees
+class IdPool(object):
+
+    def __init__(self, n):
+        self.n = n
+        # lowest ids on top of the stack, so they are handed out first
+        self.free_ids = array('I', range(n - 1, -1, -1))
+        self.in_use = bytearray(n)
+
+    def __len__(self):
+        return len(self.free_ids)
+
+    # returns a free id or None if all of them are allocated
+    def alloc(self):
+        if not self.free_ids:
+            return None
+        idx = self.free_ids.pop()
+        self.in_use[idx] = 1
+        return idx
+
+    def free(self, idx):
+        if not self.in_use[idx]:
+            raise ValueError("id " + str(idx) + " is not allocated")
+        self.in_use[idx] = 0
+        self.free_ids.append(idx)
+
+    def is_allocated(self, idx):
+        return bool(self.in_use[idx])
+
+    # free every id
+    def reset(self):
+        self.free_ids = array('I', range(self.n - 1, -1, -1))
+        self.in_use = bytearray(self.n)
@@ -0,0 +1 @@
+../kv_store/instrumentation.py
\ No newline at end of file
@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+# stand-in for SimpleSwitchThriftAPI that keeps the registers and tables in
+# memory and waits latency seconds per call (the round trip of a thrift rpc
+# to the switch), used to benchmark the controller without a switch
+class MockThriftAPI(object):
+
+    def __init__(self, thrift_port=9090, latency=0.0001, register_size=65536, registers=None, tables=None):
+        self.thrift_port = thrift_port
+        self.latency = latency
+        self.register_size = register_size
+
+        # connections to the same mock switch share its state
+        self.registers = {} if registers is None else registers
+        self.tables = {} if tables is None else tables
+        self.lock = threading.Lock()
+        self.next_handle = 0
+
+        self.calls = 0
+
+    # another connection to the same switch
+    def connect(self):
+        return MockThriftAPI(self.thrift_port, self.latency, self.register_size, self.registers, self.tables)
+
+    def rpc(self):
+        self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def register(self, register_name):
+        register = self.registers.get(register_name)
+        if register is None:
+            register = self.registers[register_name] = [0] * self.register_size
+        return register
+
+    # index is a cell or a [start, end] range (end included)
+    def register_write(self, register_name, index, value):
+        self.rpc()
+        with self.lock:
+            register = self.register(register_name)
+            if isinstance(index, list):
+                start, end = index
+                register[start:end + 1] = [value] * (end - start + 1)
+            else:
+                register[index] = value
+
+    def register_read(self, register_name, index=None):
+        self.rpc()
+        with self.lock:
+            register = self.register(register_name)
+            return list(register) if index is None else register[index]
+
+    def register_reset(self, register_name):
+        self.rpc()
+        with self.lock:
+            self.registers[register_name] = [0] * self.register_size
+
+    def table_add(self, table_name, action_name, match_keys, action_params=[], prio=0):
+        self.rpc()
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 1
+            self.tables.setdefault(table_name, {})[tuple(match_keys)] = (handle, action_name, list(action_params))
+            return handle
+
+    def table_delete(self, table_name, entry_handle, quiet=False):
+        self.rpc()
+        with self.lock:
+            entries = self.tables.get(table_name, {})
+            for match, entry in list(entries.items()):
+                if entry[0] == entry_handle:
+                    del entries[match]
+
+    def table_delete_match(self, table_name, match_keys):
+        self.rpc()
+        with self.lock:
+            self.tables.get(table_name, {}).pop(tuple(match_keys), None)
+
+    def table_clear(self, table_name):
+        self.rpc()
+        with self.lock:
+            self.tables[table_name] = {}
+
+    def get_handle_from_match(self, table_name, match_keys):
+        self.rpc()
+        with self.lock:
+            entry = self.tables.get(table_name, {}).get(tuple(match_keys))
+            return None if entry is None else entry[0]
+
+    def mirroring_add(self, mirror_id, egress_port):
+        self.rpc()
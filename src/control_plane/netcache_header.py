@@ -0,0 +1,16 @@
+import struct
+
+# layout of the netcache header of p4/include/headers.p4 (netcache_t), shared
+# by the software model of the switch, the ingest of its reports and the kv
+# store codec (kv_store/netcache_header.py links to this file):
+# op (1 byte) | seq (4 bytes) | key (16 bytes) | value (256 bytes) | value2 (256 bytes)
+NETCACHE_PORT = 50000
+
+# the fixed part, the value fields follow it
+NETCACHE_HEADER = struct.Struct('>BI16s')
+NETCACHE_KEY_SIZE = 16
+# each of value and value2 (NETCACHE_VALUE_WIDTH_MAX bits)
+NETCACHE_FIELD_BYTES = 256
+# value and value2 together
+NETCACHE_VALUE_BYTES = 2 * NETCACHE_FIELD_BYTES
+NETCACHE_HEADER_BYTES = NETCACHE_HEADER.size + NETCACHE_VALUE_BYTES
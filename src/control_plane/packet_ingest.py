@@ -0,0 +1,198 @@
+import queue
+import socket
+import struct
+import threading
+
+from netcache_header import NETCACHE_PORT, NETCACHE_HEADER, NETCACHE_VALUE_BYTES, NETCACHE_HEADER_BYTES
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+ETH_P_8021Q = 0x8100
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+# not exported by the socket module (PACKET_IGNORE_OUTGOING needs linux >= 4.20)
+SOL_PACKET = 263
+PACKET_IGNORE_OUTGOING = 23
+PACKET_OUTGOING = 4
+
+ETH_HEADER = struct.Struct('>6s6sH')
+UDP_PORTS = struct.Struct('>HH')
+
+SNAPLEN = 2048
+
+
+# offset of the netcache header of an ethernet frame sent from or
+# to port 50000 (the filter of the former scapy sniff loop), None for any
+# other frame or when the frame is too short to carry a netcache header
+def netcache_offset(frame, length):
+    if length < ETH_HEADER.size:
+        return None
+    offset = ETH_HEADER.size
+    ethertype = (frame[12] << 8) | frame[13]
+    if ethertype == ETH_P_8021Q:
+        ethertype = (frame[16] << 8) | frame[17]
+        offset += 4
+    if ethertype != ETH_P_IP or length < offset + 20:
+        return None
+
+    ihl = (frame[offset] & 0x0f) * 4
+    proto = frame[offset + 9]
+    offset += ihl
+    if proto == IPPROTO_UDP:
+        l4_len = 8
+    elif proto == IPPROTO_TCP:
+        if length < offset + 13:
+            return None
+        l4_len = (frame[offset + 12] >> 4) * 4
+    else:
+        return None
+    if length < offset + l4_len:
+        return None
+
+    sport, dport = UDP_PORTS.unpack_from(frame, offset)
+    if sport != NETCACHE_PORT and dport != NETCACHE_PORT:
+        return None
+    offset += l4_len
+    if length - offset < NETCACHE_HEADER_BYTES:
+        return None
+    return offset
+
+
+# op, key (without its zero padding) and value + value2 of the netcache
+# header at offset of buf, the value is a view of buf
+def parse_netcache(buf, offset=0):
+    op, seq, key = NETCACHE_HEADER.unpack_from(buf, offset)
+    start = offset + NETCACHE_HEADER.size
+    return op, key.lstrip(b'\x00'), memoryview(buf)[start:start + NETCACHE_VALUE_BYTES]
+
+
+# ingest of the netcache packets cloned by the switch to the cpu port: a raw
+# AF_PACKET socket receives frames into a ring of preallocated buffers, the
+# headers are parsed in place and the workers call handler(op, key, value)
+# for each report; a buffer goes back to the ring once its report has been
+# handled, and frames are dropped (and counted) while every buffer is in use
+class PacketIngest(object):
+
+    def __init__(self, iface, handler, n_buffers=4096, workers=1, rcvbuf=32 * 1024 * 1024):
+        self.iface = iface
+        self.handler = handler
+
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        try:
+            # only frames received on the interface, not the ones sent on it
+            self.sock.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+            self.ignore_outgoing = True
+        except OSError:
+            self.ignore_outgoing = False
+        self.sock.bind((iface, 0))
+
+        self.buffers = [bytearray(SNAPLEN) for _ in range(n_buffers)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+        self.free = queue.SimpleQueue()
+        for i in range(n_buffers):
+            self.free.put(i)
+        # (buffer, offset of the netcache header) of the parsed reports
+        self.reports = queue.SimpleQueue()
+
+        self.workers = workers
+        self.running = False
+
+        self.frames = 0
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def start(self):
+        self.running = True
+        threads = [threading.Thread(target=self.worker_loop, daemon=True) for _ in range(self.workers)]
+        threads.append(threading.Thread(target=self.receive_loop, daemon=True))
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def stop(self):
+        self.running = False
+        for _ in range(self.workers):
+            self.reports.put(None)
+        self.sock.close()
+
+    def receive_loop(self):
+        sock = self.sock
+        spare = bytearray(SNAPLEN)
+        while self.running:
+            try:
+                i = self.free.get_nowait()
+            except queue.Empty:
+                # every buffer waits for a worker, the frame is lost
+                i = None
+            view = self.views[i] if i is not None else spare
+
+            try:
+                if self.ignore_outgoing:
+                    length = sock.recv_into(view)
+                    offset = netcache_offset(view, length)
+                else:
+                    length, addr = sock.recvfrom_into(view)
+                    offset = netcache_offset(view, length) if addr[2] != PACKET_OUTGOING else None
+            except OSError:
+                break
+            self.frames += 1
+
+            if offset is None:
+                if i is not None:
+                    self.free.put(i)
+            elif i is None:
+                self.dropped += 1
+            else:
+                self.reports.put((i, offset))
+
+    def worker_loop(self):
+        handler = self.handler
+        while True:
+            report = self.reports.get()
+            if report is None:
+                return
+            i, offset = report
+            try:
+                op, key, value = parse_netcache(self.buffers[i], offset)
+                # the value is copied out before the buffer is reused
+                handler(op, key, bytes(value))
+                self.handled += 1
+            except Exception as e:
+                self.errors += 1
+                print("Error: failed to handle netcache report: " + str(e))
+            finally:
+                self.free.put(i)
+
+    def pending(self):
+        return self.reports.qsize()
+
+    def stats(self):
+        return {'frames': self.frames, 'handled': self.handled, 'dropped': self.dropped, 'errors': self.errors}
+
+
+# frames of a pcap file (microsecond or nanosecond timestamps, either byte
+# order) as (timestamp, bytes)
+def read_pcap(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic = data[:4]
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise ValueError(f"{path} is not a pcap file")
+    scale = 1e-9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e-6
+
+    record = struct.Struct(endian + 'IIII')
+    frames = []
+    offset = 24
+    while offset + record.size <= len(data):
+        sec, frac, incl_len, _ = record.unpack_from(data, offset)
+        offset += record.size
+        frames.append((sec + frac * scale, data[offset:offset + incl_len]))
+        offset += incl_len
+    return frames
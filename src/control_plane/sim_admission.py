@@ -0,0 +1,86 @@
+import contextlib
+import os
+
+import numpy as np
+
+from controller import NCacheController, NETCACHE_READ_QUERY, NETCACHE_WRITE_QUERY
+from eviction import EVICTION_POLICIES
+from netcache_header import NETCACHE_HEADER, NETCACHE_HEADER_BYTES
+from soft_switch import NetCacheSwitch
+# source ports of the packets of the server and of the clients
+NETCACHE_PORT_SERVER = 50000
+NETCACHE_PORT_CLIENT = 40000
+
+
+def packet(op, key, value=b''):
+    return (NETCACHE_HEADER.pack(op, 0, key.rjust(16, b'\x00')) + value).ljust(NETCACHE_HEADER_BYTES, b'\x00')
+
+
+# ranks of n_queries reads drawn from a zipf distribution over n_keys keys
+# (0 < skew < 1 as in gen_zipf_samples.py)
+def zipf_ranks(n_keys, n_queries, skew, rng):
+    weights = 1.0 / np.arange(1, n_keys + 1) ** skew
+    return rng.choice(n_keys, size=n_queries, p=weights / weights.sum())
+
+
+# the server writes every key once in a random order (the switch clones the
+# writes to the controller, which caches keys while there is room), then the
+# clients read keys drawn from the zipf distribution; the hit ratio is
+# reported for every interval of interval_queries reads
+def simulate(admission, n_keys, n_queries, skew, interval_queries, threshold, seed, eviction='lru'):
+    rng = np.random.default_rng(seed)
+    # rank -> key, popularity is unrelated to the write order
+    keys = [f"{n:08}".encode('utf-8') for n in rng.permutation(n_keys)]
+
+    switch = NetCacheSwitch()
+    controller = NCacheController('s1', thrift_apis=[switch], hot_threshold=threshold if admission else float('inf'),
+            refresh_interval=0, max_candidates=n_keys, eviction=eviction)
+    switch.clone_handler = controller.recv_netcache
+    controller.set_value_tables()
+
+    for rank in rng.permutation(n_keys):
+        switch.process(packet(NETCACHE_WRITE_QUERY, keys[rank], keys[rank] * 8), NETCACHE_PORT_SERVER)
+    controller.commit()
+
+    ratios = []
+    ranks = zipf_ranks(n_keys, n_queries, skew, rng)
+    for start in range(0, n_queries, interval_queries):
+        hits = switch.stats['hits']
+        batch = ranks[start:start + interval_queries]
+        for rank in batch:
+            switch.process(packet(NETCACHE_READ_QUERY, keys[rank]), NETCACHE_PORT_CLIENT)
+        ratios.append((switch.stats['hits'] - hits) / len(batch))
+        if admission:
+            controller.refresh_statistics()
+    return ratios, len(controller.key_map)
+
+
+def main(n_keys, n_queries, skew, interval_queries, threshold, seed, policies):
+    # the controller prints every insertion
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        insert_all, cached = simulate(False, n_keys, n_queries, skew, interval_queries, threshold, seed)
+        hot_keys = [simulate(True, n_keys, n_queries, skew, interval_queries, threshold, seed, policy)[0]
+                for policy in policies]
+
+    print(f"{n_keys} keys ({cached} fit in the cache), zipf skew {skew}, hit ratio every {interval_queries} reads")
+    print(f"{'interval':<10}{'insert all':>12}" + ''.join(f"{'hot, ' + policy:>12}" for policy in policies))
+    for n, ratios in enumerate(zip(insert_all, *hot_keys)):
+        print(f"{n:<10}" + ''.join(f"{ratio:>12.3f}" for ratio in ratios))
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--keys', type=int, required=False, default=100000)
+    parser.add_argument('--queries', type=int, required=False, default=200000)
+    parser.add_argument('--skew', type=float, required=False, default=0.9)
+    parser.add_argument('--interval', type=int, required=False, default=20000, help='reads per statistics interval')
+    parser.add_argument('--threshold', type=int, required=False, default=3, help='misses that make a key hot')
+    parser.add_argument('--seed', type=int, required=False, default=0)
+    parser.add_argument('--eviction', nargs='+', choices=list(EVICTION_POLICIES), required=False,
+            default=list(EVICTION_POLICIES), help='eviction policies compared')
+    args = parser.parse_args()
+
+    main(args.keys, args.queries, args.skew, args.interval, args.threshold, args.seed, args.eviction)
@@ -0,0 +1,104 @@
+# buddy allocator of contiguous runs of value table slots: a request of n
+# slots is served by a block of the smallest power of two >= n, found in the
+# free list of its order or split off a larger free block; freed blocks are
+# merged back with their buddy (the block they were split from) while it is
+# free, so both allocation and deallocation take O(log N) steps
+class SlotAllocator(object):
+
+    def __init__(self, n_slots):
+        self.n_slots = n_slots
+        self.max_order = max(n_slots.bit_length() - 1, 0)
+
+        # start of the allocated blocks -> (order, requested slots)
+        self.allocated = {}
+        self.allocated_slots = 0
+        self.requested_slots = 0
+
+        self.reset()
+
+    # free every slot (blocks handed out before are forgotten)
+    def reset(self):
+        # free_lists[order] holds the start of each free block of 2**order slots
+        self.free_lists = [set() for _ in range(self.max_order + 1)]
+        self.allocated.clear()
+        self.allocated_slots = 0
+        self.requested_slots = 0
+
+        # carve the slots into the largest aligned blocks (n_slots does not
+        # have to be a power of two)
+        start = 0
+        for order in range(self.max_order, -1, -1):
+            size = 1 << order
+            while start + size <= self.n_slots and start % size == 0:
+                self.free_lists[order].add(start)
+                start += size
+
+    def order_of(self, n):
+        return max(n - 1, 0).bit_length()
+
+    # returns the first slot of a run of n contiguous slots or None if there
+    # is no free block large enough
+    def alloc(self, n):
+        if n <= 0:
+            return None
+        order = self.order_of(n)
+
+        found = order
+        while found <= self.max_order and not self.free_lists[found]:
+            found += 1
+        if found > self.max_order:
+            return None
+
+        start = self.free_lists[found].pop()
+        # split the block, keeping the lower half and freeing the upper one
+        while found > order:
+            found -= 1
+            self.free_lists[found].add(start + (1 << found))
+
+        self.allocated[start] = (order, n)
+        self.allocated_slots += 1 << order
+        self.requested_slots += n
+        return start
+
+    # free the run of slots starting at start, returns the number of slots
+    # that were requested for it
+    def free(self, start):
+        order, n = self.allocated.pop(start)
+        self.allocated_slots -= 1 << order
+        self.requested_slots -= n
+
+        while order < self.max_order:
+            buddy = start ^ (1 << order)
+            if buddy not in self.free_lists[order]:
+                break
+            self.free_lists[order].remove(buddy)
+            start = min(start, buddy)
+            order += 1
+        self.free_lists[order].add(start)
+        return n
+
+    def is_allocated(self, start):
+        return start in self.allocated
+
+    def largest_free_block(self):
+        for order in range(self.max_order, -1, -1):
+            if self.free_lists[order]:
+                return 1 << order
+        return 0
+
+    # internal fragmentation is the share of the allocated slots that were not
+    # requested (rounding up to a power of two), external fragmentation the
+    # share of the free slots that are not part of the largest free block
+    def stats(self):
+        free_slots = self.n_slots - self.allocated_slots
+        largest = self.largest_free_block()
+        return {
+            'slots': self.n_slots,
+            'allocations': len(self.allocated),
+            'allocated': self.allocated_slots,
+            'requested': self.requested_slots,
+            'free': free_slots,
+            'largest_free_block': largest,
+            'internal_fragmentation': 1.0 - self.requested_slots / self.allocated_slots if self.allocated_slots else 0.0,
+            'external_fragmentation': 1.0 - largest / free_slots if free_slots else 0.0,
+        }
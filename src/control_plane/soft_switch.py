@@ -0,0 +1,337 @@
+import selectors
+import socket
+import threading
+import time
+
+import numpy as np
+
+from netcache_header import NETCACHE_PORT, NETCACHE_HEADER, NETCACHE_FIELD_BYTES, NETCACHE_HEADER_BYTES
+
+READ_QUERY = 0x00
+WRITE_QUERY = 0x01
+FLUSH_QUERY = 0x02
+READ_FAIL = 0x03
+
+NETCACHE_ENTRIES = 65536
+NETCACHE_VTABLE_NUM = 16
+INGRESS_VTABLE_NUM = 8
+RECIRCULATION_COUNT = 2
+
+INGRESS_LOOKUP_TABLE = "ingress_lookup_table"
+EGRESS_LOOKUP_TABLE = "egress_lookup_table"
+
+# verdicts of the pipeline for a packet
+FORWARD = 0     # on to its destination
+RETURN = 1      # back to its sender (ret_pkt_to_sender)
+DROP = 2
+
+
+# software model of the netcache pipeline of p4/core (MyIngress and MyEgress)
+# at the level of the udp payload: the lookup tables, the cache status
+# registers, the 16 value tables and the assembly of value and value2 over
+# the recirculations of a read query; the tables and registers are managed
+# through the subset of the SimpleSwitchThriftAPI interface used by the
+# controller, and packets cloned to the controller are handed to clone_handler
+class NetCacheSwitch(object):
+
+    def __init__(self, thrift_port=9090, entries=NETCACHE_ENTRIES, clone_handler=None):
+        self.thrift_port = thrift_port
+        self.entries = entries
+        self.clone_handler = clone_handler
+
+        # vt0..vt15 as rows of big-endian 64 bit slots, so that the slots read
+        # by a pass of a read query are a single slice in the order the value
+        # is assembled (vt0[idx], vt0[idx + 1], vt1[idx], ...)
+        self.vtables = np.zeros((NETCACHE_VTABLE_NUM, entries), dtype='>i8')
+        self.registers = {
+            'ingress_cache_status': np.zeros(entries * INGRESS_VTABLE_NUM, dtype=np.uint8),
+            'egress_cache_status': np.zeros(entries * INGRESS_VTABLE_NUM, dtype=np.uint8),
+            'cache_hits': np.zeros(entries * INGRESS_VTABLE_NUM, dtype=np.uint32),
+        }
+        # table -> {match key: (handle, action, params)}
+        self.tables = {}
+        self.handles = {}
+        self.next_handle = 0
+        self.mirror_sessions = {}
+        self.lock = threading.Lock()
+
+        self.stats = {'packets': 0, 'hits': 0, 'misses': 0, 'invalid': 0, 'clones': 0, 'recirculations': 0}
+
+    # thrift interface (see p4utils SimpleSwitchThriftAPI)
+
+    def register(self, register_name):
+        if register_name.startswith('vt'):
+            return self.vtables[int(register_name[2:])]
+        return self.registers[register_name]
+
+    # index is a cell or a [start, end] range (end included)
+    def register_write(self, register_name, index, value):
+        with self.lock:
+            register = self.register(register_name)
+            if isinstance(index, list):
+                start, end = index
+                register[start:end + 1] = value
+            else:
+                register[index] = value
+
+    def register_read(self, register_name, index=None):
+        with self.lock:
+            register = self.register(register_name)
+            return register.tolist() if index is None else int(register[index])
+
+    def register_reset(self, register_name):
+        with self.lock:
+            self.register(register_name)[:] = 0
+
+    def table_add(self, table_name, action_name, match_keys, action_params=[], prio=0):
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 1
+            match = tuple(int(m) if m.isdigit() else m for m in match_keys)
+            self.tables.setdefault(table_name, {})[match] = (handle, action_name, [int(p) for p in action_params])
+            self.handles[(table_name, handle)] = match
+            return handle
+
+    def table_delete(self, table_name, entry_handle, quiet=False):
+        with self.lock:
+            match = self.handles.pop((table_name, entry_handle), None)
+            if match is not None:
+                del self.tables[table_name][match]
+
+    def table_delete_match(self, table_name, match_keys):
+        with self.lock:
+            match = tuple(int(m) if m.isdigit() else m for m in match_keys)
+            entry = self.tables.get(table_name, {}).pop(match, None)
+            if entry is not None:
+                del self.handles[(table_name, entry[0])]
+
+    def table_clear(self, table_name):
+        with self.lock:
+            for match, (handle, _, _) in self.tables.get(table_name, {}).items():
+                del self.handles[(table_name, handle)]
+            self.tables[table_name] = {}
+
+    def get_handle_from_match(self, table_name, match_keys):
+        with self.lock:
+            match = tuple(int(m) if m.isdigit() else m for m in match_keys)
+            entry = self.tables.get(table_name, {}).get(match)
+            return None if entry is None else entry[0]
+
+    def mirroring_add(self, mirror_id, egress_port):
+        self.mirror_sessions[mirror_id] = egress_port
+
+    # pipeline
+
+    def lookup(self, table_name, key):
+        entry = self.tables.get(table_name, {}).get((key, ))
+        return None if entry is None else entry[2]
+
+    # bits of the bitmap enable the value tables (vtable_i matches bit 7 - i%8
+    # of the bitmap, with an entry installed by set_value_tables)
+    def vtables_enabled(self, bitmap, first):
+        enabled = []
+        for i in range(first, first + INGRESS_VTABLE_NUM):
+            bit = (bitmap >> (7 - i % INGRESS_VTABLE_NUM)) & 1
+            if (bit, ) in self.tables.get("vtable_" + str(i), {}):
+                enabled.append(i)
+        return enabled
+
+    # slots of the enabled value tables at vt_idx and vt_idx + 1
+    def read_slots(self, tables, vt_idx):
+        if len(tables) == INGRESS_VTABLE_NUM and tables[-1] - tables[0] == INGRESS_VTABLE_NUM - 1:
+            return self.vtables[tables[0]:tables[-1] + 1, vt_idx:vt_idx + 2].tobytes()
+        return b''.join(self.vtables[i, vt_idx:vt_idx + 2].tobytes() for i in tables)
+
+    # run a netcache packet (udp payload) coming from src_port through the
+    # pipeline, returns the verdict and the (possibly rewritten) payload
+    def process(self, data, src_port):
+        self.stats['packets'] += 1
+        # payloads shorter than the netcache header fail to parse and are
+        # only forwarded
+        if len(data) < NETCACHE_HEADER_BYTES:
+            return FORWARD, data
+
+        op, seq, key = NETCACHE_HEADER.unpack_from(data)
+        key = int.from_bytes(key, 'big')
+
+        with self.lock:
+            verdict, data, clone = self.pipeline(data, op, key, src_port)
+        # clones reach the controller once the lock is released, as it handles
+        # them by writing to the tables and registers of the switch
+        if clone:
+            self.clone(data)
+        return verdict, data
+
+    # returns the verdict, the payload and whether it is cloned to the controller
+    def pipeline(self, data, op, key, src_port):
+        ingress = self.lookup(INGRESS_LOOKUP_TABLE, key)
+        if ingress is None:
+            self.stats['misses'] += 1
+            if op in (WRITE_QUERY, FLUSH_QUERY):
+                return RETURN, data, True
+            if op == READ_QUERY:
+                return FORWARD, bytes([READ_FAIL]) + bytes(data[1:]), True
+            return FORWARD, data, False
+
+        # writes the server pushes to cached keys (a system prompt populated
+        # again) are returned and cloned as on a miss, the server takes them
+        # as acks
+        if op == WRITE_QUERY and src_port == NETCACHE_PORT:
+            return RETURN, data, True
+        if op != READ_QUERY:
+            return FORWARD, data, False
+
+        egress = self.lookup(EGRESS_LOOKUP_TABLE, key)
+        fields = [bytearray(data[NETCACHE_HEADER.size:NETCACHE_HEADER.size + NETCACHE_FIELD_BYTES]),
+                bytearray(data[NETCACHE_HEADER.size + NETCACHE_FIELD_BYTES:NETCACHE_HEADER_BYTES])]
+
+        # one pass through ingress and egress per value field, each pass
+        # reads 2 slots of every value table (the recirculations of the
+        # packet carry recirc_cnt)
+        for recirc_cnt in range(0, RECIRCULATION_COUNT * 2, 2):
+            if recirc_cnt > 0:
+                self.stats['recirculations'] += 1
+            field = fields[recirc_cnt // 2]
+
+            bitmap, vt_idx, key_idx = ingress
+            if self.registers['ingress_cache_status'][key_idx] != 1:
+                # the entry is being updated, the server answers the read
+                self.stats['invalid'] += 1
+                return FORWARD, bytes([READ_FAIL]) + bytes(data[1:]), False
+            if src_port != NETCACHE_PORT:
+                if recirc_cnt == 0:
+                    self.registers['cache_hits'][key_idx] += 1
+                slots = self.read_slots(self.vtables_enabled(bitmap, 0), vt_idx + recirc_cnt)
+                field[:] = (field + slots)[len(slots):]
+
+            if egress is None:
+                # the packet leaves through the recirculation port
+                return DROP, data, False
+            bitmap, vt_idx, key_idx = egress
+            if self.registers['egress_cache_status'][key_idx] == 1:
+                slots = self.read_slots(self.vtables_enabled(bitmap, INGRESS_VTABLE_NUM), vt_idx + recirc_cnt)
+                field[:] = (field + slots)[len(slots):]
+
+        self.stats['hits'] += 1
+        data = bytes(data[:NETCACHE_HEADER.size]) + bytes(fields[0]) + bytes(fields[1]) + bytes(data[NETCACHE_HEADER_BYTES:])
+        return RETURN, data, False
+
+    def clone(self, data):
+        self.stats['clones'] += 1
+        if self.clone_handler is not None:
+            self.clone_handler(bytes(data))
+
+
+# udp front end of the model that stands between the clients and a server on
+# loopback: clients send to the listening address and every client gets its
+# own upstream socket towards the server, so that the server sees each client
+# as a different address and its replies can be mapped back to the client;
+# returned packets go back out of the socket they came in from
+class SoftSwitchProxy(object):
+
+    def __init__(self, switch, listen, server, rcvbuf=8 * 1024 * 1024):
+        self.switch = switch
+        self.server = server
+        self.rcvbuf = rcvbuf
+
+        self.front = self.udp_socket(listen)
+        self.upstream = {}
+        self.clients = {}
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.front, selectors.EVENT_READ, None)
+
+    def udp_socket(self, addr):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        sock.bind(addr)
+        sock.setblocking(False)
+        return sock
+
+    def upstream_socket(self, client):
+        sock = self.upstream.get(client)
+        if sock is None:
+            sock = self.upstream[client] = self.udp_socket((self.front.getsockname()[0], 0))
+            self.clients[sock] = client
+            self.selector.register(sock, selectors.EVENT_READ, client)
+        return sock
+
+    def from_client(self, data, client):
+        upstream = self.upstream_socket(client)
+        verdict, data = self.switch.process(data, client[1])
+        if verdict == FORWARD:
+            upstream.sendto(data, self.server)
+        elif verdict == RETURN:
+            self.front.sendto(data, client)
+
+    def from_server(self, data, upstream, client):
+        verdict, data = self.switch.process(data, NETCACHE_PORT)
+        if verdict == FORWARD:
+            self.front.sendto(data, client)
+        elif verdict == RETURN:
+            upstream.sendto(data, self.server)
+
+    def serve_forever(self):
+        while True:
+            for key, _ in self.selector.select():
+                sock = key.fileobj
+                while True:
+                    try:
+                        data, addr = sock.recvfrom(2048)
+                    except BlockingIOError:
+                        break
+                    if sock is self.front:
+                        self.from_client(data, addr)
+                    else:
+                        self.from_server(data, sock, key.data)
+
+
+def parse_addr(addr):
+    host, port = addr.rsplit(':', 1)
+    return host, int(port)
+
+
+def main(listen, server, with_controller, stats_interval):
+    switch = NetCacheSwitch()
+
+    if with_controller:
+        # the controller needs p4utils and scapy, the model itself does not
+        from controller import NCacheController
+        controller = NCacheController('s1', thrift_apis=[switch])
+        switch.clone_handler = controller.recv_netcache
+        controller.set_value_tables()
+        # write-through of the values written to the server
+        controller.start_coherence()
+        # the stats socket of the controller reports the switch as well
+        controller.instruments.add_source('switch', lambda: dict(switch.stats))
+        controller.start_stats()
+    else:
+        for i in range(NETCACHE_VTABLE_NUM):
+            switch.table_add("vtable_" + str(i), "process_array_" + str(i), ['1'], [])
+
+    proxy = SoftSwitchProxy(switch, parse_addr(listen), parse_addr(server))
+    proxy_t = threading.Thread(target=proxy.serve_forever, daemon=True)
+    proxy_t.start()
+
+    print(f"Software switch listening on {listen}, forwarding to {server}")
+    last = dict(switch.stats)
+    while True:
+        time.sleep(stats_interval)
+        stats = dict(switch.stats)
+        rate = (stats['packets'] - last['packets']) / stats_interval
+        print(f"{rate:.0f} packets/sec, {stats}")
+        last = stats
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--listen', type=str, required=False, default='127.0.0.1:50000', help='address the clients send to')
+    parser.add_argument('--server', type=str, required=False, default='127.0.0.2:50000', help='address of the kv server')
+    parser.add_argument('--no-controller', help='do not run the controller (nothing gets cached)', action='store_true')
+    parser.add_argument('--stats-interval', type=float, required=False, default=10.0)
+    args = parser.parse_args()
+
+    main(args.listen, args.server, not args.no_controller, args.stats_interval)
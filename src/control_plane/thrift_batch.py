@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from array import array
+
+import threading
+import time
+
+
+# stages of the writes queued for a cache insertion: the value tables have to
+# be written before the lookup table entries (and validity bits) that make
+# the switch serve them are committed
+STAGE_VALUES = 0
+STAGE_COMMIT = 1
+
+
+# batching layer over one or more thrift connections to the switch (objects
+# with the register_write/table_add interface of SimpleSwitchThriftAPI):
+# writes are queued and, on flush, register writes are coalesced (the last
+# write of a register cell wins, writes of the value a cell already holds are
+# dropped and runs of consecutive cells set to the same value become a single
+# range write) and issued over all the connections in parallel, one stage
+# after the other; the calls of each kind are timed when instruments (see
+# instrumentation.py) are given
+class BatchedThriftWriter(object):
+
+    def __init__(self, apis, max_ops=4096, register_size=65536, instruments=None):
+        if not isinstance(apis, (list, tuple)):
+            apis = [apis]
+        self.apis = list(apis)
+        # flush on its own once this many writes are queued
+        self.max_ops = max_ops
+
+        # stage -> {(register, index): value}
+        self.registers = {STAGE_VALUES: {}, STAGE_COMMIT: {}}
+        # stage -> [(table, action, match, params)], action None for a delete
+        self.tables = {STAGE_VALUES: [], STAGE_COMMIT: []}
+        self.queued = 0
+        # last value of each register cell (see shadow_of), one array of
+        # signed 64 bit values per register
+        self.register_size = register_size
+        self.shadow = {}
+        self.lock = threading.RLock()
+
+        self.executor = ThreadPoolExecutor(max_workers=len(self.apis)) if len(self.apis) > 1 else None
+
+        self.rpcs = 0
+        self.writes = 0
+        self.instruments = instruments
+
+    def register_write(self, register_name, index, value, stage=STAGE_VALUES):
+        with self.lock:
+            self.registers[stage][(register_name, index)] = value
+            self.writes += 1
+            self.queued += 1
+            if self.queued >= self.max_ops:
+                self.flush()
+
+    def table_add(self, table_name, action_name, match_keys, action_params=[], stage=STAGE_COMMIT):
+        with self.lock:
+            self.tables[stage].append((table_name, action_name, match_keys, action_params))
+            self.writes += 1
+            self.queued += 1
+
+    # entries are deleted by match (table_delete_match), their handles are
+    # not known when the table_add is queued
+    def table_delete(self, table_name, match_keys, stage=STAGE_COMMIT):
+        with self.lock:
+            self.tables[stage].append((table_name, None, match_keys, None))
+            self.writes += 1
+            self.queued += 1
+
+    # reads and resets go to the switch right away, over the first connection
+    # (which is not in use while the writer lock is held)
+    def register_read(self, register_name, index=None):
+        with self.lock:
+            return self.apis[0].register_read(register_name, index)
+
+    def register_reset(self, register_name):
+        with self.lock:
+            self.apis[0].register_reset(register_name)
+            self.shadow[register_name] = array('q', bytes(8 * self.register_size))
+
+    def table_clear(self, table_name):
+        with self.lock:
+            self.apis[0].table_clear(table_name)
+
+    # forget the values written to a register (e.g. after writes done outside
+    # of this writer), they are read from the switch again on the next write
+    def invalidate(self, register_name):
+        with self.lock:
+            self.shadow.pop(register_name, None)
+
+    # the shadow of a register is read from the switch on its first write: a
+    # controller restarted against a running switch must not take the cells
+    # for zeroed, or the writes clearing the stale ones (e.g. valid bits)
+    # would be dropped
+    def shadow_of(self, register_name):
+        shadow = self.shadow.get(register_name)
+        if shadow is None:
+            values = self.apis[0].register_read(register_name)
+            # the switch returns the cells as unsigned values
+            shadow = self.shadow[register_name] = array('q', (value - (1 << 64) if value >= (1 << 63) else value
+                    for value in values[:self.register_size]))
+        return shadow
+
+    # merge the queued register writes of a stage into (register, start, end,
+    # value) calls, end included as in bm_register_write_range (the shadows
+    # are only updated once the switch has taken the calls, see applied)
+    def coalesce(self, writes):
+        calls = []
+        for (name, index), value in sorted(writes.items()):
+            shadow = self.shadow_of(name)
+            if index < len(shadow) and shadow[index] == value:
+                continue
+
+            if calls:
+                last_name, start, end, last_value = calls[-1]
+                if last_name == name and end + 1 == index and last_value == value:
+                    calls[-1] = (name, start, index, value)
+                    continue
+            calls.append((name, index, index, value))
+        return calls
+
+    # record the values of the register calls the switch has taken
+    def applied(self, calls):
+        for name, start, end, value in calls:
+            shadow = self.shadow.get(name)
+            if shadow is None:
+                continue
+            for index in range(start, min(end + 1, len(shadow))):
+                shadow[index] = value
+
+    def issue(self, api, calls):
+        instruments = self.instruments
+        for call in calls:
+            issued = time.perf_counter_ns()
+            if call[0] == 'register':
+                _, name, start, end, value = call
+                if start == end:
+                    api.register_write(name, start, value)
+                else:
+                    api.register_write(name, [start, end], value)
+                kind = 'thrift_register_write'
+            else:
+                _, table, action, match, params = call
+                if action is None:
+                    api.table_delete_match(table, match)
+                    kind = 'thrift_table_delete'
+                else:
+                    api.table_add(table, action, match, params)
+                    kind = 'thrift_table_add'
+            if instruments is not None:
+                instruments.add(kind, time.perf_counter_ns() - issued)
+
+    # issue the calls over all the connections, returns (or raises the error of
+    # a failed call) once all of them are done
+    def run(self, calls):
+        if not calls:
+            return
+        self.rpcs += len(calls)
+        if self.executor is None:
+            self.issue(self.apis[0], calls)
+            return
+
+        n = len(self.apis)
+        futures = [self.executor.submit(self.issue, api, calls[i::n]) for i, api in enumerate(self.apis)]
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    # send every queued write to the switch; when a call fails, any of the
+    # calls of its stage may or may not have reached the switch, so the
+    # shadows of their registers are read from the switch again on the next
+    # write, and the writes of the later stages (which would commit values
+    # that may not have been written) are dropped with the error
+    def flush(self):
+        with self.lock:
+            for stage in (STAGE_VALUES, STAGE_COMMIT):
+                register_calls = self.coalesce(self.registers[stage])
+                calls = [('register', ) + call for call in register_calls]
+                calls += [('table', ) + entry for entry in self.tables[stage]]
+                self.registers[stage] = {}
+                self.tables[stage] = []
+                try:
+                    self.run(calls)
+                except Exception:
+                    for name in set(call[0] for call in register_calls):
+                        self.shadow.pop(name, None)
+                    self.registers = {STAGE_VALUES: {}, STAGE_COMMIT: {}}
+                    self.tables = {STAGE_VALUES: [], STAGE_COMMIT: []}
+                    self.queued = 0
+                    raise
+                self.applied(register_calls)
+            self.queued = 0
+
+    def pending(self):
+        return self.queued
+
+    def stats(self):
+        return {'writes': self.writes, 'rpcs': self.rpcs}
+
+    def close(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,204 @@
+import asyncio
+import socket
+import time
+
+from client_api import (NETCACHE_PORT, NOCACHE_PORT, NETCACHE_READ_QUERY, NETCACHE_INIT_QUERY, NETCACHE_REQUEST_SUCCESS,
+        NETCACHE_KEY_NOT_FOUND, SYSTEM_PROMPT, build_message, parse_init_reply)
+from codec import NETCACHE_HEADER, NETCACHE_HEADER_SIZE, kv_packet_keys
+
+# a few thousand responses of a full netcache header can be queued at once
+RECV_BUFFER_SIZE = 8 * 1024 * 1024
+# seconds the server may take to push a system prompt to the switch
+INIT_TIMEOUT = 60.0
+
+
+# bookkeeping of a single read (all times are seconds since the epoch)
+class ReadRequest:
+
+    __slots__ = ('key', 'seq', 'send_time', 'last_send_time', 'recv_time', 'attempts', 'op')
+
+    def __init__(self, key, seq):
+        self.key = key
+        self.seq = seq
+        self.send_time = 0.0
+        self.last_send_time = 0.0
+        self.recv_time = 0.0
+        self.attempts = 0
+        self.op = None
+
+    def latency(self):
+        if self.recv_time == 0.0:
+            return None
+        return self.recv_time - self.send_time
+
+
+class NetCacheProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.response_received(data)
+
+    def error_received(self, exc):
+        # icmp errors (e.g. port unreachable) surface here, the affected
+        # requests are retried when their timeout expires
+        pass
+
+
+# asynchronous version of NetCacheClient that keeps many reads in flight over
+# a single udp socket; responses (either answered by the switch or by the
+# server after a cache miss) are matched to their requests by the seq field
+class AsyncNetCacheClient:
+
+    def __init__(self, server='10.0.0.1', no_cache=False, timeout=1.0, retries=3,
+            max_in_flight=4096, interface=None):
+        if no_cache:
+            self.port = NOCACHE_PORT
+        else:
+            self.port = NETCACHE_PORT
+
+        self.server = server
+        self.timeout = timeout
+        self.retries = retries
+        self.interface = interface
+
+        self.transport = None
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.next_seq = 0
+        # seq -> (future, request) of the reads waiting for a response
+        self.pending = {}
+        # seq -> future of the init queries waiting for the server
+        self.init_pending = {}
+
+        # every read issued (used for evaluation)
+        self.requests = []
+        self.latencies = []
+        self.successful_reads = 0
+        self.failed_reads = 0
+
+    async def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.interface is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.interface.encode())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        sock.bind(('0.0.0.0', 0))
+
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: NetCacheProtocol(self), sock=sock)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def response_received(self, data):
+        if len(data) < NETCACHE_HEADER_SIZE:
+            return
+
+        op, seq, _ = NETCACHE_HEADER.unpack_from(data)
+        init = self.init_pending.get(seq)
+        if init is not None:
+            # the write packets of the population carry the seq of the query
+            # as well, only the reply of the server completes it
+            if op in (NETCACHE_REQUEST_SUCCESS, NETCACHE_KEY_NOT_FOUND) and not init.done():
+                init.set_result(data)
+            return
+
+        entry = self.pending.pop(seq, None)
+        if entry is None:
+            # late response of a request that has been retried or given up on
+            return
+
+        future, request = entry
+        request.recv_time = time.time()
+        request.op = op
+        if not future.done():
+            future.set_result(data)
+
+    def allocate_seq(self):
+        seq = self.next_seq
+        self.next_seq = (self.next_seq + 1) & 0xffffffff
+        return seq
+
+    # ask the server to push the kv cache of prompt to the switch, returns the
+    # tag of its keys and its length in tokens (see read_kv_cache)
+    async def send_system_prompt(self, prompt=SYSTEM_PROMPT, timeout=INIT_TIMEOUT):
+        seq = self.allocate_seq()
+        msg = build_message(NETCACHE_INIT_QUERY, 'init', seq, prompt)
+        if msg is None:
+            raise ValueError("System prompt does not fit in the value of a query")
+
+        future = asyncio.get_running_loop().create_future()
+        self.init_pending[seq] = future
+        try:
+            self.transport.sendto(msg, (self.server, self.port))
+            data = await asyncio.wait_for(future, timeout)
+        finally:
+            del self.init_pending[seq]
+        return parse_init_reply(data)
+
+    # read the value of key, returns the netcache payload (value and value2) or
+    # None if the key does not exist or no response arrived after all retries
+    async def read(self, key):
+        seq = self.allocate_seq()
+        msg = build_message(NETCACHE_READ_QUERY, key, seq)
+        if msg is None:
+            return None
+
+        request = ReadRequest(key, seq)
+        self.requests.append(request)
+
+        async with self.in_flight:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[seq] = (future, request)
+
+            data = None
+            for _ in range(self.retries + 1):
+                request.last_send_time = time.time()
+                if request.attempts == 0:
+                    request.send_time = request.last_send_time
+                request.attempts += 1
+                self.transport.sendto(msg, (self.server, self.port))
+
+                try:
+                    data = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                    break
+                except asyncio.TimeoutError:
+                    continue
+
+            self.pending.pop(seq, None)
+
+        if data is None or request.op == NETCACHE_KEY_NOT_FOUND:
+            self.failed_reads += 1
+            return None
+
+        self.successful_reads += 1
+        self.latencies.append(request.latency())
+        return data[NETCACHE_HEADER_SIZE:]
+
+    # issue all the reads concurrently, returns the payloads in key order
+    async def read_many(self, keys):
+        return await asyncio.gather(*(self.read(key) for key in keys))
+
+    # fetch every packet of the system prompt kv cache concurrently, returns
+    # a dictionary with the payload of each packet key
+    async def read_kv_cache(self, n_layers=12, n_heads=12, prompt_len=9, pack=1, tag=''):
+        keys = list(kv_packet_keys(n_layers, n_heads, prompt_len, pack, tag))
+        return dict(zip(keys, await self.read_many(keys)))
+
+    def latency_report(self, percentiles=(50, 90, 99, 99.9)):
+        latencies = sorted(self.latencies)
+        report = {
+            'requests': len(self.requests),
+            'successful': self.successful_reads,
+            'failed': self.failed_reads,
+            'retried': sum(1 for r in self.requests if r.attempts > 1),
+        }
+        if latencies:
+            report['mean'] = sum(latencies) / len(latencies)
+            report['max'] = latencies[-1]
+            for p in percentiles:
+                idx = min(len(latencies) - 1, int(len(latencies) * p / 100))
+                report['p' + str(p)] = latencies[idx]
+        return report
@@ -0,0 +1,222 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+
+
+MSG_WAITFORONE = 0x10000
+BATCH_SIZE = 64
+BUFFER_SIZE = 2048
+
+
+# structures of <sys/socket.h> needed to call recvmmsg/sendmmsg through ctypes
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+            ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+            ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+            ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+# port and address are kept as raw bytes since they are in network byte order
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint8 * 2),
+            ('sin_addr', ctypes.c_uint8 * 4), ('sin_zero', ctypes.c_uint8 * 8)]
+
+
+def load_mmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None, None
+
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+# batched syscalls are only available on linux, elsewhere (or when disabled)
+# we fall back to one syscall per datagram over the same preallocated buffers
+recvmmsg, sendmmsg = load_mmsg()
+
+
+def mmsg_supported(sock):
+    return recvmmsg is not None and sock.family == socket.AF_INET
+
+
+def raise_errno():
+    err = ctypes.get_errno()
+    if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise BlockingIOError(err, os.strerror(err))
+    raise OSError(err, os.strerror(err))
+
+
+def to_sockaddr(addr, sa=None):
+    if sa is None:
+        sa = sockaddr_in()
+    try:
+        packed_ip = socket.inet_aton(addr[0])
+    except OSError:
+        packed_ip = socket.inet_aton(socket.gethostbyname(addr[0]))
+    sa.sin_family = socket.AF_INET
+    sa.sin_port[:] = addr[1].to_bytes(2, 'big')
+    sa.sin_addr[:] = packed_ip
+    return sa
+
+
+def from_sockaddr(sa):
+    return socket.inet_ntoa(bytes(sa.sin_addr)), int.from_bytes(bytes(sa.sin_port), 'big')
+
+
+# receives up to batch datagrams per call into a ring of preallocated buffers;
+# the returned payloads are memoryviews into the ring, so they are only valid
+# until the next call of recv_batch (copy them if they need to outlive it)
+class BatchReceiver:
+
+    def __init__(self, sock, batch=BATCH_SIZE, bufsize=BUFFER_SIZE, use_mmsg=True):
+        self.sock = sock
+        self.batch = batch
+        self.bufsize = bufsize
+
+        self.ring = bytearray(batch * bufsize)
+        self.view = memoryview(self.ring)
+        self.slots = [self.view[i * bufsize:(i + 1) * bufsize] for i in range(batch)]
+
+        self.msgs = None
+        if use_mmsg and mmsg_supported(sock):
+            base = ctypes.addressof((ctypes.c_char * len(self.ring)).from_buffer(self.ring))
+            self.iovs = (iovec * batch)()
+            self.names = (sockaddr_in * batch)()
+            self.msgs = (mmsghdr * batch)()
+            for i in range(batch):
+                self.iovs[i].iov_base = base + i * bufsize
+                self.iovs[i].iov_len = bufsize
+                hdr = self.msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(self.names[i])
+                hdr.msg_iov = ctypes.pointer(self.iovs[i])
+                hdr.msg_iovlen = 1
+
+    # block until at least one datagram arrives (or the socket timeout expires)
+    # and return the list of (payload, addr) of all the datagrams queued
+    def recv_batch(self):
+        if self.msgs is not None:
+            return self._recv_mmsg()
+        return self._recv_drain()
+
+    def _recv_mmsg(self):
+        timeout = self.sock.gettimeout()
+        if timeout is None:
+            flags = MSG_WAITFORONE
+        else:
+            # sockets with a timeout are non-blocking underneath, so wait for
+            # the first datagram here and then take whatever is queued
+            if not select.select([self.sock], [], [], timeout)[0]:
+                raise socket.timeout('timed out')
+            flags = socket.MSG_DONTWAIT
+
+        for i in range(self.batch):
+            self.msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+
+        while True:
+            n = recvmmsg(self.sock.fileno(), self.msgs, self.batch, flags, None)
+            if n >= 0:
+                break
+            if ctypes.get_errno() != errno.EINTR:
+                raise_errno()
+
+        return [(self.slots[i][:self.msgs[i].msg_len], from_sockaddr(self.names[i])) for i in range(n)]
+
+    def _recv_drain(self):
+        n, addr = self.sock.recvfrom_into(self.slots[0])
+        batch = [(self.slots[0][:n], addr)]
+
+        # MSG_DONTWAIT still waits for the socket timeout, so only blocking
+        # sockets are drained
+        if self.sock.gettimeout() is not None:
+            return batch
+
+        while len(batch) < self.batch:
+            try:
+                n, addr = self.sock.recvfrom_into(self.slots[len(batch)], self.bufsize, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            batch.append((self.slots[len(batch)][:n], addr))
+        return batch
+
+
+# sends a list of datagrams to the same destination with as few syscalls as
+# possible (sendmmsg sends up to batch datagrams per call)
+class BatchSender:
+
+    def __init__(self, sock, batch=BATCH_SIZE, use_mmsg=True):
+        self.sock = sock
+        self.batch = batch
+
+        self.msgs = None
+        if use_mmsg and mmsg_supported(sock):
+            self.iovs = (iovec * batch)()
+            self.name = sockaddr_in()
+            self.msgs = (mmsghdr * batch)()
+            for i in range(batch):
+                hdr = self.msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(self.name)
+                hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+                hdr.msg_iov = ctypes.pointer(self.iovs[i])
+                hdr.msg_iovlen = 1
+
+    def send_batch(self, datagrams, addr):
+        if self.msgs is None:
+            for msg in datagrams:
+                self.sock.sendto(msg, addr)
+            return
+
+        to_sockaddr(addr, self.name)
+        for start in range(0, len(datagrams), self.batch):
+            self._send_mmsg(datagrams[start:start + self.batch], addr)
+
+    def _send_mmsg(self, datagrams, addr):
+        # keep references to the buffers until the syscall returns
+        bufs = []
+        for i, msg in enumerate(datagrams):
+            if isinstance(msg, bytes):
+                buf = ctypes.c_char_p(msg)
+                self.iovs[i].iov_base = ctypes.cast(buf, ctypes.c_void_p).value
+            else:
+                if isinstance(msg, bytearray):
+                    buf = (ctypes.c_char * len(msg)).from_buffer(msg)
+                else:
+                    # read-only buffers (e.g. memoryviews of bytes) are copied
+                    buf = (ctypes.c_char * len(msg)).from_buffer_copy(msg)
+                self.iovs[i].iov_base = ctypes.addressof(buf)
+            self.iovs[i].iov_len = len(msg)
+            bufs.append(buf)
+
+        sent = 0
+        while sent < len(datagrams):
+            n = sendmmsg(self.sock.fileno(), ctypes.byref(self.msgs[sent]), len(datagrams) - sent, 0)
+            if n >= 0:
+                sent += n
+                continue
+
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                # socket buffer full, let sendto block (or time out) for the rest
+                for msg in datagrams[sent:]:
+                    self.sock.sendto(msg, addr)
+                return
+            raise_errno()
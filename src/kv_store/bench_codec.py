@@ -0,0 +1,110 @@
+import struct
+import time
+
+import torch
+
+from codec import build_kv_cache_messages, decode_vector, build_write_message, kv_key
+
+NETCACHE_WRITE_QUERY = 1
+
+
+# per-float implementation that the codec replaced (kept here as the
+# reference point of the benchmark)
+def legacy_build_write_message(op, key, value, seq=0):
+    msg = bytearray()
+    msg += op.to_bytes(1, 'big')
+    msg += seq.to_bytes(4, 'big')
+    msg += int.from_bytes(bytes(key, "utf-8"), "big").to_bytes(16, 'big')
+    for i in range(64):
+        msg += struct.pack('>f', value[i])
+    return msg
+
+
+def legacy_unpack_message_to_tensor(value):
+    values = []
+    for i in range(64):
+        values.append(struct.unpack('>f', value[i*4:(i+1)*4])[0])
+    return torch.tensor(values, dtype=torch.float32)
+
+
+def legacy_encode(kv_cache, prompt_len):
+    msgs = []
+    for i in range(len(kv_cache)):
+        for j in range(2):
+            for k in range(kv_cache[0][0].shape[1]):
+                for p in range(prompt_len):
+                    msgs.append(legacy_build_write_message(NETCACHE_WRITE_QUERY,
+                            kv_key(i, j, k, p), kv_cache[i][j][0][k][p]))
+    return msgs
+
+
+def vector_encode(kv_cache, prompt_len):
+    msgs = []
+    for i in range(len(kv_cache)):
+        for j in range(2):
+            for k in range(kv_cache[0][0].shape[1]):
+                for p in range(prompt_len):
+                    msgs.append(build_write_message(NETCACHE_WRITE_QUERY,
+                            kv_key(i, j, k, p), kv_cache[i][j][0][k][p]))
+    return msgs
+
+
+def cache_encode(kv_cache, prompt_len):
+    return list(build_kv_cache_messages(NETCACHE_WRITE_QUERY, kv_cache, prompt_len))
+
+
+def legacy_decode(msgs):
+    for msg in msgs:
+        legacy_unpack_message_to_tensor(msg[21:])
+
+
+def vector_decode(msgs):
+    for msg in msgs:
+        decode_vector(memoryview(msg)[21:])
+
+
+def inplace_decode(msgs):
+    out = torch.empty(64, dtype=torch.float32)
+    for msg in msgs:
+        decode_vector(memoryview(msg)[21:], out=out)
+
+
+def measure(fn, n_vectors, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return n_vectors / best
+
+
+def main(cache, prompt_len, repeat):
+    kv_cache = torch.load(cache)
+    msgs = cache_encode(kv_cache, prompt_len)
+    n_vectors = len(msgs)
+
+    results = [
+        ('encode (struct loop)', lambda: legacy_encode(kv_cache, prompt_len)),
+        ('encode (per vector)', lambda: vector_encode(kv_cache, prompt_len)),
+        ('encode (whole cache)', lambda: cache_encode(kv_cache, prompt_len)),
+        ('decode (struct loop)', lambda: legacy_decode(msgs)),
+        ('decode (numpy view)', lambda: vector_decode(msgs)),
+        ('decode (in place)', lambda: inplace_decode(msgs)),
+    ]
+
+    print(f"{n_vectors} vectors per system prompt, best of {repeat} runs")
+    for name, fn in results:
+        print(f"{name:<24} {measure(fn, n_vectors, repeat):>14.0f} vectors/sec")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cache', type=str, required=False, default='../p4/kv_cache.pt', help='Path to the kv_cache file')
+    parser.add_argument('--prompt-len', type=int, required=False, default=9)
+    parser.add_argument('--repeat', type=int, required=False, default=5)
+    args = parser.parse_args()
+
+    main(args.cache, args.prompt_len, args.repeat)
@@ -0,0 +1,408 @@
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import torch
+import transformers
+
+import server
+from async_client import AsyncNetCacheClient
+from client_api import (NETCACHE_PORT, NETCACHE_INIT_QUERY, NETCACHE_FLUSH_QUERY, NETCACHE_REQUEST_SUCCESS,
+        NETCACHE_KEY_NOT_FOUND, build_message, parse_init_reply)
+from codec import KV_QUANT_MODES, kv_packet_keys, kv_vector_size, max_vectors_per_packet
+from instrumentation import read_stats
+from kv_buffer import KVCacheBuffer
+from server import KVServer, SYSTEM_PROMPT, INPUT_PROMPT
+
+# loopback testbed: the clients send to the software switch (soft_switch.py,
+# with the controller), which stands in front of the server
+SWITCH_HOST = '127.0.0.1'
+SERVER_HOST = '127.0.0.2'
+KV_STORE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTROL_PLANE_DIR = os.path.join(KV_STORE_DIR, '..', 'control_plane')
+SERVER_STATS = '/tmp/bench_server_stats.s'
+CONTROLLER_STATS = '/tmp/controller_stats.s'
+
+# shape of the gpt2 kv cache
+N_LAYERS = 12
+N_HEADS = 12
+
+# keys the switch holds at once (every key takes 4 value table slots)
+SWITCH_KEYS = 65536 // 4
+
+STARTUP_TIMEOUT = 120.0
+POPULATE_TIMEOUT = 60.0
+POLL_INTERVAL = 0.05
+
+# numbers of a run that are summarized (median over the repetitions) and
+# compared against an earlier report
+SUMMARY_FIELDS = ['population_s', 'population_lost', 'cached_s', 'fetch_s', 'fetch_max_s', 'read_p99_s',
+        'reassembly_s', 'model_s', 'ttft_s', 'baseline_s', 'speedup', 'failed_reads']
+REGRESSION_FIELDS = ['population_s', 'fetch_s', 'ttft_s']
+
+
+# system prompt of about n_tokens tokens (the server reports the actual
+# length, re-tokenizing decoded text may merge a token or two)
+def prompt_of_length(tokenizer, n_tokens):
+    text = ' '.join([SYSTEM_PROMPT] * (n_tokens // 4 + 2))
+    return tokenizer.decode(tokenizer(text, add_special_tokens=True).input_ids[:n_tokens])
+
+
+# snapshot of the instruments of a process, None until it serves them
+def try_read_stats(path):
+    try:
+        return read_stats(path)
+    except (OSError, ValueError):
+        return None
+
+
+def wait_for_stats(path, proc, timeout=STARTUP_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{proc.args[1]} exited with status {proc.returncode}")
+        stats = try_read_stats(path)
+        if stats is not None:
+            return stats
+        time.sleep(POLL_INTERVAL)
+    raise RuntimeError(f"{proc.args[1]} did not start within {timeout:.0f} seconds")
+
+
+# the software switch with the controller and one kv server at a time (the
+# server is restarted for every packing and quantization mode, which are
+# fixed when it starts), their output goes to log_dir
+class Testbed:
+
+    def __init__(self, model, cache, init_rate, init_window, log_dir):
+        self.model = model
+        self.cache = os.path.abspath(cache)
+        self.init_rate = init_rate
+        self.init_window = init_window
+        self.log_dir = log_dir
+        self.switch = None
+        self.server = None
+        self.seq = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(POPULATE_TIMEOUT)
+
+    def spawn(self, args, cwd, log_name):
+        log = open(os.path.join(self.log_dir, log_name), 'a')
+        return subprocess.Popen([sys.executable] + args, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+
+    def start_switch(self):
+        self.switch = self.spawn(['soft_switch.py', '--listen', f"{SWITCH_HOST}:{NETCACHE_PORT}",
+                '--server', f"{SERVER_HOST}:{NETCACHE_PORT}", '--stats-interval', '3600'],
+                CONTROL_PLANE_DIR, 'soft_switch.log')
+        wait_for_stats(CONTROLLER_STATS, self.switch)
+
+    def start_server(self, quant, pack):
+        self.stop_server()
+        # the server logs to log/ of its working directory
+        os.makedirs(os.path.join(KV_STORE_DIR, 'log'), exist_ok=True)
+        self.server = self.spawn(['server.py', '--bind', SERVER_HOST, '--cache', self.cache, '--model', self.model,
+                '--quant', quant, '--pack', str(pack), '--init-rate', str(self.init_rate),
+                '--init-window', str(self.init_window), '--suppress-output', '--stats-socket', SERVER_STATS],
+                KV_STORE_DIR, 'server.log')
+        wait_for_stats(SERVER_STATS, self.server)
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+            self.server = None
+
+    def close(self):
+        self.stop_server()
+        if self.switch is not None:
+            self.switch.terminate()
+            self.switch.wait()
+        self.sock.close()
+
+    # send a query and wait for its reply (packets of the same seq with
+    # other ops, e.g. population writes retransmitted once their key was
+    # cached and forwarded by the switch, are skipped)
+    def request(self, op, key, value='', reply_ops=None):
+        self.seq += 1
+        self.sock.sendto(build_message(op, key, self.seq, value), (SWITCH_HOST, NETCACHE_PORT))
+        while True:
+            data = self.sock.recv(2048)
+            if int.from_bytes(data[1:5], 'big') == self.seq and (reply_ops is None or data[0] in reply_ops):
+                return data
+
+    # empty the switch (the flush is returned once the controller is done)
+    def flush(self):
+        self.request(NETCACHE_FLUSH_QUERY, 'flush', reply_ops=(NETCACHE_FLUSH_QUERY, ))
+
+    # have the server push the kv cache of prompt to the switch, returns the
+    # tag of its keys and its length once the server is done
+    def populate(self, prompt):
+        return parse_init_reply(self.request(NETCACHE_INIT_QUERY, 'init', prompt,
+                (NETCACHE_REQUEST_SUCCESS, NETCACHE_KEY_NOT_FOUND)))
+
+    def controller_stats(self):
+        return read_stats(CONTROLLER_STATS)
+
+    def server_counters(self):
+        return read_stats(SERVER_STATS)['counters']
+
+    # wait until the controller inserted n keys since the counters of start
+    def wait_inserted(self, start, n, timeout=POPULATE_TIMEOUT):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.controller_stats()['counters'].get('inserted', 0) - start >= n:
+                return True
+            time.sleep(POLL_INTERVAL)
+        return False
+
+
+# every client reads all the keys at once, returns the fetch time, payloads
+# and latency report of each client
+async def fetch(keys, concurrency, timeout, retries, in_flight):
+    clients = [AsyncNetCacheClient(server=SWITCH_HOST, timeout=timeout, retries=retries, max_in_flight=in_flight)
+            for _ in range(concurrency)]
+    for client in clients:
+        await client.connect()
+
+    async def fetch_one(client):
+        start = time.perf_counter()
+        payloads = await client.read_many(keys)
+        return time.perf_counter() - start, dict(zip(keys, payloads))
+
+    results = await asyncio.gather(*(fetch_one(client) for client in clients))
+    reports = [client.latency_report() for client in clients]
+    for client in clients:
+        client.close()
+    return [(elapsed, payloads, report) for (elapsed, payloads), report in zip(results, reports)]
+
+
+# one run of the pipeline: populate the switch with the kv cache of prompt,
+# fetch it with concurrency clients, reassemble the kv cache of the first
+# client and run inference over it, against the baseline inference of the
+# same probe without a kv cache
+def run_once(testbed, kv_server, prompt, probe, quant, pack, concurrency, timeout, retries, in_flight):
+    testbed.flush()
+    switch_before = testbed.controller_stats()
+    inserted = switch_before['counters'].get('inserted', 0)
+    server_before = testbed.server_counters()
+
+    start = time.perf_counter()
+    tag, prompt_len = testbed.populate(prompt)
+    population = time.perf_counter() - start
+    server_after = testbed.server_counters()
+    keys = list(kv_packet_keys(N_LAYERS, N_HEADS, prompt_len, pack, tag))
+    if not testbed.wait_inserted(inserted, len(keys)):
+        print(f"Warning: the controller did not insert all the {len(keys)} keys")
+    cached = time.perf_counter() - start
+
+    clients = asyncio.run(fetch(keys, concurrency, timeout, retries, in_flight))
+    fetch_s, payloads, _ = clients[0]
+
+    start = time.perf_counter()
+    kv_buffer = KVCacheBuffer(N_LAYERS, N_HEADS, prompt_len, quant=quant)
+    for key, payload in payloads.items():
+        if payload is not None:
+            kv_buffer.store(key, payload)
+    complete = kv_buffer.complete()
+    cached_kv = kv_buffer.past_key_values()
+    reassembly = time.perf_counter() - start
+
+    if complete:
+        model_s, first_token = kv_server.compute_inference(prompt + probe, prompt_len, cached_kv)
+    else:
+        model_s, first_token = float('nan'), None
+    kv_buffer.close()
+    baseline_s, baseline_token = kv_server.baseline_inference(probe, prompt)
+
+    switch_after = testbed.controller_stats()
+    ttft = fetch_s + reassembly + model_s
+    return {
+        'prompt_len': prompt_len,
+        'quant': quant,
+        'pack': pack,
+        'value_bytes': pack * kv_vector_size(quant),
+        'packets': len(keys),
+        'concurrency': concurrency,
+        'population_s': population,
+        # packets of the population the switch did not return (as acks) in time
+        'population_retransmitted': server_after.get('populate_retransmitted', 0)
+                - server_before.get('populate_retransmitted', 0),
+        'population_lost': server_after.get('populate_lost', 0) - server_before.get('populate_lost', 0),
+        'cached_s': cached,
+        'fetch_s': fetch_s,
+        'fetch_max_s': max(elapsed for elapsed, _, _ in clients),
+        'read_p99_s': max(report.get('p99', 0.0) for _, _, report in clients),
+        'failed_reads': sum(report['failed'] for _, _, report in clients),
+        'retried_reads': sum(report['retried'] for _, _, report in clients),
+        'switch_hits': switch_after['switch']['hits'] - switch_before['switch']['hits'],
+        'reassembly_s': reassembly,
+        'model_s': model_s,
+        'ttft_s': ttft,
+        'baseline_s': baseline_s,
+        'speedup': baseline_s / ttft if complete else 0.0,
+        'first_token': first_token,
+        'baseline_first_token': baseline_token,
+        'tokens_match': first_token == baseline_token,
+    }
+
+
+def config_of(row):
+    return row['prompt_len'], row['quant'], row['pack'], row['concurrency']
+
+
+# median of every summary field over the repetitions of each configuration
+def summarize(rows):
+    configs = {}
+    for row in rows:
+        configs.setdefault(config_of(row), []).append(row)
+    summary = []
+    for (prompt_len, quant, pack, concurrency), runs in configs.items():
+        entry = {'prompt_len': prompt_len, 'quant': quant, 'pack': pack, 'value_bytes': runs[0]['value_bytes'],
+                'packets': runs[0]['packets'], 'concurrency': concurrency, 'repeats': len(runs),
+                'tokens_match': all(run['tokens_match'] for run in runs)}
+        for field in SUMMARY_FIELDS:
+            entry[field] = statistics.median(run[field] for run in runs)
+        summary.append(entry)
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'tokens':>6}{'quant':>6}{'pack':>5}{'bytes':>6}{'clients':>8}{'populate s':>11}{'lost':>6}{'fetch s':>9}"
+            f"{'ttft s':>9}{'baseline s':>11}{'speedup':>8}{'failed':>7}{'match':>6}")
+    for entry in summary:
+        print(f"{entry['prompt_len']:>6}{entry['quant']:>6}{entry['pack']:>5}{entry['value_bytes']:>6}"
+                f"{entry['concurrency']:>8}{entry['population_s']:>11.3f}"
+                f"{entry['population_lost']:>6.0f}{entry['fetch_s']:>9.4f}"
+                f"{entry['ttft_s']:>9.4f}{entry['baseline_s']:>11.4f}{entry['speedup']:>8.2f}"
+                f"{entry['failed_reads']:>7.0f}{'yes' if entry['tokens_match'] else 'no':>6}")
+
+
+# configurations of summary slower than in the earlier report by more than
+# tolerance (a fraction) in any of the regression fields
+def compare(summary, previous, tolerance):
+    earlier = {config_of(entry): entry for entry in previous['summary']}
+    regressions = []
+    for entry in summary:
+        old = earlier.get(config_of(entry))
+        if old is None:
+            continue
+        for field in REGRESSION_FIELDS:
+            if old[field] > 0 and entry[field] > old[field] * (1 + tolerance):
+                regressions.append((config_of(entry), field, old[field], entry[field]))
+    return regressions
+
+
+def environment(model):
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'model': model,
+    }
+
+
+def main(model, cache, prompt_lens, quants, packs, concurrency, repeats, probe, timeout, retries, in_flight,
+        init_rate, init_window, output, previous_report, tolerance):
+    parameters = {'prompt_lens': prompt_lens, 'quants': quants, 'packs': packs, 'concurrency': concurrency,
+            'repeats': repeats, 'probe': probe, 'timeout': timeout, 'retries': retries, 'in_flight': in_flight,
+            'init_rate': init_rate, 'init_window': init_window}
+    results_dir = os.path.dirname(output) or '.'
+    os.makedirs(results_dir, exist_ok=True)
+
+    kv_server = KVServer('127.0.0.1', suppress=True)
+    prompts = {n: prompt_of_length(server.tokenizer, n) for n in prompt_lens}
+
+    testbed = Testbed(model, cache, init_rate, init_window, results_dir)
+    rows = []
+    skipped = []
+    try:
+        testbed.start_switch()
+        for quant in quants:
+            for pack in packs:
+                if pack > max_vectors_per_packet(quant):
+                    skipped.append({'quant': quant, 'pack': pack, 'reason': 'more vectors than fit in a packet'})
+                    continue
+                testbed.start_server(quant, pack)
+                for n_tokens in prompt_lens:
+                    n_keys = N_LAYERS * 2 * N_HEADS * n_tokens // pack
+                    if n_keys > SWITCH_KEYS:
+                        skipped.append({'quant': quant, 'pack': pack, 'prompt_len': n_tokens,
+                                'reason': f"{n_keys} keys do not fit in the switch"})
+                        continue
+                    for clients in concurrency:
+                        for _ in range(repeats):
+                            rows.append(run_once(testbed, kv_server, prompts[n_tokens], probe, quant, pack, clients,
+                                    timeout, retries, in_flight))
+    finally:
+        testbed.close()
+        kv_server.close()
+
+    summary = summarize(rows)
+    report = {'environment': environment(model), 'parameters': parameters, 'runs': rows, 'summary': summary,
+            'skipped': skipped}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_summary(summary)
+    print(f"Report written to {output}")
+
+    if previous_report is not None:
+        with open(previous_report) as f:
+            regressions = compare(summary, json.load(f), tolerance)
+        for config, field, old, new in regressions:
+            print(f"Regression {config}: {field} {old:.4f} -> {new:.4f}")
+        return not regressions
+    return True
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--model', type=str, required=True)
+    parser.add_argument('--cache', type=str, required=False, default='../p4/kv_cache.kvc',
+            help='kv cache file the server starts with (see kv_file.py)')
+    parser.add_argument('--prompt-lens', type=int, nargs='+', required=False, default=[9, 32],
+            help='tokens of the system prompts')
+    parser.add_argument('--quants', nargs='+', choices=KV_QUANT_MODES, required=False, default=list(KV_QUANT_MODES))
+    parser.add_argument('--packs', type=int, nargs='+', required=False, default=[1, 2, 4],
+            help='kv vectors per packet (the value size is pack times the vector size of the quantization mode)')
+    parser.add_argument('--concurrency', type=int, nargs='+', required=False, default=[1, 4],
+            help='clients fetching the kv cache at once')
+    parser.add_argument('--repeats', type=int, required=False, default=3)
+    parser.add_argument('--probe', type=str, required=False, default=INPUT_PROMPT)
+    parser.add_argument('--timeout', type=float, required=False, default=0.5, help='seconds before a read is retried')
+    parser.add_argument('--retries', type=int, required=False, default=3)
+    parser.add_argument('--in-flight', type=int, required=False, default=64,
+            help='reads each client keeps in flight (the soft switch drops what its socket cannot queue)')
+    parser.add_argument('--init-rate', type=float, required=False, default=0,
+            help='packets/sec when populating the switch (0 = unlimited, the window paces it)')
+    parser.add_argument('--init-window', type=int, required=False, default=64)
+    parser.add_argument('--output', type=str, required=False, default='results/bench_e2e.json')
+    parser.add_argument('--compare', type=str, required=False, default=None,
+            help='earlier report, exits with status 1 if a configuration got slower')
+    parser.add_argument('--tolerance', type=float, required=False, default=0.2,
+            help='slowdown over the earlier report tolerated (fraction)')
+    args = parser.parse_args()
+
+    # compute_inference and baseline_inference use the model of the server module
+    server.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    server.tokenizer = transformers.AutoTokenizer.from_pretrained(args.model)
+    server.model = transformers.AutoModelForCausalLM.from_pretrained(args.model)
+    server.model.to(server.device)
+    server.model.eval()
+
+    ok = main(args.model, args.cache, args.prompt_lens, args.quants, args.packs, args.concurrency, args.repeats,
+            args.probe, args.timeout, args.retries, args.in_flight, args.init_rate, args.init_window, args.output,
+            args.compare, args.tolerance)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,122 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from client_api import NETCACHE_PORT, NETCACHE_INIT_QUERY, NETCACHE_WRITE_QUERY, SYSTEM_PROMPT, build_message
+from codec import KV_QUANT_MODES, NETCACHE_HEADER, build_kv_cache_messages
+from kv_file import load_kv_cache
+from pacing import WindowedSender
+
+# loopback testbed of bench_e2e.py: the software switch listens for the
+# clients and stands in front of the server address, which is taken here by
+# a socket that pushes the kv cache the way the server does
+SWITCH_HOST = '127.0.0.1'
+SERVER_HOST = '127.0.0.2'
+CONTROL_PLANE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'control_plane')
+
+STARTUP_TIMEOUT = 120.0
+POLL_INTERVAL = 0.5
+
+
+def start_switch(with_controller):
+    args = [sys.executable, 'soft_switch.py', '--listen', f"{SWITCH_HOST}:{NETCACHE_PORT}",
+            '--server', f"{SERVER_HOST}:{NETCACHE_PORT}", '--stats-interval', '3600']
+    if not with_controller:
+        args.append('--no-controller')
+    return subprocess.Popen(args, cwd=CONTROL_PLANE_DIR, stdout=subprocess.DEVNULL)
+
+
+# send an init query through the switch until it reaches the server socket
+# (once the switch is up), returns the address the server answers to, i.e.
+# the upstream socket of the switch for this client
+def wait_for_init(client, server_sock, switch):
+    deadline = time.time() + STARTUP_TIMEOUT
+    server_sock.settimeout(POLL_INTERVAL)
+    while time.time() < deadline:
+        if switch.poll() is not None:
+            raise RuntimeError(f"soft_switch.py exited with status {switch.returncode}")
+        client.sendto(build_message(NETCACHE_INIT_QUERY, 'init', 0, SYSTEM_PROMPT), (SWITCH_HOST, NETCACHE_PORT))
+        try:
+            data, addr = server_sock.recvfrom(2048)
+        except socket.timeout:
+            continue
+        if data[0] == NETCACHE_INIT_QUERY:
+            server_sock.settimeout(None)
+            return addr
+    raise RuntimeError(f"soft_switch.py did not start within {STARTUP_TIMEOUT:.0f} seconds")
+
+
+# the write queries the switch returns to the server are the acks of the
+# population (see KVServer.handle_client_udp_request)
+def receive_acks(sock, sender):
+    while True:
+        try:
+            data = sock.recv(2048)
+        except OSError:
+            return
+        if len(data) >= NETCACHE_HEADER.size and data[0] == NETCACHE_WRITE_QUERY:
+            sender.ack(NETCACHE_HEADER.unpack_from(data)[1])
+
+
+# push the kv cache to the switch passes times (the keys are cached by the
+# controller after the first pass, so that later passes are written to
+# cached keys as when a system prompt is populated again) and check that
+# every packet got acked
+def main(cache, pack, quant, init_rate, init_window, passes, with_controller):
+    kv_cache = load_kv_cache(cache)
+    prompt_len = kv_cache.shape[4]
+
+    switch = start_switch(with_controller)
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind((SERVER_HOST, NETCACHE_PORT))
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    ok = True
+    try:
+        addr = wait_for_init(client, server_sock, switch)
+        sender = WindowedSender(server_sock, rate=init_rate, window=init_window)
+        threading.Thread(target=receive_acks, args=(server_sock, sender), daemon=True).start()
+
+        print(f"{'pass':<6}{'packets':>9}{'acked':>9}{'retransmitted':>15}{'lost':>7}{'seconds':>10}")
+        seq = 1
+        for i in range(passes):
+            sender.reset_stats()
+            msgs = list(build_kv_cache_messages(NETCACHE_WRITE_QUERY, kv_cache, prompt_len, seq, pack, quant=quant))
+            sender.send(msgs, addr)
+            stats = sender.stats()
+            print(f"{i + 1:<6}{stats['sent']:>9}{stats['acked']:>9}{stats['retransmitted']:>15}{stats['lost']:>7}"
+                    f"{stats['elapsed']:>10.3f}")
+            ok = ok and stats['acked'] == stats['sent'] and stats['lost'] == 0
+            seq += len(msgs)
+    finally:
+        switch.terminate()
+        switch.wait()
+        server_sock.close()
+        client.close()
+
+    print('Every packet was acked' if ok else 'Some packets were not acked')
+    return ok
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    # the defaults are those of server.py
+    parser.add_argument('--cache', type=str, required=False, default='../p4/kv_cache.kvc', help='Path to the kv cache file')
+    parser.add_argument('--pack', type=int, required=False, default=1)
+    parser.add_argument('--quant', choices=KV_QUANT_MODES, required=False, default='fp32')
+    parser.add_argument('--init-rate', type=float, required=False, default=1000)
+    parser.add_argument('--init-window', type=int, required=False, default=64)
+    parser.add_argument('--passes', type=int, required=False, default=2)
+    parser.add_argument('--no-controller', help='run the switch without the controller (nothing gets cached)',
+            action='store_true')
+    args = parser.parse_args()
+
+    ok = main(args.cache, args.pack, args.quant, args.init_rate, args.init_window, args.passes,
+            not args.no_controller)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,88 @@
+import torch
+import transformers
+
+import server
+from codec import KV_QUANT_MODES, KV_TAG_LEN, build_kv_cache_messages, kv_pos_digits, max_vectors_per_packet, unpack_header
+from kv_buffer import KVCacheBuffer
+from kv_file import load_kv_cache
+from server import KVServer, NETCACHE_WRITE_QUERY, SYSTEM_PROMPT, INPUT_PROMPT
+
+PROBES = [
+    INPUT_PROMPT,
+    "What is the capital of France?",
+    "Write a short poem about the sea.",
+    "Explain how a hash table works.",
+    "List three benefits of regular exercise.",
+]
+
+
+# push the kv cache through the encoder of the given quantization mode and
+# back through the reassembly path of the server (as read from the switch);
+# the plain 6 digit keys only address prompts of up to 10 tokens, the keys of
+# longer ones are namespaced by a tag as those of the prefix cache
+def round_trip(kv_cache, prompt_len, quant):
+    n_layers, n_heads = kv_cache.shape[0], kv_cache.shape[3]
+    kv_buffer = KVCacheBuffer(n_layers, n_heads, prompt_len, quant=quant)
+    tag = '' if kv_pos_digits(prompt_len) == 1 else '0' * KV_TAG_LEN
+    msgs = list(build_kv_cache_messages(NETCACHE_WRITE_QUERY, kv_cache, prompt_len, pack=max_vectors_per_packet(quant),
+            tag=tag, quant=quant))
+    for msg in msgs:
+        _, _, key, payload = unpack_header(msg)
+        kv_buffer.store(key.decode('utf-8').lstrip('\x00'), payload)
+    return kv_buffer, len(msgs)
+
+
+# past_key_values stays a tuple of views: compute_inference wraps it in a new
+# DynamicCache on every call, where a single Cache would grow with each probe
+def first_tokens(kv_server, past_key_values, prompt_len):
+    return [kv_server.compute_inference(SYSTEM_PROMPT + probe, prompt_len, past_key_values)[1] for probe in PROBES]
+
+
+# compare the first token of compute_inference over the dequantized kv cache
+# with the first token of baseline_inference (and of compute_inference over
+# the original kv cache) for every probe and mode
+def main(cache, modes):
+    kv_cache = load_kv_cache(cache).to(torch.float32)
+    prompt_len = kv_cache.shape[4]
+    kv_server = KVServer('127.0.0.1', suppress=True)
+
+    baseline_tokens = [kv_server.baseline_inference(probe)[1] for probe in PROBES]
+    reference_tokens = first_tokens(kv_server, tuple((layer[0], layer[1]) for layer in kv_cache), prompt_len)
+
+    results = []
+    for quant in modes:
+        kv_buffer, n_msgs = round_trip(kv_cache, prompt_len, quant)
+        error = (kv_buffer.kv_vectors - kv_cache).abs()
+
+        tokens = first_tokens(kv_server, kv_buffer.past_key_values(), prompt_len)
+        baseline_matches = sum(a == b for a, b in zip(tokens, baseline_tokens))
+        reference_matches = sum(a == b for a, b in zip(tokens, reference_tokens))
+        results.append((quant, n_msgs, error.max().item(), error.mean().item(), baseline_matches, reference_matches))
+        kv_buffer.close()
+
+    kv_server.close()
+
+    print(f"{'mode':<8}{'packets':>10}{'max error':>14}{'mean error':>14}{'= baseline':>12}{'= fp32':>10}")
+    for quant, n_msgs, max_error, mean_error, baseline_matches, reference_matches in results:
+        print(f"{quant:<8}{n_msgs:>10}{max_error:>14.2e}{mean_error:>14.2e}"
+                f"{baseline_matches:>10}/{len(PROBES)}{reference_matches:>8}/{len(PROBES)}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cache', type=str, required=False, default='../p4/kv_cache.kvc', help='Path to the kv cache file')
+    parser.add_argument('--model', type=str, required=True)
+    parser.add_argument('--modes', nargs='+', choices=KV_QUANT_MODES, required=False, default=list(KV_QUANT_MODES))
+    args = parser.parse_args()
+
+    # compute_inference and baseline_inference use the model of the server module
+    server.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    server.tokenizer = transformers.AutoTokenizer.from_pretrained(args.model)
+    server.model = transformers.AutoModelForCausalLM.from_pretrained(args.model)
+    server.model.to(server.device)
+    server.model.eval()
+
+    main(args.cache, args.modes)
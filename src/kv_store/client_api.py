@@ -4,17 +4,23 @@ import sys
 import grpc
 import io
 
+from batch_io import BatchSender
+from codec import NETCACHE_KEY_SIZE, kv_packet_keys
+from partition import ConsistentHashRing, stable_hash
+
 NETCACHE_PORT = 50000
 NOCACHE_PORT = 50001
 
 MAX_SUPPORTED_SERVERS = 254
 
 NETCACHE_READ_QUERY = 0
+NETCACHE_WRITE_QUERY = 1
 NETCACHE_FLUSH_QUERY = 2
 NETCACHE_INIT_QUERY = 6
 
 NETCACHE_VALUE_SIZE = 512
 
+NETCACHE_REQUEST_SUCCESS = 10
 NETCACHE_KEY_NOT_FOUND = 20
 
 SYSTEM_PROMPT = "You are a helpful and informative AI assistant."
@@ -30,10 +36,10 @@ def build_message(op, key = "", seq=0, value = ""):
     msg += op.to_bytes(1, 'big')
     msg += seq.to_bytes(4, 'big')
 
-    if len(key) <= 8:
-        msg += convert(key).to_bytes(16, 'big')
+    if len(key) <= NETCACHE_KEY_SIZE:
+        msg += convert(key).to_bytes(NETCACHE_KEY_SIZE, 'big')
     else:
-        print("Error: Key should be up to 8 bytes")
+        print(f"Error: Key should be up to {NETCACHE_KEY_SIZE} bytes")
         return None
 
     if len(value) <= NETCACHE_VALUE_SIZE:
@@ -44,12 +50,24 @@ def build_message(op, key = "", seq=0, value = ""):
     return msg
 
 
+# tag of the keys and length in tokens of the system prompt the server pushed
+# to the switch, from its reply to an init query (value "<tag>:<prompt_len>")
+def parse_init_reply(data):
+    op = data[0]
+    if op != NETCACHE_REQUEST_SUCCESS:
+        raise RuntimeError(f"Server failed to push the system prompt to the cache (op = {op})")
+    tag, prompt_len = data[21:].decode("utf-8").strip('\x00').split(':')
+    return tag, int(prompt_len)
+
+
 class NetCacheClient:
 
-    def __init__(self, n_servers=1, no_cache=False):
+    def __init__(self, n_servers=1, no_cache=False, interface='client1-eth0'):
         self.n_servers = n_servers
         self.successful_reads = 0
         self.servers = []
+        # consistent hash ring of the servers (built on first use, see get_node)
+        self.ring = None
 
         if no_cache:
             self.port = NOCACHE_PORT
@@ -57,31 +75,33 @@ class NetCacheClient:
             self.port = NETCACHE_PORT
 
         self.sock_s1 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock_s1.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, b'client1-eth0')
+        # interface of the client host in the mininet topology (None on loopback)
+        if interface is not None:
+            self.sock_s1.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+        # sends bursts of reads with as few syscalls as possible
+        self.batch_sender = BatchSender(self.sock_s1)
 
         # store all latencies of the requests sent (used for evaluation)
         self.latencies = []
 
-    def send_system_prompt(self, seq = 0):
-        msg = build_message(NETCACHE_INIT_QUERY, "init", seq, SYSTEM_PROMPT)
+    # ask the server to push the kv cache of a system prompt to the switch,
+    # returns the tag of its keys and its length in tokens (see read_kv_cache)
+    def send_system_prompt(self, seq = 0, prompt = SYSTEM_PROMPT):
+        msg = build_message(NETCACHE_INIT_QUERY, "init", seq, prompt)
         if msg is None:
             return
 
         start_time = time.time()
-        self.udps.connect(('10.0.0.1', self.port))
-        self.udps.send(msg)
+        self.sock_s1.sendto(msg, ('10.0.0.1', self.port))
 
-        data = self.udps.recv(1024)
-        op = data[0]
+        data = self.sock_s1.recv(1024)
 
         latency = time.time() - start_time
         self.latencies.append(latency)
 
-        if op == NETCACHE_KEY_NOT_FOUND:
-            print('Error: Key not found (key = ' + key + ')')
-        else:
-            val = data[21:].decode("utf-8")
-            print(val)
+        tag, prompt_len = parse_init_reply(data)
+        print(f"Prompt written to KV Cache (tag = {tag}, {prompt_len} tokens)")
+        return tag, prompt_len
 
     def configure(self):
 
@@ -127,10 +147,13 @@ class NetCacheClient:
 
     # return the right node who contains the given key - our implementation
     # is based on client side partitioning i.e the client directly sends
-    # the message to the correct node
-    # TODO:1(dimlek): implement consistent hashing partitioning
+    # the message to the correct node (see partition.py and sim_partition.py
+    # for the balance of each scheme)
     # TODO:2(dimlek): explore option of proxy assisted partitioning
     def get_node(self, key, partition_scheme='range'):
+        # the servers of the topology unless the caller set its own list
+        if not self.servers:
+            self.get_servers_ips()
 
         if partition_scheme == 'range':
             # find the right node through range partitioning based on 1st key character
@@ -138,11 +161,17 @@ class NetCacheClient:
             return self.servers[first_letter % self.n_servers]
 
         elif partition_scheme == 'hash':
-            return self.servers[hash(key) % self.n_servers]
+            # hash() is randomized per process, clients would disagree
+            return self.servers[stable_hash(key) % self.n_servers]
 
         elif partition_scheme == 'consistent-hash':
-            # TODO(dimlek): impelement consistent hashing partitioning
-            pass
+            return self.server_ring().node_for(key)
+
+        elif partition_scheme == 'bounded-hash':
+            # consistent hashing with bounded loads, keys are placed as they
+            # are first seen (use server_ring().place(keys) to agree on the
+            # placement of a known key set with the other clients)
+            return self.server_ring().assign(key)
 
         else:
             print("Error: Invalid partitioning scheme")
@@ -150,6 +179,11 @@ class NetCacheClient:
 
         return -1
 
+    def server_ring(self):
+        if self.ring is None:
+            self.ring = ConsistentHashRing(self.servers)
+        return self.ring
+
     def run_inference(stub, probe, use_kv_cache=False, kv_cache_bytes=None, prompt_len=-1):
         """
         Make an inference RPC call. If use_kv_cache is True and kv_cache_bytes is provided,
@@ -200,6 +234,36 @@ class NetCacheClient:
             self.successful_reads += 1
             return val
         return None
+        '''
+
+    # write a value through the server that owns the key (over tcp), returns
+    # once the server acked it, i.e. once the switch no longer serves an older
+    # value of the key
+    def write(self, key, value, seq=0, partition_scheme='range'):
+        msg = build_message(NETCACHE_WRITE_QUERY, key, seq, value)
+        if msg is None:
+            return False
+
+        with socket.create_connection((self.get_node(key, partition_scheme), self.port)) as sock:
+            sock.sendall(msg)
+            data = sock.recv(1024)
+        return len(data) > 0 and data[0] == NETCACHE_REQUEST_SUCCESS
+
+    # read every vector of the system prompt kv cache from the switch, using
+    # the packing mode (vectors per packet) the server populated it with and
+    # the tag returned by send_system_prompt
+    def read_kv_cache(self, n_layers=12, n_heads=12, prompt_len=9, pack=1, seq=0, tag=''):
+        self.read_many(kv_packet_keys(n_layers, n_heads, prompt_len, pack, tag), seq)
+
+    # send a read query for each key in one batch of datagrams
+    def read_many(self, keys, seq=0):
+        msgs = []
+        for key in keys:
+            msg = build_message(NETCACHE_READ_QUERY, key, seq)
+            if msg is not None:
+                msgs.append(msg)
+
+        self.batch_sender.send_batch(msgs, ("10.0.0.1", self.port))
 
     def request_latency_metric(self):
         total_latency = 0
@@ -208,20 +272,26 @@ class NetCacheClient:
         average_latency = total_latency / len(self.latencies)
         print(f"Average Latency of sending message: {average_latency}")
 
+    # have the controller evict every cached key, returns whether the switch
+    # acknowledged the flush
     def flush(self, seq = 0):
-        msg = build_message(NETCACHE_FLUSH_QUERY, seq)
+        msg = build_message(NETCACHE_FLUSH_QUERY, seq=seq)
         if msg is None:
-            return
-
-        self.udps.connect((self.get_node(key), self.port))
-        self.udps.send(msg)
+            return False
 
+        # the switch clones the query to the controller and returns it
         start_time = time.time()
+        self.sock_s1.sendto(msg, ('10.0.0.1', self.port))
 
-        data = self.udps.recv(1024)
+        data = self.sock_s1.recv(1024)
         op = data[0]
 
         latency = time.time() - start_time
         self.latencies.append(latency)
 
-        print(f"Received Flush Complete {op}")
+        if op != NETCACHE_FLUSH_QUERY:
+            print(f"Error: Unexpected reply to the flush (op = {op})")
+            return False
+
+        print("Received Flush Complete")
+        return True
@@ -0,0 +1,246 @@
+import numpy as np
+import torch
+
+from netcache_header import NETCACHE_HEADER, NETCACHE_KEY_SIZE, NETCACHE_VALUE_BYTES
+
+# size of the fixed part of the netcache header (see netcache_header.py), the
+# value fields follow it and are parsed separately
+NETCACHE_HEADER_SIZE = NETCACHE_HEADER.size
+
+# every cached item is the key or value vector of a single attention head
+# at a single position of the system prompt (64 big-endian float32 values)
+KV_HEAD_DIM = 64
+WIRE_DTYPE = np.dtype('>f4')
+KV_VECTOR_SIZE = KV_HEAD_DIM * WIRE_DTYPE.itemsize
+
+# a full netcache header carries value and value2 (2 x 2048 bits), which is
+# assembled by the switch over RECIRCULATION_COUNT passes of the value tables
+NETCACHE_PAYLOAD_SIZE = NETCACHE_VALUE_BYTES
+MAX_VECTORS_PER_PACKET = NETCACHE_PAYLOAD_SIZE // KV_VECTOR_SIZE
+
+# vectors can optionally be quantized on the wire (and thus in the switch
+# registers) to big-endian float16, or to int8 preceded by a per vector
+# big-endian float32 scale (max(|x|) / 127), fitting more vectors per packet
+KV_QUANT_MODES = ('fp32', 'fp16', 'int8')
+FP16_WIRE_DTYPE = np.dtype('>f2')
+INT8_SCALE_DTYPE = np.dtype('>f4')
+INT8_MAX = 127
+
+
+def kv_vector_size(quant='fp32'):
+    if quant == 'fp32':
+        return KV_VECTOR_SIZE
+    if quant == 'fp16':
+        return KV_HEAD_DIM * FP16_WIRE_DTYPE.itemsize
+    if quant == 'int8':
+        return INT8_SCALE_DTYPE.itemsize + KV_HEAD_DIM
+    raise ValueError("Invalid quantization mode " + str(quant))
+
+
+# 2 fp32, 4 fp16 or 7 int8 vectors per packet (the count is a single digit
+# of the packet key)
+def max_vectors_per_packet(quant='fp32'):
+    return min(NETCACHE_PAYLOAD_SIZE // kv_vector_size(quant), 9)
+
+
+# the key of a kv vector encodes its coordinates in the kv cache of the model
+# as <layer (2 digits)><kv toggle (1 digit)><head (2 digits)><position (1 digit)>
+def kv_key(layer, kv_toggle, head, pos):
+    return f"{layer:02}{kv_toggle}{head:02}{pos}"
+
+
+def parse_kv_key(key):
+    return int(key[0:2]), int(key[2]), int(key[3:5]), int(key[5])
+
+
+# packed packets carry count vectors that are consecutive in (layer, kv, head,
+# pos) order, starting from the given coordinates; the descriptor is the key
+# of the first vector followed by the vector count (1 digit), so that it still
+# fits in the 8 bytes of the key the switch matches on
+def kv_packed_key(layer, kv_toggle, head, pos, count):
+    return kv_key(layer, kv_toggle, head, pos) + str(count)
+
+
+# keys of the kv caches served from the prefix cache are namespaced by a tag
+# derived from the hash of the prompt, as <tag (KV_TAG_LEN hex digits)><layer
+# (2 digits)><kv toggle (1 digit)><head (2 digits)><position (as many digits
+# as the prompt length needs)><count (1 digit)>, which fits in the 16 bytes of
+# the key field for prompts of up to 10000 tokens
+KV_TAG_LEN = 6
+
+
+def kv_tagged_key(tag, layer, kv_toggle, head, pos, count, pos_digits=1):
+    return f"{tag}{layer:02}{kv_toggle}{head:02}{pos:0{pos_digits}}{count}"
+
+
+def kv_pos_digits(prompt_len):
+    return len(str(max(prompt_len - 1, 0)))
+
+
+def is_tagged_key(key):
+    return len(key) > 7
+
+
+def kv_key_tag(key):
+    return key[:KV_TAG_LEN] if is_tagged_key(key) else ''
+
+
+# returns the coordinates of the first vector and the number of vectors
+# carried by a packet with the given key (plain 6 digit keys carry one)
+def parse_kv_packet_key(key):
+    if is_tagged_key(key):
+        body = key[KV_TAG_LEN:]
+        return (int(body[0:2]), int(body[2]), int(body[3:5]), int(body[5:-1])), int(body[-1])
+    count = int(key[6]) if len(key) > 6 else 1
+    return parse_kv_key(key), count
+
+
+def kv_flat_index(layer, kv_toggle, head, pos, n_heads, prompt_len):
+    return ((layer * 2 + kv_toggle) * n_heads + head) * prompt_len + pos
+
+
+def kv_unflat_index(idx, n_heads, prompt_len):
+    idx, pos = divmod(idx, prompt_len)
+    idx, head = divmod(idx, n_heads)
+    layer, kv_toggle = divmod(idx, 2)
+    return layer, kv_toggle, head, pos
+
+
+# coordinates of every vector described by a packet key
+def kv_packet_coords(key, n_heads, prompt_len):
+    start, count = parse_kv_packet_key(key)
+    first = kv_flat_index(*start, n_heads, prompt_len)
+    return [kv_unflat_index(idx, n_heads, prompt_len) for idx in range(first, first + count)]
+
+
+# keys of all the packets needed to carry a kv cache, with pack vectors per
+# packet (pack=1 keeps the original one vector per key layout), namespaced by
+# tag if one is given
+def kv_packet_keys(n_layers, n_heads, prompt_len, pack=1, tag=''):
+    n_vectors = n_layers * 2 * n_heads * prompt_len
+    pos_digits = kv_pos_digits(prompt_len)
+    if tag and KV_TAG_LEN + 6 + pos_digits > NETCACHE_KEY_SIZE:
+        raise ValueError(f"Prompt of {prompt_len} tokens does not fit in the key space")
+
+    for start in range(0, n_vectors, pack):
+        coords = kv_unflat_index(start, n_heads, prompt_len)
+        count = min(pack, n_vectors - start)
+        if tag:
+            yield kv_tagged_key(tag, *coords, count, pos_digits)
+        elif pack == 1:
+            yield kv_key(*coords)
+        else:
+            yield kv_packed_key(*coords, count)
+
+
+# left pad the key with zero bytes to the width of the key field (this is
+# the same representation as int.from_bytes(key).to_bytes(16, 'big'))
+def key_to_bytes(key):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return key.rjust(NETCACHE_KEY_SIZE, b'\x00')
+
+
+def pack_header(op, seq, key):
+    return NETCACHE_HEADER.pack(op, seq, key_to_bytes(key))
+
+
+# returns (op, seq, key, value) where value is a zero-copy view of the
+# payload that follows the header
+def unpack_header(pkt):
+    op, seq, key = NETCACHE_HEADER.unpack_from(pkt)
+    return op, seq, key, memoryview(pkt)[NETCACHE_HEADER_SIZE:]
+
+
+# convert a tensor (of any shape whose last dimension is the head dimension)
+# to its wire representation in a single pass, the result holds one row of
+# kv_vector_size(quant) bytes per vector
+def encode_vectors(tensor, quant='fp32'):
+    if isinstance(tensor, torch.Tensor):
+        tensor = tensor.detach().cpu().numpy()
+    if quant == 'fp32':
+        return np.ascontiguousarray(tensor, dtype=WIRE_DTYPE).reshape(-1, KV_HEAD_DIM)
+    if quant == 'fp16':
+        return np.ascontiguousarray(tensor, dtype=FP16_WIRE_DTYPE).reshape(-1, KV_HEAD_DIM)
+    if quant != 'int8':
+        raise ValueError("Invalid quantization mode " + str(quant))
+
+    vectors = np.asarray(tensor, dtype=np.float32).reshape(-1, KV_HEAD_DIM)
+    scales = np.abs(vectors).max(axis=1) / INT8_MAX
+    # all zero vectors keep a zero scale and decode back to zeros
+    safe = np.where(scales > 0, scales, 1.0)
+    wire = np.empty((len(vectors), kv_vector_size(quant)), dtype=np.uint8)
+    wire[:, :INT8_SCALE_DTYPE.itemsize] = scales.astype(INT8_SCALE_DTYPE).view(np.uint8).reshape(-1, INT8_SCALE_DTYPE.itemsize)
+    wire[:, INT8_SCALE_DTYPE.itemsize:] = np.rint(vectors / safe[:, None]).astype(np.int8).view(np.uint8)
+    return wire
+
+
+def encode_vector(vector):
+    return encode_vectors(vector).tobytes()
+
+
+# decode count vectors from buf (anything supporting the buffer protocol) into
+# a float32 tensor; when out is given the values are byte swapped (and
+# dequantized) straight into its storage instead of allocating a new tensor
+def decode_vectors(buf, count=1, out=None, quant='fp32'):
+    if out is None:
+        out = torch.empty(count, KV_HEAD_DIM, dtype=torch.float32)
+    dst = out.numpy().reshape(count, KV_HEAD_DIM)
+
+    if quant == 'fp32':
+        dst[:] = np.frombuffer(buf, dtype=WIRE_DTYPE, count=count * KV_HEAD_DIM).reshape(count, KV_HEAD_DIM)
+    elif quant == 'fp16':
+        dst[:] = np.frombuffer(buf, dtype=FP16_WIRE_DTYPE, count=count * KV_HEAD_DIM).reshape(count, KV_HEAD_DIM)
+    elif quant == 'int8':
+        rows = np.frombuffer(buf, dtype=np.uint8, count=count * kv_vector_size(quant)).reshape(count, -1)
+        scales = rows[:, :INT8_SCALE_DTYPE.itemsize].copy().view(INT8_SCALE_DTYPE)
+        np.multiply(rows[:, INT8_SCALE_DTYPE.itemsize:].view(np.int8), scales, out=dst)
+    else:
+        raise ValueError("Invalid quantization mode " + str(quant))
+    return out
+
+
+def decode_vector(buf, out=None):
+    if out is None:
+        return decode_vectors(buf).view(KV_HEAD_DIM)
+    return decode_vectors(buf, out=out)
+
+
+def build_write_message(op, key, value, seq=0):
+    return pack_header(op, seq, key) + encode_vector(value)
+
+
+def unpack_message_to_tensor(value):
+    return decode_vector(value)
+
+
+# generate the write messages for every (layer, kv, head, pos) vector of a
+# legacy past_key_values tuple (or of a [layers, 2, 1, heads, positions,
+# head_dim] tensor), the whole cache is converted to wire format
+# once and every message payload is a slice of that buffer; each message
+# carries up to pack consecutive vectors, zero padded to the full value and
+# value2 fields that the switch parses;
+# messages are numbered with consecutive seq values starting from seq so that
+# each one of them can be acknowledged individually
+def build_kv_cache_messages(op, kv_cache, prompt_len, seq=0, pack=1, tag='', quant='fp32'):
+    max_pack = max_vectors_per_packet(quant)
+    if pack < 1 or pack > max_pack:
+        raise ValueError(f"pack should be between 1 and {max_pack} for {quant} vectors")
+
+    if isinstance(kv_cache, torch.Tensor):
+        cache = kv_cache
+    else:
+        cache = torch.stack([torch.stack(tuple(layer)) for layer in kv_cache])
+    n_layers = cache.shape[0]
+    n_heads = cache.shape[3]
+    wire = encode_vectors(cache[:, :, 0, :, :prompt_len], quant)
+    rows = memoryview(wire).cast('B')
+    vector_size = kv_vector_size(quant)
+
+    start = 0
+    for key in kv_packet_keys(n_layers, n_heads, prompt_len, pack, tag):
+        _, count = parse_kv_packet_key(key)
+        msg = pack_header(op, seq, key) + rows[start * vector_size:(start + count) * vector_size]
+        yield msg.ljust(NETCACHE_HEADER_SIZE + NETCACHE_PAYLOAD_SIZE, b'\x00')
+        start += count
+        seq = (seq + 1) & 0xffffffff
@@ -0,0 +1,246 @@
+from collections import deque
+
+import os
+import socket
+import struct
+import threading
+
+# messages of the unix channel between the server and the controller (see
+# NCacheController.coherence_loop): type (1 byte) | count (4 bytes) followed
+# by count entries
+COHERENCE_HEADER = struct.Struct('>BI')
+# sent by both ends on connect, count carries the protocol version
+COHERENCE_HELLO = 0
+# server -> controller, entries of key (16 bytes) | value (512 bytes)
+COHERENCE_UPDATE = 1
+# controller -> server, keys (16 bytes) whose new value is in the switch and
+# valid again (no keys: a batch of cache insertions was committed)
+COHERENCE_INSERT_OK = 2
+COHERENCE_VERSION = 1
+
+NETCACHE_KEY_SIZE = 16
+NETCACHE_VALUE_BYTES = 512
+
+ENTRY_SIZE = {
+    COHERENCE_HELLO: 0,
+    COHERENCE_UPDATE: NETCACHE_KEY_SIZE + NETCACHE_VALUE_BYTES,
+    COHERENCE_INSERT_OK: NETCACHE_KEY_SIZE,
+}
+
+
+def recv_exactly(conn, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("coherence channel closed")
+        data += chunk
+    return bytes(data)
+
+
+def send_message(conn, kind, entries=(), count=None):
+    entries = list(entries)
+    conn.sendall(COHERENCE_HEADER.pack(kind, len(entries) if count is None else count) + b''.join(entries))
+
+
+# (type, count, payload) of the next message on conn
+def recv_message(conn):
+    kind, count = COHERENCE_HEADER.unpack(recv_exactly(conn, COHERENCE_HEADER.size))
+    if kind not in ENTRY_SIZE:
+        raise ValueError("unknown coherence message type " + str(kind))
+    return kind, count, recv_exactly(conn, count * ENTRY_SIZE[kind])
+
+
+# server end of the write-through protocol: a write of a key sends its new
+# value to the controller, which invalidates the key in the switch (reads
+# then miss and reach the server), rewrites its value and validates it again
+# before acking the key with INSERT_OK; until then the requests of the key are
+# buffered in incoming_requests (in arrival order) and handed back to serve
+# once the ack has arrived, so that no read is answered with a value older
+# than an acknowledged write
+class CoherenceChannel(object):
+
+    def __init__(self, path, serve, incoming_requests=None, values=None, batch=64):
+        self.path = path
+        self.serve = serve
+        # (key, request) of the requests of keys being updated, serve(key,
+        # request) is called for each of them once the key is acked
+        self.incoming_requests = deque() if incoming_requests is None else incoming_requests
+        # latest value written to each key, set when its update starts (the
+        # server answers the reads that reach it from here)
+        self.values = {} if values is None else values
+        # updates sent to the controller at most batch keys at a time
+        self.batch = batch
+
+        self.sock = None
+        self.conn = None
+        self.cond = threading.Condition()
+        # key -> (callbacks, value) of the update of the key waiting for its ack
+        self.updating = {}
+        # key -> [value, callbacks] of the writes buffered behind it
+        self.merged = {}
+        # (key, value) of the writes not yet sent to the controller
+        self.outgoing = []
+
+        self.updates = 0
+        self.acks = 0
+        self.buffered = 0
+
+    def listen(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+        return self.sock
+
+    def start(self):
+        if self.sock is None:
+            self.listen()
+        threads = [threading.Thread(target=self.accept_loop, daemon=True),
+                threading.Thread(target=self.send_loop, daemon=True)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    # one controller at a time, a new connection replaces the previous one and
+    # the updates not acked yet are sent again over it
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            try:
+                kind, version, _ = recv_message(conn)
+                if kind != COHERENCE_HELLO or version != COHERENCE_VERSION:
+                    raise ValueError("unexpected handshake ({}, {})".format(kind, version))
+                send_message(conn, COHERENCE_HELLO, count=COHERENCE_VERSION)
+            except (OSError, ValueError) as e:
+                print('Error: controller handshake failed: ' + str(e))
+                conn.close()
+                continue
+
+            with self.cond:
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = conn
+                self.outgoing = [(key, value) for key, (_, value) in self.updating.items()]
+                self.cond.notify_all()
+            threading.Thread(target=self.receive_loop, args=(conn, ), daemon=True).start()
+
+    def receive_loop(self, conn):
+        try:
+            while True:
+                kind, count, payload = recv_message(conn)
+                if kind == COHERENCE_INSERT_OK and count > 0:
+                    self.ack([payload[i:i + NETCACHE_KEY_SIZE] for i in range(0, len(payload), NETCACHE_KEY_SIZE)])
+        except (OSError, ValueError):
+            pass
+        with self.cond:
+            if self.conn is conn:
+                self.conn = None
+        conn.close()
+
+    def send_loop(self):
+        while True:
+            with self.cond:
+                while not self.outgoing or self.conn is None:
+                    self.cond.wait()
+                batch, self.outgoing = self.outgoing[:self.batch], self.outgoing[self.batch:]
+                conn = self.conn
+            try:
+                send_message(conn, COHERENCE_UPDATE, (key + value for key, value in batch))
+            except OSError:
+                # sent again once the controller reconnects
+                pass
+
+    # a write of key (16 bytes, zero padded) to value, done() is called once
+    # the switch is coherent with it; the writes of a key being updated are
+    # buffered until the update in flight is acked and then go out as a
+    # single update with the latest of their values (acking all of them)
+    def write(self, key, value, done=None):
+        value = bytes(value[:NETCACHE_VALUE_BYTES]).ljust(NETCACHE_VALUE_BYTES, b'\x00')
+        with self.cond:
+            if key not in self.updating:
+                self.start_update(key, value, [done])
+                return True
+            merged = self.merged.get(key)
+            if merged is None:
+                merged = self.merged[key] = [None, []]
+                self.incoming_requests.append((key, ('write', )))
+            merged[0] = value
+            merged[1].append(done)
+            self.buffered += 1
+            return False
+
+    # called with the lock held
+    def start_update(self, key, value, callbacks):
+        self.updating[key] = (callbacks, value)
+        self.values[key] = value
+        self.outgoing.append((key, value))
+        self.updates += 1
+        self.cond.notify_all()
+
+    # buffer request (a tuple starting with the kind of the request, e.g.
+    # 'read') until the update of key in flight (if any) is acked, returns
+    # whether the request was buffered
+    def hold(self, key, request):
+        with self.cond:
+            if key not in self.updating:
+                return False
+            self.incoming_requests.append((key, request))
+            self.buffered += 1
+            return True
+
+    # INSERT_OK of a batch of keys: their writes complete, and the requests
+    # buffered behind them are served again in order (a buffered write starts
+    # the next update of its key, the requests after it stay buffered)
+    def ack(self, keys):
+        done = []
+        ready = []
+        with self.cond:
+            for key in keys:
+                entry = self.updating.pop(key, None)
+                if entry is not None:
+                    done += entry[0]
+                    self.acks += 1
+
+            kept = []
+            for key, request in self.incoming_requests:
+                if key in self.updating:
+                    kept.append((key, request))
+                elif request[0] == 'write':
+                    # started here so that no later write of the key overtakes it
+                    value, callbacks = self.merged.pop(key)
+                    self.start_update(key, value, callbacks)
+                else:
+                    ready.append((key, request))
+            self.incoming_requests.clear()
+            self.incoming_requests.extend(kept)
+
+        for callback in done:
+            if callback is not None:
+                callback()
+        for key, request in ready:
+            self.serve(key, request)
+
+    def pending(self):
+        with self.cond:
+            return len(self.updating)
+
+    def stats(self):
+        with self.cond:
+            return {'updates': self.updates, 'acks': self.acks, 'buffered': self.buffered,
+                    'pending': len(self.updating), 'queued': len(self.incoming_requests)}
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        with self.cond:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -1,37 +1,330 @@
-from client_api import NetCacheClient
+from itertools import islice
+
+import multiprocessing
+import os
+import queue
+import select
+import socket
+import threading
+import time
 
 import numpy as np
 
+from client_api import (NetCacheClient, NETCACHE_PORT, NOCACHE_PORT, NETCACHE_READ_QUERY, NETCACHE_WRITE_QUERY,
+        NETCACHE_REQUEST_SUCCESS, build_message)
+from codec import NETCACHE_HEADER, NETCACHE_HEADER_SIZE
+from gen_zipf_samples import ZIPF_MODES, load_keys, query_chunks
+from metrics import Metrics
+
+NETCACHE_READ_FAIL = 3
+
+RECV_BUFFER_SIZE = 8 * 1024 * 1024
+# processes start together this long after they are forked
+START_DELAY = 0.5
+
+
+# queries of a sample file: the key of a read or key=value for a write
+def file_queries(filepath):
+    with open(filepath) as fp:
+        for line in fp:
+            key, sep, value = line.strip().partition('=')
+            if key:
+                yield key, value if sep else None
+
+
+# queries drawn on the fly (see gen_zipf_samples.py), writes get the number
+# of the query as their value
+def zipf_queries(n_servers, n_queries, skew, mode, seed, write_ratio):
+    n = 0
+    for writes, keys in query_chunks(load_keys(n_servers), n_queries, skew, mode=mode, seed=seed,
+            write_ratio=write_ratio):
+        for write, key in zip(writes.tolist(), keys.tolist()):
+            yield key, 'q' + str(n) if write else None
+            n += 1
+
+
+# every key the workload may query (the bounded-load placement of a key
+# depends on the keys placed before it, the clients place the whole set at
+# once so that they agree on the server of every key)
+def workload_keys(config):
+    if config['input'] is not None:
+        return {key for key, _ in file_queries(config['input'])}
+    return load_keys(config['n_servers'])
+
+
+# intended send times (seconds from the start) of an open loop client sending
+# rate queries/sec, evenly spaced or as a poisson process (rate <= 0 sends
+# every query right away)
+def arrivals(rate, poisson, rng, offset=0.0):
+    t = offset
+    while True:
+        yield t
+        if rate > 0:
+            t += rng.exponential(1.0 / rate) if poisson else 1.0 / rate
+
+
+# one client process of the open loop driver: it sends its share of the
+# queries at their intended times whatever the replies do, and the latency
+# of a request is measured from its intended send time (so that a stalled
+# server is not hidden by requests that were sent late); times are on the
+# wall clock, from start_at, so that the time series of the processes line up
+# when they are merged; reads go over udp,
+# matched to their reply by seq, and writes over tcp from a separate thread
+class OpenLoopClient:
+
+    def __init__(self, servers, port, partition, disable_cache, timeout, start_at, keys=None):
+        self.servers = servers
+        self.port = port
+        self.partition = partition
+        # the server answers READ_FAIL queries (READ queries reaching it are
+        # the reads of the kv cache served by the switch)
+        self.read_op = NETCACHE_READ_FAIL if disable_cache else NETCACHE_READ_QUERY
+        self.timeout = timeout
+
+        self.client = NetCacheClient(n_servers=len(servers), no_cache=disable_cache, interface=None)
+        self.client.servers = list(servers)
+        if partition == 'bounded-hash':
+            self.client.server_ring().place(keys)
+
+        self.start_at = start_at
+        self.reads = Metrics(start_time=start_at)
+        self.writes = Metrics(start_time=start_at)
+        self.sent = 0
+        self.replies = 0
+        self.switch_hits = 0
+        self.server_replies = 0
+        self.lost = 0
+        self.write_errors = 0
+        self.late_sends = 0
+
+        self.write_queue = queue.SimpleQueue()
+
+    def udp_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        sock.setblocking(False)
+        return sock
+
+    def write_loop(self, start):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                return
+            intended, key, value = item
+            msg = build_message(NETCACHE_WRITE_QUERY, key, 0, value)
+            try:
+                with socket.create_connection((self.client.get_node(key, self.partition), self.port),
+                        timeout=self.timeout) as sock:
+                    sock.sendall(msg)
+                    data = sock.recv(1024)
+                if not data or data[0] != NETCACHE_REQUEST_SUCCESS:
+                    raise OSError("write not acked")
+                self.writes.record(self.start_at + intended, self.start_at + time.perf_counter() - start)
+            except OSError:
+                self.write_errors += 1
 
-def main(n_servers, disable_cache, suppress, input_files):
-    client = NetCacheClient(n_servers=n_servers, no_cache=disable_cache)
+    def receive(self, sock, start, in_flight):
+        while True:
+            try:
+                data = sock.recv(2048)
+            except BlockingIOError:
+                return
+            if len(data) < NETCACHE_HEADER_SIZE:
+                continue
+            op, seq, _ = NETCACHE_HEADER.unpack_from(data)
+            intended = in_flight.pop(seq, None)
+            if intended is None:
+                continue
+            self.reads.record(self.start_at + intended, self.start_at + time.perf_counter() - start)
+            self.replies += 1
+            # the switch returns the read itself, the server answers a miss
+            # with a write of the value
+            if op == NETCACHE_READ_QUERY:
+                self.switch_hits += 1
+            else:
+                self.server_replies += 1
 
-    for filepath in input_files:
-        sample = []
+    def expire(self, now, in_flight):
+        expired = [seq for seq, intended in in_flight.items() if now - intended > self.timeout]
+        for seq in expired:
+            del in_flight[seq]
+        self.lost += len(expired)
 
-        with open(filepath) as fp:
-            line = fp.readline()
-            while line:
-                sample.append(line.strip())
-                line = fp.readline()
+    def run(self, queries, schedule, start):
+        sock = self.udp_socket()
+        writer_t = threading.Thread(target=self.write_loop, args=(start, ), daemon=True)
+        writer_t.start()
 
-        for query in sample:
-            client.read(query, suppress=suppress)
+        # seq -> intended send time of the reads waiting for a reply
+        in_flight = {}
+        last_expire = 0.0
+        seq = 0
+        for (key, value), intended in zip(queries, schedule):
+            while True:
+                now = time.perf_counter() - start
+                if now >= intended:
+                    break
+                readable, _, _ = select.select([sock], [], [], min(intended - now, 0.01))
+                if readable:
+                    self.receive(sock, start, in_flight)
+            if now - intended > 0.001:
+                self.late_sends += 1
 
-        #print("\n########## SERVER METRICS REPORT ##########")
-        #print("########## [{}] ##########\n".format(filepath))
+            if value is not None:
+                self.writes.record_sent()
+                self.write_queue.put((intended, key, value))
+            else:
+                self.reads.record_sent()
+                msg = build_message(self.read_op, key, seq)
+                if msg is not None:
+                    in_flight[seq] = intended
+                    sock.sendto(msg, (self.client.get_node(key, self.partition), self.port))
+                    seq = (seq + 1) & 0xffffffff
+            self.sent += 1
 
-        if disable_cache:
-            x = 'nocache'
-        else:
-            x = 'netcache'
+            if now - last_expire > self.timeout:
+                self.expire(now, in_flight)
+                last_expire = now
 
-        input_file = filepath.split('/')[1].split('.')[0]
+        # wait for the last replies
+        deadline = time.perf_counter() + self.timeout
+        while in_flight and time.perf_counter() < deadline:
+            readable, _, _ = select.select([sock], [], [], 0.01)
+            if readable:
+                self.receive(sock, start, in_flight)
+        self.lost += len(in_flight)
+        self.write_queue.put(None)
+        writer_t.join(self.timeout)
+        sock.close()
 
-        out_file = 'results/{}_{}_{}.txt'.format(input_file, n_servers, x)
-        out_fd = open(out_file, 'w')
+    def results(self):
+        return {'reads': self.reads.to_dict(), 'writes': self.writes.to_dict(), 'sent': self.sent,
+                'replies': self.replies, 'switch_hits': self.switch_hits, 'server_replies': self.server_replies,
+                'lost': self.lost, 'write_errors': self.write_errors, 'late_sends': self.late_sends}
 
-        client.request_metrics_report(output=out_fd)
+
+# client process k of n_clients: queries k, k + n, ... at rate / n_clients
+def client_process(k, n_clients, config, keys, start_at, results):
+    rng = np.random.default_rng(None if config['seed'] is None else config['seed'] + k)
+    rate = config['rate'] / n_clients
+    # constant arrivals of the clients are interleaved
+    offset = k / config['rate'] if config['rate'] > 0 and not config['poisson'] else 0.0
+
+    queries = islice(workload(config), k, None, n_clients)
+    client = OpenLoopClient(config['servers'], config['port'], config['partition'], config['disable_cache'],
+            config['timeout'], start_at, keys)
+
+    time.sleep(max(0.0, start_at - time.time()))
+    start = time.perf_counter()
+    client.run(queries, arrivals(rate, config['poisson'], rng, offset), start)
+    results.put((time.perf_counter() - start, client.results()))
+
+
+def workload(config):
+    if config['input'] is not None:
+        return file_queries(config['input'])
+    return zipf_queries(config['n_servers'], config['zipf'], config['skew'], config['mode'], config['seed'],
+            config['write_ratio'])
+
+
+# replay one workload with n_clients processes, returns the merged results
+def run(config, n_clients):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    keys = workload_keys(config) if config['partition'] == 'bounded-hash' else None
+    start_at = time.time() + START_DELAY
+    clients = [ctx.Process(target=client_process, args=(k, n_clients, config, keys, start_at, results))
+            for k in range(n_clients)]
+    for client in clients:
+        client.start()
+    outcomes = [results.get() for _ in clients]
+    for client in clients:
+        client.join()
+
+    elapsed = max(elapsed for elapsed, _ in outcomes)
+    reads, writes = Metrics(start_time=start_at), Metrics(start_time=start_at)
+    totals = {}
+    for _, outcome in outcomes:
+        reads.merge(Metrics.from_dict(outcome.pop('reads')))
+        writes.merge(Metrics.from_dict(outcome.pop('writes')))
+        for name, value in outcome.items():
+            totals[name] = totals.get(name, 0) + value
+    return elapsed, reads, writes, totals
+
+
+def summary(config, n_clients, elapsed, reads, writes, totals):
+    report = {
+        'workload': config['name'],
+        'n_servers': config['n_servers'],
+        'cache': 'nocache' if config['disable_cache'] else 'netcache',
+        'clients': n_clients,
+        'arrivals': 'poisson' if config['poisson'] else 'constant',
+        'offered_rate': config['rate'],
+        'elapsed': elapsed,
+        'throughput': (totals['replies'] + writes.total_messages_received) / elapsed if elapsed > 0 else 0.0,
+        'switch_hit_ratio': totals['switch_hits'] / totals['replies'] if totals['replies'] else 0.0,
+        'server_ratio': totals['server_replies'] / totals['replies'] if totals['replies'] else 0.0,
+    }
+    report.update(totals)
+    for name, metrics in (('read', reads), ('write', writes)):
+        report[name + '_count'] = metrics.total_messages_received
+        report[name + '_mean_ms'] = metrics.calculate_avg_latency()
+        for p in (50, 99, 99.9):
+            report[f"{name}_p{p:g}_ms"] = metrics.percentile(p)
+        report[name + '_max_ms'] = metrics.latency.max / 1e3
+    return report
+
+
+def print_summary(report, output=None):
+    lines = [
+        f"[{report['workload']}] {report['n_servers']} servers, {report['cache']}, {report['clients']} clients, "
+        f"{report['arrivals']} arrivals at {report['offered_rate']:.0f} queries/sec",
+        f"throughput = {report['throughput']:.2f} queries/sec ({report['sent']} sent, {report['replies']} read replies, "
+        f"{report['lost']} lost, {report['late_sends']} sent late)",
+        f"switch hits = {report['switch_hit_ratio']:.3f}, served by the server = {report['server_ratio']:.3f}",
+        f"read latency p50 = {report['read_p50_ms']:.3f} ms, p99 = {report['read_p99_ms']:.3f} ms, "
+        f"p999 = {report['read_p99.9_ms']:.3f} ms, max = {report['read_max_ms']:.3f} ms",
+    ]
+    if report['write_count'] or report['write_errors']:
+        lines.append(f"write latency p50 = {report['write_p50_ms']:.3f} ms, p99 = {report['write_p99_ms']:.3f} ms, "
+                f"p999 = {report['write_p99.9_ms']:.3f} ms ({report['write_errors']} errors)")
+    print('\n'.join(lines))
+
+
+def main(n_servers, disable_cache, suppress, input_files, zipf_queries_n=0, skew=0.9, mode='scrambled', seed=None,
+        write_ratio=0.0, rate=1000.0, poisson=False, n_clients=1, servers=None, partition='range', timeout=1.0,
+        results_dir='results'):
+    if servers is None:
+        client = NetCacheClient(n_servers=n_servers, no_cache=disable_cache, interface=None)
+        client.get_servers_ips()
+        servers = client.servers
+
+    config = {'n_servers': n_servers, 'disable_cache': disable_cache, 'servers': servers,
+            'port': NOCACHE_PORT if disable_cache else NETCACHE_PORT, 'partition': partition, 'timeout': timeout,
+            'rate': rate, 'poisson': poisson, 'seed': seed, 'input': None, 'zipf': zipf_queries_n, 'skew': skew,
+            'mode': mode, 'write_ratio': write_ratio}
+
+    workloads = [(filepath, os.path.basename(filepath).split('.')[0]) for filepath in input_files or []]
+    if zipf_queries_n > 0:
+        workloads.append((None, 'zipf_{}_{}'.format(zipf_queries_n, str(skew).replace('.', ''))))
+
+    os.makedirs(results_dir, exist_ok=True)
+    reports = []
+    for filepath, name in workloads:
+        config.update(input=filepath, name=name)
+        elapsed, reads, writes, totals = run(config, n_clients)
+        report = summary(config, n_clients, elapsed, reads, writes, totals)
+        if not suppress:
+            print_summary(report)
+
+        # the report labels the export of all the requests (see gen_plots.py),
+        # the reads and the writes are kept apart as well
+        out_file = os.path.join(results_dir, '{}_{}_{}'.format(name, n_servers, report['cache']))
+        requests = Metrics(start_time=reads.start_time).merge(reads).merge(writes)
+        requests.export_json(out_file + '.json', labels=dict(report, reads=reads.to_dict(), writes=writes.to_dict()))
+        requests.export_csv(out_file + '.csv')
+        reports.append(report)
+    return reports
 
 
 if __name__=="__main__":
@@ -42,7 +335,28 @@ if __name__=="__main__":
     parser.add_argument('--n-servers', help='number of servers', type=int, required=False, default=1)
     parser.add_argument('--disable-cache', help='disable in-network caching', action='store_true')
     parser.add_argument('--suppress', help='suppress output', action='store_true')
-    parser.add_argument('--input', help='input files to execute queries', required=True, nargs="+")
+    parser.add_argument('--input', help='input files to execute queries', required=False, nargs="+")
+    parser.add_argument('--zipf', type=int, required=False, default=0,
+            help='number of queries drawn on the fly instead of read from a file (see gen_zipf_samples.py)')
+    parser.add_argument('--skew', type=float, required=False, default=0.9)
+    parser.add_argument('--mode', choices=ZIPF_MODES, required=False, default='scrambled')
+    parser.add_argument('--seed', type=int, required=False, default=None)
+    parser.add_argument('--write-ratio', type=float, required=False, default=0.0)
+    parser.add_argument('--rate', type=float, required=False, default=1000.0,
+            help='target queries/sec over all clients (0 = as fast as possible)')
+    parser.add_argument('--poisson', help='poisson arrivals instead of evenly spaced ones', action='store_true')
+    parser.add_argument('--clients', type=int, required=False, default=1, help='client processes (one socket each)')
+    parser.add_argument('--servers', nargs='+', required=False, default=None,
+            help='server addresses (default 10.0.0.1 and up, e.g. 127.0.0.1 for soft_switch.py)')
+    parser.add_argument('--partition', choices=['range', 'hash', 'consistent-hash', 'bounded-hash'],
+            required=False, default='range')
+    parser.add_argument('--timeout', type=float, required=False, default=1.0, help='seconds before a read is lost')
+    parser.add_argument('--results-dir', type=str, required=False, default='results')
     args = parser.parse_args()
 
-    main(args.n_servers, args.disable_cache, args.suppress, args.input)
+    if not args.input and args.zipf <= 0:
+        parser.error('one of --input or --zipf is required')
+
+    main(args.n_servers, args.disable_cache, args.suppress, args.input, args.zipf, args.skew, args.mode,
+            args.seed, args.write_ratio, args.rate, args.poisson, args.clients, args.servers, args.partition,
+            args.timeout, args.results_dir)
@@ -1,49 +1,65 @@
+import json
+import os
+
 import matplotlib.pyplot as plt
 import numpy as np
-import sys
 
-def main(input_file):
+from metrics import Metrics
 
-    """
-    if len(sys.argv) != 4:
-        print("Usage: python3 plotqueries.py <number_of_servers> <show/save> <yaxis_limit>")
-        return
-    """
-    """
-    for i in range(1,NO_SERVERS+1):
-        with open("../p4/server" + str(i) + ".log") as fp:
-            last = fp.readlines()[-1]
-            answered_queries = last.split("     ")[-1]
-            no_queries.append(int(answered_queries.strip()))
-    """
+PLOT_PERCENTILES = (50, 99, 99.9)
 
-    # the code below assumes the format of the output printed by the
-    # script exec_queries.py
 
-    yvalues = []
-    xlabels = []
+# the exports of exec_queries.py (see Metrics.export_json): one run each,
+# named by its labels (workload, servers, cache)
+def load_runs(input_files):
+    runs = []
+    for input_file in input_files:
+        with open(input_file) as fp:
+            export = json.load(fp)
+        labels = export['labels']
+        if {'workload', 'n_servers', 'cache'} <= labels.keys():
+            name = '{} {}s {}'.format(labels['workload'], labels['n_servers'], labels['cache'])
+        else:
+            name = os.path.basename(input_file).rsplit('.', 1)[0]
+        runs.append((name, labels, Metrics.from_dict(export['metrics'])))
+    return runs
 
-    with open(input_file, 'r') as fp:
-        lines = fp.readlines()
 
-        for i in range(0, len(lines) - 1, 2):
-            server_name = lines[i].split(']')[0][1:]
-            n_requests = lines[i].split('=')[1].strip()
-            throughput = lines[i+1].split('=')[1].strip()
+def main(input_files, output):
 
-            yvalues.append(int(n_requests))
-            xlabels.append(server_name)
+    runs = load_runs(input_files)
+    xvalues = np.arange(len(runs))
+    names = [name for name, _, _ in runs]
 
+    fig, (ax_throughput, ax_latency, ax_series) = plt.subplots(3, 1, figsize=(max(6, 1.5 * len(runs)), 12))
 
-    xvalues = range(1, len(xlabels) + 1)
+    # throughput of every run
+    ax_throughput.bar(xvalues, [metrics.calculate_throughput() for _, _, metrics in runs])
+    ax_throughput.set_xticks(xvalues)
+    ax_throughput.set_xticklabels(names, rotation=15)
+    ax_throughput.set_ylabel('queries/sec')
 
-    plt.bar(xvalues, yvalues)
-    plt.xticks(xvalues, xlabels)
+    # latency percentiles of every run, from the merged histograms
+    width = 0.8 / len(PLOT_PERCENTILES)
+    for i, p in enumerate(PLOT_PERCENTILES):
+        ax_latency.bar(xvalues + (i - (len(PLOT_PERCENTILES) - 1) / 2) * width,
+                [metrics.percentile(p) for _, _, metrics in runs], width, label='p{:g}'.format(p))
+    ax_latency.set_xticks(xvalues)
+    ax_latency.set_xticklabels(names, rotation=15)
+    ax_latency.set_ylabel('latency (ms)')
+    ax_latency.set_yscale('log')
+    ax_latency.legend()
 
-    axes = plt.gca()
-    axes.set_ylim([0, 1.3 * max(yvalues)])
+    # throughput over time, from the start of each run
+    for name, _, metrics in runs:
+        series = metrics.time_series()
+        ax_series.plot([t - metrics.start_time for t, _, _ in series], [rate for _, rate, _ in series], label=name)
+    ax_series.set_xlabel('time (s)')
+    ax_series.set_ylabel('queries/sec')
+    ax_series.legend()
 
-    plt.savefig("plot.png")
+    fig.tight_layout()
+    fig.savefig(output)
 
 
 if __name__=="__main__":
@@ -51,7 +67,8 @@ if __name__=="__main__":
     import argparse
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--input', help='input file of results to generate plot', required=True)
+    parser.add_argument('--input', help='json results of exec_queries.py to plot', required=True, nargs='+')
+    parser.add_argument('--output', help='plot file', required=False, default='plot.png')
     args = parser.parse_args()
 
-    main(args.input)
+    main(args.input, args.output)
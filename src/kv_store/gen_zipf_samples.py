@@ -1,52 +1,121 @@
-from random import shuffle
-
 import numpy as np
 import argparse
 
 DATA_DIR='data/'
 
-def main(n_servers, n_queries, skew):
-
-    alpha = 1.0 / (1.0 - skew)
-
+# queries drawn per vectorized step
+CHUNK_SIZE = 65536
+
+ZIPF_MODES = ['zipf', 'scrambled', 'hotspot-shift']
+
+
+# bounded zipf over n_keys ranks: rank k (0 based) is drawn with probability
+# proportional to 1 / (k + 1) ** skew, by inverse transform sampling of the
+# precomputed cdf (exact, no draws are rejected), chunk ranks at a time
+class ZipfGenerator(object):
+
+    def __init__(self, n_keys, skew, seed=None, chunk=CHUNK_SIZE):
+        self.n_keys = n_keys
+        self.skew = skew
+        self.chunk = chunk
+        self.rng = np.random.default_rng(seed)
+
+        weights = 1.0 / np.arange(1, n_keys + 1, dtype=np.float64) ** skew
+        self.cdf = np.cumsum(weights)
+        self.cdf /= self.cdf[-1]
+
+    def sample(self, n):
+        ranks = np.searchsorted(self.cdf, self.rng.random(n), side='right')
+        # u can round up to the last cdf value
+        return np.minimum(ranks, self.n_keys - 1)
+
+    # arrays of ranks adding up to n_queries
+    def chunks(self, n_queries):
+        for start in range(0, n_queries, self.chunk):
+            yield self.sample(min(self.chunk, n_queries - start))
+
+
+# stream of n_queries queries over keys as (is_write, key) chunks, in one of
+# the modes:
+# - zipf: the popularity of the keys follows their order (hot keys are
+#   next to each other, e.g. all on the first server)
+# - scrambled: the ranks are mapped to the keys through a random permutation
+#   (hot keys are spread over the key space)
+# - hotspot-shift: as scrambled, but every shift_interval queries the ranks
+#   move shift_keys keys further, so that the hot set changes over time
+# a fraction write_ratio of the queries are writes
+def query_chunks(keys, n_queries, skew, mode='scrambled', seed=None, write_ratio=0.0, shift_interval=100000,
+        shift_keys=None, chunk=CHUNK_SIZE):
+    if mode not in ZIPF_MODES:
+        raise ValueError("Invalid zipf mode " + str(mode))
+
+    keys = np.asarray(keys, dtype=object)
+    generator = ZipfGenerator(len(keys), skew, seed, chunk)
+    rng = generator.rng
+    order = np.arange(len(keys)) if mode == 'zipf' else rng.permutation(len(keys))
+    if shift_keys is None:
+        # by default the hot set moves past the hottest 1% of the keys
+        shift_keys = max(1, len(keys) // 100)
+
+    start = 0
+    for ranks in generator.chunks(n_queries):
+        if mode == 'hotspot-shift':
+            periods = (start + np.arange(len(ranks))) // shift_interval
+            ranks = (ranks + periods * shift_keys) % len(keys)
+        writes = rng.random(len(ranks)) < write_ratio if write_ratio > 0 else np.zeros(len(ranks), dtype=bool)
+        yield writes, keys[order[ranks]]
+        start += len(ranks)
+
+
+# one query per line: the key of a read, key=value for a write (the format
+# of the data files, the value names the query that wrote it)
+def query_lines(keys, n_queries, skew, **kwargs):
+    n = 0
+    for writes, chunk_keys in query_chunks(keys, n_queries, skew, **kwargs):
+        lines = [f"{key}=q{n + i}\n" if write else f"{key}\n"
+                for i, (write, key) in enumerate(zip(writes.tolist(), chunk_keys.tolist()))]
+        n += len(lines)
+        yield lines
+
+
+# keys of the data files of n_servers servers (see produce_keyvals.sh)
+def load_keys(n_servers, data_dir=DATA_DIR):
     keys = []
-    sample = []
-
-    # adds all generated keys to the set of keys to sample from
     for i in range(1, 1+int(n_servers)):
-        with open(DATA_DIR + 'server' + str(i) + '.txt') as f:
+        with open(data_dir + 'server' + str(i) + '.txt') as f:
             content = f.readlines()
         content = [x.strip().split('=')[0] for x in content]
         keys.extend(content)
+    return keys
+
 
-    # shuffle keys
-    shuffle(keys)
+def sample_file_name(n_queries, skew, mode, write_ratio):
+    name = '{}zipf_sample_{}_{}'.format(DATA_DIR, n_queries, str(skew).replace('.',''))
+    if mode != 'scrambled':
+        name += '_' + mode
+    if write_ratio > 0:
+        name += '_w' + str(write_ratio).replace('.','')
+    return name + '.txt'
 
-    # draw random query items
-    while len(sample) < int(n_queries):
 
-        # zipf distribution will return any natural number (>= 1)
-        # the probability decreases for larger values
-        # when the index is larger than the number of keys
-        # we sample, we simply try again
-        query_index = np.random.zipf(alpha, 1)[0]
-        if query_index <= len(keys):
-            sample.append(keys[query_index-1])
+def main(n_servers, n_queries, skew, mode, seed, write_ratio, shift_interval, shift_keys, output):
 
+    keys = load_keys(n_servers)
 
-    sample_file = '{}zipf_sample_{}_{}.txt'.format(DATA_DIR, n_queries,
-            str(skew).replace('.',''))
+    sample_file = output or sample_file_name(n_queries, skew, mode, write_ratio)
 
+    # the queries are written chunk by chunk, never held in memory at once
     with open(sample_file, 'w') as f:
-    	for query_item in sample:
-            f.write("%s\n" % query_item)
+        for lines in query_lines(keys, n_queries, skew, mode=mode, seed=seed, write_ratio=write_ratio,
+                shift_interval=shift_interval, shift_keys=shift_keys):
+            f.writelines(lines)
 
 
 
 def check_valid_skew(value):
     ivalue = float(value)
-    if ivalue >= 1 or ivalue <= 0:
-        raise argparse.ArgumentTypeError("value should be (0 < skew < 1)")
+    if ivalue <= 0:
+        raise argparse.ArgumentTypeError("value should be (skew > 0)")
     return ivalue
 
 if __name__=="__main__":
@@ -55,8 +124,18 @@ if __name__=="__main__":
 
     parser.add_argument('--n-servers', help='number of servers', type=int, required=True)
     parser.add_argument('--n-queries', help='number of queries to generate', type=int, required=True)
-    parser.add_argument('--skew', help='skewness of the workload (0 < skew < 1)', type=check_valid_skew,
+    parser.add_argument('--skew', help='zipf exponent of the workload (e.g. 0.9, 0.99)', type=check_valid_skew,
             required=False, default=0.9)
+    parser.add_argument('--mode', choices=ZIPF_MODES, required=False, default='scrambled',
+            help='mapping of the zipf ranks to the keys')
+    parser.add_argument('--seed', type=int, required=False, default=None)
+    parser.add_argument('--write-ratio', type=float, required=False, default=0.0, help='fraction of writes (key=value lines)')
+    parser.add_argument('--shift-interval', type=int, required=False, default=100000,
+            help='queries between two moves of the hot set (hotspot-shift)')
+    parser.add_argument('--shift-keys', type=int, required=False, default=None,
+            help='keys the hot set moves by (hotspot-shift, default 1%% of the keys)')
+    parser.add_argument('--output', type=str, required=False, default=None, help='sample file (default under data/)')
     args = parser.parse_args()
 
-    main(args.n_servers, args.n_queries, args.skew)
+    main(args.n_servers, args.n_queries, args.skew, args.mode, args.seed, args.write_ratio,
+            args.shift_interval, args.shift_keys, args.output)
@@ -0,0 +1,197 @@
+import json
+import os
+import socket
+import threading
+import time
+
+# latencies are counted in power of two buckets of nanoseconds (bucket i
+# holds the latencies of i bits, the last one everything above 2 seconds)
+LATENCY_BUCKETS = 32
+
+
+# counters and latency accumulators of the stages of a hot path: every thread
+# updates its own dicts (registered on its first update) without taking any
+# lock, and snapshot() adds up the dicts of all the threads, so that measuring
+# a stage costs two perf_counter_ns() calls and a few additions; other stats
+# (e.g. of a sender or a cache) are pulled in by the snapshot from sources;
+# used by both the server and the controller (control_plane/instrumentation.py
+# links to this file), each of them names its instruments and picks its own
+# stats socket
+class Instruments:
+
+    def __init__(self, name):
+        self.name = name
+        self.sources = {}
+        self.reset()
+
+    # forget every thread (e.g. in a process forked from the one that created
+    # the instruments, whose threads did not survive the fork)
+    def reset(self):
+        self.local = threading.local()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def thread_slots(self):
+        try:
+            return self.local.slots
+        except AttributeError:
+            slots = self.local.slots = ({}, {})
+            with self.lock:
+                self.threads.append(slots)
+            return slots
+
+    def count(self, name, n=1):
+        counters = self.thread_slots()[0]
+        counters[name] = counters.get(name, 0) + n
+
+    # one run of a stage that took ns nanoseconds (the difference of two
+    # time.perf_counter_ns() calls)
+    def add(self, stage, ns):
+        timings = self.thread_slots()[1]
+        timing = timings.get(stage)
+        if timing is None:
+            timing = timings[stage] = [0] * (3 + LATENCY_BUCKETS)
+        timing[0] += 1
+        timing[1] += ns
+        if ns > timing[2]:
+            timing[2] = ns
+        timing[3 + min(ns.bit_length(), LATENCY_BUCKETS - 1)] += 1
+
+    # stats() of source are part of every snapshot
+    def add_source(self, name, source):
+        self.sources[name] = source
+
+    # counters and timings of all the threads (the copies are taken while the
+    # threads keep updating them, a snapshot may miss their last updates)
+    def snapshot(self):
+        with self.lock:
+            threads = list(self.threads)
+
+        counters = {}
+        totals = {}
+        for thread_counters, thread_timings in threads:
+            for name, value in thread_counters.copy().items():
+                counters[name] = counters.get(name, 0) + value
+            for stage, timing in thread_timings.copy().items():
+                total = totals.setdefault(stage, [0] * (3 + LATENCY_BUCKETS))
+                timing = list(timing)
+                total[2] = max(total[2], timing[2])
+                timing[2] = 0
+                for i, value in enumerate(timing):
+                    total[i] += value
+
+        snapshot = {'name': self.name, 'pid': os.getpid(), 'time': time.time(),
+                'uptime': time.time() - self.start_time, 'counters': counters,
+                'timings': {stage: timing_summary(total) for stage, total in sorted(totals.items())}}
+        for name, source in self.sources.items():
+            try:
+                snapshot[name] = source()
+            except Exception as e:
+                snapshot[name] = {'error': str(e)}
+        return snapshot
+
+    # write a snapshot to path (replaced at once, readers never see a partial one)
+    def dump(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    def dump_loop(self, interval, path):
+        while True:
+            time.sleep(interval)
+            try:
+                self.dump(path)
+            except OSError as e:
+                print('Error: writing stats to ' + path + ': ' + str(e))
+
+    # answer every connection to the unix socket at path with a snapshot
+    def serve(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(4)
+        while True:
+            conn, _ = sock.accept()
+            try:
+                conn.sendall(json.dumps(self.snapshot()).encode('utf-8') + b'\n')
+            except OSError:
+                pass
+            conn.close()
+
+    # report the snapshots every interval seconds to dump_path and/or on
+    # demand over the unix socket at socket_path
+    def start(self, interval=0, dump_path=None, socket_path=None):
+        threads = []
+        if interval > 0 and dump_path is not None:
+            threads.append(threading.Thread(target=self.dump_loop, args=(interval, dump_path), daemon=True))
+        if socket_path is not None:
+            threads.append(threading.Thread(target=self.serve, args=(socket_path, ), daemon=True))
+        for thread in threads:
+            thread.start()
+        return threads
+
+
+# count, mean, max and bucket bounds of the percentiles of a stage, in
+# microseconds (a percentile is the upper bound of its power of two bucket)
+def timing_summary(timing):
+    count, total, max_ns = timing[:3]
+    buckets = timing[3:]
+    summary = {'count': count, 'total_s': total / 1e9, 'mean_us': total / count / 1e3 if count else 0.0,
+            'max_us': max_ns / 1e3}
+    for p in (50, 99):
+        rank = count * p / 100.0
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= rank:
+                break
+        summary[f"p{p}_us"] = min(2 ** i, max_ns) / 1e3 if count else 0.0
+    return summary
+
+
+# snapshot of the instruments served at path
+def read_stats(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+    return json.loads(data)
+
+
+def print_stats(snapshot):
+    print(f"[{snapshot['name']}] pid {snapshot['pid']}, up {snapshot['uptime']:.1f} seconds")
+    for name, value in sorted(snapshot['counters'].items()):
+        print(f"  {name:<24}{value:>12}")
+    if snapshot['timings']:
+        print(f"  {'stage':<24}{'count':>12}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}{'max us':>10}")
+    for stage, timing in snapshot['timings'].items():
+        print(f"  {stage:<24}{timing['count']:>12}{timing['mean_us']:>10.2f}{timing['p50_us']:>10.2f}"
+                f"{timing['p99_us']:>10.2f}{timing['max_us']:>10.2f}")
+    for name, value in snapshot.items():
+        if isinstance(value, dict) and name not in ('counters', 'timings'):
+            print(f"  {name}: {value}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--socket', type=str, required=True,
+            help='stats socket of the server (/tmp/server_stats.s) or of the controller (/tmp/controller_stats.s)')
+    parser.add_argument('--interval', type=float, required=False, default=0, help='poll every interval seconds')
+    args = parser.parse_args()
+
+    while True:
+        print_stats(read_stats(args.socket))
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval)
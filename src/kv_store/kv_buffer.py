@@ -0,0 +1,183 @@
+import multiprocessing
+import time
+
+import numpy as np
+import torch
+
+from codec import KV_HEAD_DIM, decode_vectors, kv_flat_index, parse_kv_packet_key
+from workers import SharedArray
+
+
+# contiguous [n_layers, 2, 1, n_heads, prompt_len, head_dim] float32 buffer the
+# kv vectors read from the switch are decoded into, allocated once (in shared
+# memory, so that all the server workers fill the same buffer) together with
+# a map of the vectors received so far; worker processes forked before the
+# buffer was created attach to its blocks by their names (see KVBufferRegistry)
+class KVCacheBuffer:
+
+    # indices of the fetch timings (shared by all workers as well)
+    FIRST_STORE = 0
+    LAST_STORE = 1
+    DECODE_TIME = 2
+    ASSEMBLY_TIME = 3
+    COMPLETED = 4
+
+    def __init__(self, n_layers, n_heads, prompt_len, head_dim=KV_HEAD_DIM, quant='fp32', names=None, lock=None):
+        self.n_layers = n_layers
+        self.n_heads = n_heads
+        self.prompt_len = prompt_len
+        self.n_vectors = n_layers * 2 * n_heads * prompt_len
+        # wire format of the vectors (see codec.KV_QUANT_MODES), they are
+        # dequantized to float32 while decoded into the buffer
+        self.quant = quant
+
+        data_name, received_name, timings_name = names or (None, None, None)
+        self.data = SharedArray((n_layers, 2, 1, n_heads, prompt_len, head_dim), np.float32, data_name)
+        # one byte per vector (rather than one bit) so that workers marking
+        # different vectors never race on the same byte
+        self.received_map = SharedArray((self.n_vectors, ), np.uint8, received_name)
+        self.timings = SharedArray((5, ), np.float64, timings_name)
+        # serializes the completion check of the workers (a lock created after
+        # the workers were forked is not shared with them, pass one that is)
+        self.lock = lock if lock is not None else multiprocessing.get_context('fork').Lock()
+
+        self.kv_vectors = torch.from_numpy(self.data.array)
+        # (layer, kv, head, pos) order is the memory order of the buffer, so
+        # the vectors of a packet always map to a single slice of this view
+        self.flat = self.kv_vectors.view(self.n_vectors, head_dim)
+        self.received = self.received_map.array
+
+    # decode the vectors of a packet straight into their place in the buffer
+    # and return how many vectors it carried
+    def store(self, key, payload):
+        now = time.time()
+        timings = self.timings.array
+        if timings[self.FIRST_STORE] == 0.0:
+            timings[self.FIRST_STORE] = now
+        timings[self.LAST_STORE] = now
+
+        start_time = time.perf_counter()
+        start, count = parse_kv_packet_key(key)
+        first = kv_flat_index(*start, self.n_heads, self.prompt_len)
+        decode_vectors(payload, count, out=self.flat[first:first + count], quant=self.quant)
+        decoded_time = time.perf_counter()
+        self.received[first:first + count] = 1
+
+        timings[self.DECODE_TIME] += decoded_time - start_time
+        timings[self.ASSEMBLY_TIME] += time.perf_counter() - decoded_time
+        return count
+
+    def received_count(self):
+        return int(np.count_nonzero(self.received))
+
+    def complete(self):
+        return bool(self.received.all())
+
+    # returns True once per fill of the buffer, to the first caller that finds
+    # it complete (so that only one worker acts on the completion)
+    def claim_completion(self):
+        with self.lock:
+            start_time = time.perf_counter()
+            claimed = not self.timings.array[self.COMPLETED] and self.complete()
+            if claimed:
+                self.timings.array[self.COMPLETED] = 1.0
+            self.timings.array[self.ASSEMBLY_TIME] += time.perf_counter() - start_time
+        return claimed
+
+    # time spent from the first to the last vector received (fetch), decoding
+    # vectors into the buffer (decode) and tracking their completion (assembly)
+    def fetch_breakdown(self):
+        timings = self.timings.array
+        return {
+            'first_store': timings[self.FIRST_STORE],
+            'fetch': timings[self.LAST_STORE] - timings[self.FIRST_STORE],
+            'decode': timings[self.DECODE_TIME],
+            'assembly': timings[self.ASSEMBLY_TIME],
+        }
+
+    # coordinates of the vectors still missing
+    def missing(self):
+        return [tuple(int(c) for c in np.unravel_index(idx, (self.n_layers, 2, self.n_heads, self.prompt_len)))
+                for idx in np.flatnonzero(self.received == 0)]
+
+    # legacy past_key_values layout (a (key, value) tuple per layer, each of
+    # shape [1, n_heads, prompt_len, head_dim]) made of views of the buffer
+    # (compute_inference wraps them in a DynamicCache, see prefix_cache.py)
+    def past_key_values(self):
+        return tuple((self.kv_vectors[layer, 0], self.kv_vectors[layer, 1]) for layer in range(self.n_layers))
+
+    # names of the shared memory blocks of the buffer
+    def names(self):
+        return self.data.name, self.received_map.name, self.timings.name
+
+    def reset(self):
+        with self.lock:
+            self.received[:] = 0
+            self.timings.array[:] = 0.0
+
+    def close(self):
+        self.kv_vectors = None
+        self.flat = None
+        self.received = None
+        self.data.close()
+        self.received_map.close()
+        self.timings.close()
+
+
+# directory of the reassembly buffers created after the worker processes were
+# forked (i.e. of the system prompts pushed to the switch on demand): the
+# worker that creates a buffer publishes the names of its shared memory blocks
+# together with the shape and the prompt of its kv cache, so that the other
+# workers attach to it rather than drop the vectors they receive; allocated
+# (together with the lock shared by the completion checks of these buffers)
+# before the workers are forked
+class KVBufferRegistry:
+
+    ENTRY = np.dtype([('tag', 'S16'), ('n_layers', np.int32), ('n_heads', np.int32), ('prompt_len', np.int32),
+            ('names', 'S64', (3, )), ('prompt', 'S512')])
+
+    def __init__(self, capacity=64):
+        self.entries = SharedArray((capacity, ), self.ENTRY)
+        self.lock = multiprocessing.get_context('fork').Lock()
+
+    def slot_of(self, tag):
+        slots = np.flatnonzero(self.entries.array['tag'] == tag.encode('utf-8'))
+        return int(slots[0]) if len(slots) else None
+
+    # returns False if the registry is full (the buffer then stays private to
+    # the worker that created it)
+    def publish(self, tag, kv_buffer, prompt):
+        with self.lock:
+            if self.slot_of(tag) is not None:
+                return True
+            slot = self.slot_of('')
+            if slot is None:
+                return False
+            entry = self.entries.array[slot]
+            entry['n_layers'] = kv_buffer.n_layers
+            entry['n_heads'] = kv_buffer.n_heads
+            entry['prompt_len'] = kv_buffer.prompt_len
+            entry['names'] = [name.encode('utf-8') for name in kv_buffer.names()]
+            entry['prompt'] = prompt.encode('utf-8')
+            # published last, readers skip the slot until then
+            entry['tag'] = tag.encode('utf-8')
+            return True
+
+    # (n_layers, n_heads, prompt_len, names, prompt) of the buffer of tag
+    def lookup(self, tag):
+        with self.lock:
+            slot = self.slot_of(tag)
+            if slot is None:
+                return None
+            entry = self.entries.array[slot]
+            return (int(entry['n_layers']), int(entry['n_heads']), int(entry['prompt_len']),
+                    tuple(name.decode('utf-8') for name in entry['names']), entry['prompt'].decode('utf-8'))
+
+    def remove(self, tag):
+        with self.lock:
+            slot = self.slot_of(tag)
+            if slot is not None:
+                self.entries.array[slot]['tag'] = b''
+
+    def close(self):
+        self.entries.close()
@@ -0,0 +1,122 @@
+import mmap
+import struct
+import time
+
+import numpy as np
+import torch
+
+
+# flat on-disk format of a kv cache, mapped in memory instead of unpickled:
+# a fixed size header followed (at DATA_OFFSET, page aligned) by the vectors
+# in [n_layers, 2, 1, n_heads, prompt_len, head_dim] order, i.e. the layout of
+# the kv buffers and of the prefix cache entries, so that it is indexed as is
+KV_FILE_MAGIC = b'KVC1'
+KV_FILE_VERSION = 1
+# magic | version | layers | heads | positions | head dim | dtype (numpy str)
+KV_FILE_HEADER = struct.Struct('<4sHHIIII8s')
+DATA_OFFSET = 4096
+
+
+class KVFileError(Exception):
+    pass
+
+
+# write a kv cache (legacy past_key_values tuple or stacked tensor) to path
+def write_kv_file(path, kv_cache, dtype=np.float32):
+    if not isinstance(kv_cache, torch.Tensor):
+        kv_cache = torch.stack([torch.stack(tuple(layer)) for layer in kv_cache])
+    if kv_cache.dim() != 6 or kv_cache.shape[1] != 2 or kv_cache.shape[2] != 1:
+        raise KVFileError(f"Unexpected kv cache shape {tuple(kv_cache.shape)}")
+
+    dtype = np.dtype(dtype).newbyteorder('<')
+    data = np.ascontiguousarray(kv_cache.detach().cpu().numpy(), dtype=dtype)
+    n_layers, _, _, n_heads, prompt_len, head_dim = data.shape
+
+    header = KV_FILE_HEADER.pack(KV_FILE_MAGIC, KV_FILE_VERSION, 0, n_layers, n_heads, prompt_len,
+            head_dim, dtype.str.encode())
+    with open(path, 'wb') as f:
+        f.write(header.ljust(DATA_OFFSET, b'\x00'))
+        f.write(data.tobytes())
+
+
+# read only mapping of a kv cache file; the vectors are paged in lazily by
+# the kernel and shared with every process mapping the same file
+class KVFile:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            # copy on write mapping so that torch gets a writable array, pages
+            # are only copied if someone writes to them (nobody does)
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        if len(self.mm) < DATA_OFFSET:
+            raise KVFileError(f"{path} is too short to be a kv cache file")
+        magic, version, _, n_layers, n_heads, prompt_len, head_dim, dtype = KV_FILE_HEADER.unpack_from(self.mm)
+        if magic != KV_FILE_MAGIC or version != KV_FILE_VERSION:
+            raise KVFileError(f"{path} is not a kv cache file (version {KV_FILE_VERSION})")
+
+        self.n_layers = n_layers
+        self.n_heads = n_heads
+        self.prompt_len = prompt_len
+        self.head_dim = head_dim
+        self.dtype = np.dtype(dtype.rstrip(b'\x00').decode())
+        self.shape = (n_layers, 2, 1, n_heads, prompt_len, head_dim)
+
+        size = int(np.prod(self.shape)) * self.dtype.itemsize
+        if len(self.mm) < DATA_OFFSET + size:
+            raise KVFileError(f"{path} is truncated")
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.mm, offset=DATA_OFFSET)
+
+    # [n_layers, 2, 1, n_heads, prompt_len, head_dim] view of the mapping
+    def tensor(self):
+        return torch.from_numpy(self.array)
+
+    # legacy past_key_values layout made of views of the mapping
+    def past_key_values(self):
+        kv = self.tensor()
+        return tuple((kv[layer, 0], kv[layer, 1]) for layer in range(self.n_layers))
+
+    def close(self):
+        self.array = None
+        self.mm.close()
+
+
+# kv cache of path as a stacked tensor, mapped if it is a kv cache file and
+# unpickled if it is a legacy .pt file
+def load_kv_cache(path):
+    if path.endswith('.pt'):
+        kv_cache = torch.load(path)
+        return torch.stack([torch.stack(tuple(layer)) for layer in kv_cache])
+    return KVFile(path).tensor()
+
+
+def main(src, dst, dtype, repeat):
+    write_kv_file(dst, torch.load(src), dtype)
+
+    kv_file = KVFile(dst)
+    print(f"Converted {src} to {dst}: {kv_file.n_layers} layers, {kv_file.n_heads} heads, "
+            f"{kv_file.prompt_len} positions, head dim {kv_file.head_dim}, {kv_file.dtype}")
+    kv_file.close()
+
+    for name, path in (('torch.load', src), ('mmap', dst)):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            load_kv_cache(path).sum()
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:<12} {best * 1000:>10.3f} ms per load")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('src', type=str, help='Path to the kv_cache .pt file')
+    parser.add_argument('dst', type=str, help='Path of the kv cache file to write')
+    parser.add_argument('--dtype', choices=['float32', 'float16'], required=False, default='float32')
+    parser.add_argument('--repeat', type=int, required=False, default=20)
+    args = parser.parse_args()
+
+    main(args.src, args.dst, args.dtype, args.repeat)
@@ -0,0 +1,83 @@
+import multiprocessing
+import socket
+import time
+
+from server import KVServer, NETCACHE_READ_FAIL, build_message
+from workers import reuseport_socket, start_workers
+
+
+# closed loop client that keeps `depth` READ_FAIL requests in flight and
+# counts the replies it gets back from the server within duration seconds
+def client_loop(port, duration, depth, results):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    msg = build_message(NETCACHE_READ_FAIL, int.from_bytes(b'a_1', 'big'))
+
+    for _ in range(depth):
+        sock.sendto(msg, ('127.0.0.1', port))
+
+    served = 0
+    end = time.time() + duration
+    while time.time() < end:
+        try:
+            sock.recvfrom(2048)
+            served += 1
+        except socket.timeout:
+            # a request got lost, keep the pipeline full
+            pass
+        sock.sendto(msg, ('127.0.0.1', port))
+
+    results.put(served)
+
+
+def run(port, n_workers, worker_mode, n_clients, depth, duration):
+    server = KVServer('127.0.0.1', suppress=True, workers=n_workers, worker_mode=worker_mode)
+    server.port = port
+    server.worker_socks = [reuseport_socket('127.0.0.1', port) for _ in range(n_workers)]
+    workers = start_workers(server.serve_udp_worker, n_workers, worker_mode, daemon=True)
+
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    clients = [ctx.Process(target=client_loop, args=(port, duration, depth, results)) for _ in range(n_clients)]
+    for client in clients:
+        client.start()
+    served = sum(results.get() for _ in clients)
+    for client in clients:
+        client.join()
+
+    if worker_mode == 'process':
+        for worker in workers:
+            worker.terminate()
+    for sock in server.worker_socks:
+        sock.close()
+    server.close()
+
+    return served / duration
+
+
+def main(port, max_workers, modes, n_clients, depth, duration):
+    print(f"{'mode':<10}{'workers':>8}{'requests/sec':>16}")
+    for mode in modes:
+        n_workers = 1
+        while n_workers <= max_workers:
+            # every run uses a different port, thread workers can not be stopped
+            rate = run(port, n_workers, mode, n_clients, depth, duration)
+            print(f"{mode:<10}{n_workers:>8}{rate:>16.0f}")
+            port += 1
+            n_workers *= 2
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--port', type=int, required=False, default=51000)
+    parser.add_argument('--max-workers', type=int, required=False, default=multiprocessing.cpu_count())
+    parser.add_argument('--modes', nargs='+', choices=['thread', 'process'], required=False, default=['thread', 'process'])
+    parser.add_argument('--clients', type=int, required=False, default=8, help='number of client processes')
+    parser.add_argument('--depth', type=int, required=False, default=8, help='requests in flight per client')
+    parser.add_argument('--duration', type=float, required=False, default=5.0, help='seconds per run')
+    args = parser.parse_args()
+
+    main(args.port, args.max_workers, args.modes, args.clients, args.depth, args.duration)
@@ -1,16 +1,162 @@
+import csv
+import json
 import sys
 
+import numpy as np
+
+# values below 2 ** HISTOGRAM_SUB_BITS get a bucket each, above that every
+# power of two is split into 2 ** (HISTOGRAM_SUB_BITS - 1) buckets (a relative
+# error under 1% with 7 bits)
+HISTOGRAM_SUB_BITS = 7
+HISTOGRAM_BUCKETS = 64 * 2 ** (HISTOGRAM_SUB_BITS - 1)
+# length of the windows of the throughput time series, in seconds
+SERIES_WINDOW = 1.0
+
+REPORT_PERCENTILES = (50, 90, 99, 99.9)
+
+
+# hdr-style histogram of latencies: integer microseconds go to log-linear
+# buckets of bounded relative error, so that millions of requests take a
+# fixed array of counters and histograms of different clients or processes
+# merge by adding their counters
+class LatencyHistogram:
+
+    def __init__(self, counts=None):
+        self.half = 2 ** (HISTOGRAM_SUB_BITS - 1)
+        self.counts = np.zeros(HISTOGRAM_BUCKETS, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def bucket(self, value):
+        if value < 2 * self.half:
+            return value
+        shift = value.bit_length() - HISTOGRAM_SUB_BITS
+        return shift * self.half + (value >> shift)
+
+    # lowest value of a bucket
+    def bucket_value(self, index):
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        return (index - shift * self.half) << shift
+
+    # record a latency in seconds
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        self.counts[min(self.bucket(value), HISTOGRAM_BUCKETS - 1)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        return self
+
+    # latency in seconds below which p percent of the values fall (the middle
+    # of the bucket of the value)
+    def percentile(self, p):
+        if self.total == 0:
+            return 0.0
+        rank = max(1, int(np.ceil(self.total * p / 100.0)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        low = self.bucket_value(index)
+        high = self.bucket_value(index + 1) if index + 1 < HISTOGRAM_BUCKETS else low + 1
+        return min((low + high - 1) / 2.0, self.max) / 1e6
+
+    def mean(self):
+        return self.sum / self.total / 1e6 if self.total else 0.0
+
+    # plain python state, e.g. to send a histogram back from a worker process
+    def to_dict(self):
+        nonzero = np.nonzero(self.counts)[0]
+        return {'buckets': nonzero.tolist(), 'counts': self.counts[nonzero].tolist(),
+                'total': self.total, 'sum': self.sum, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, state):
+        histogram = cls()
+        histogram.counts[state['buckets']] = state['counts']
+        histogram.total = state['total']
+        histogram.sum = state['sum']
+        histogram.max = state['max']
+        return histogram
+
 
 class Metrics:
 
-    def __init__(self, total_messages_sent=0, total_messages_received=0, start_time=0.0, end_time=0.0):
+    def __init__(self, total_messages_sent=0, total_messages_received=0, start_time=0.0, end_time=0.0,
+            window=SERIES_WINDOW):
         self.total_messages_sent = total_messages_sent
         self.total_messages_received = total_messages_received
         self.start_time = start_time
         self.end_time = end_time
-        # dictionary with key = <request-id> and value = list [<send-time>, <deliver-time]
-        self.latency_list = {}
+        # latencies of the delivered requests (see LatencyHistogram), instead of
+        # the send and deliver times of every request
+        self.latency = LatencyHistogram()
+        # requests delivered and the sum of their latencies (microseconds) in
+        # each window of window seconds since start_time
+        self.window = window
+        self.series_count = np.zeros(0, dtype=np.int64)
+        self.series_latency = np.zeros(0, dtype=np.int64)
 
+    def record_sent(self, n=1):
+        self.total_messages_sent += n
+
+    # a request sent at send_time was delivered at deliver_time (seconds, on
+    # the clock of start_time)
+    def record(self, send_time, deliver_time):
+        if self.total_messages_received == 0 and not self.start_time:
+            self.start_time = send_time
+        latency = deliver_time - send_time
+        self.latency.record(latency)
+        self.total_messages_received += 1
+        if deliver_time > self.end_time:
+            self.end_time = deliver_time
+
+        index = max(0, int((deliver_time - self.start_time) / self.window))
+        if index >= len(self.series_count):
+            self.grow(index + 1)
+        self.series_count[index] += 1
+        self.series_latency[index] += max(0, int(latency * 1e6))
+
+    def grow(self, n):
+        size = max(n, 2 * len(self.series_count), 16)
+        self.series_count = np.concatenate([self.series_count, np.zeros(size - len(self.series_count), dtype=np.int64)])
+        self.series_latency = np.concatenate([self.series_latency,
+                np.zeros(size - len(self.series_latency), dtype=np.int64)])
+
+    # add the requests of other (e.g. of another client or worker process),
+    # the windows of both are aligned on their start times
+    def merge(self, other):
+        if other.window != self.window:
+            raise ValueError("Metrics with different windows can not be merged")
+        if other.total_messages_received:
+            if self.total_messages_received == 0:
+                self.start_time = other.start_time
+                self.series_count = np.zeros(0, dtype=np.int64)
+                self.series_latency = np.zeros(0, dtype=np.int64)
+            elif other.start_time < self.start_time:
+                shift = int(round((self.start_time - other.start_time) / self.window))
+                self.series_count = np.concatenate([np.zeros(shift, dtype=np.int64), self.series_count])
+                self.series_latency = np.concatenate([np.zeros(shift, dtype=np.int64), self.series_latency])
+                self.start_time -= shift * self.window
+            offset = int(round((other.start_time - self.start_time) / self.window))
+            n = len(other.series_count)
+            if offset + n > len(self.series_count):
+                self.grow(offset + n)
+            self.series_count[offset:offset + n] += other.series_count
+            self.series_latency[offset:offset + n] += other.series_latency
+            self.end_time = max(self.end_time, other.end_time)
+
+        self.total_messages_sent += other.total_messages_sent
+        self.total_messages_received += other.total_messages_received
+        self.latency.merge(other.latency)
+        return self
 
     # calculate throughput by dividing the total messages sent by the time elapsed
     # between the first message and the delivery of the last message
@@ -24,24 +170,70 @@ class Metrics:
 
     # calculate system's average latency in milliseconds
     def calculate_avg_latency(self):
-        total_latency = 0.0
-        for tup in self.latency_list.values():
-            latency = tup[1] - tup[0]
-            total_latency = total_latency + latency
-        total_latency = total_latency
-        if len(self.latency_list) != 0:
-            avg_latency = total_latency / len(self.latency_list)
-        else:
-            avg_latency = 0
-        # return average latency in milliseconds
-        return avg_latency * (10 ** 3)
+        return self.latency.mean() * (10 ** 3)
+
+    # latency in milliseconds below which p percent of the requests fall
+    def percentile(self, p):
+        return self.latency.percentile(p) * (10 ** 3)
 
+    # (window start, requests/sec, mean latency in milliseconds) of every
+    # window up to the last delivery
+    def time_series(self):
+        n = int(np.nonzero(self.series_count)[0][-1]) + 1 if self.series_count.any() else 0
+        counts = self.series_count[:n]
+        means = np.divide(self.series_latency[:n], counts, out=np.zeros(n), where=counts > 0) / 1e3
+        return [(self.start_time + i * self.window, float(counts[i]) / self.window, float(means[i])) for i in range(n)]
+
+    def summary(self):
+        report = {
+            'sent': self.total_messages_sent,
+            'received': self.total_messages_received,
+            'elapsed': self.end_time - self.start_time,
+            'throughput': self.calculate_throughput(),
+            'mean_ms': self.calculate_avg_latency(),
+            'max_ms': self.latency.max / 1e3,
+        }
+        for p in REPORT_PERCENTILES:
+            report[f"p{p:g}_ms"] = self.percentile(p)
+        return report
+
+    def to_dict(self):
+        return {'total_messages_sent': self.total_messages_sent,
+                'total_messages_received': self.total_messages_received,
+                'start_time': self.start_time, 'end_time': self.end_time, 'window': self.window,
+                'series_count': self.series_count.tolist(), 'series_latency': self.series_latency.tolist(),
+                'latency': self.latency.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state):
+        metrics = cls(state['total_messages_sent'], state['total_messages_received'], state['start_time'],
+                state['end_time'], state['window'])
+        metrics.series_count = np.array(state['series_count'], dtype=np.int64)
+        metrics.series_latency = np.array(state['series_latency'], dtype=np.int64)
+        metrics.latency = LatencyHistogram.from_dict(state['latency'])
+        return metrics
+
+    # the summary, the time series and the histogram (to merge or plot later,
+    # see gen_plots.py), with labels describing the run (e.g. the number of
+    # servers)
+    def export_json(self, path, labels=None):
+        with open(path, 'w') as f:
+            json.dump({'labels': labels or {}, 'summary': self.summary(),
+                    'series': [list(row) for row in self.time_series()], 'metrics': self.to_dict()}, f, indent=2)
+
+    # one row per window of the time series, times in seconds from start_time
+    def export_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time', 'throughput', 'mean_latency_ms'])
+            for start, throughput, latency in self.time_series():
+                writer.writerow([f"{start - self.start_time:.3f}", f"{throughput:.2f}", f"{latency:.6f}"])
 
     def print_info(self, output_fd=sys.stdout):
         """
         Print the following metrics to evaluate system's performance:
         System throughput - how many queries are served over time
-        System latency - average message delivery time
+        System latency - average message delivery time and tail percentiles
         Messages cost - total queries sent/received
 
         :param output_fd: file descriptor to output performance data
@@ -52,6 +244,7 @@ class Metrics:
         output_fd.write('\n\n-----Performance analytics -----\n')
         output_fd.write('System throughput = %.2f messages/sec\n' % throughput)
         output_fd.write('System latency = %.3f ms\n' % avg_latency)
+        output_fd.write('Latency percentiles = %s\n' % ', '.join(
+                'p%g %.3f ms' % (p, self.percentile(p)) for p in REPORT_PERCENTILES))
         output_fd.write('Messages received = %d\n' % self.total_messages_received)
         output_fd.write('Total messages = %d\n' % total_messages)
-
@@ -0,0 +1 @@
+../control_plane/netcache_header.py
\ No newline at end of file
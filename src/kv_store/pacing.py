@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from itertools import islice
+
+import threading
+import time
+
+from batch_io import BATCH_SIZE, BatchSender
+from codec import NETCACHE_HEADER
+
+
+# classic token bucket: tokens accumulate at rate per second up to burst and
+# every packet sent consumes one (rate <= 0 disables pacing)
+class TokenBucket:
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # block until n tokens are available and consume them
+    def consume(self, n=1):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # block until at least one token is available and consume as many as
+    # possible up to n, returns the number of tokens consumed
+    def consume_up_to(self, n):
+        if self.rate <= 0:
+            return n
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    granted = min(n, int(self.tokens))
+                    self.tokens -= granted
+                    return granted
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# rate controlled sender with a sliding window of unacknowledged packets;
+# packets are identified by the seq field of their netcache header, acks are
+# delivered by the receiving thread via ack(seq) and every packet that is not
+# acked within timeout is retransmitted on its own (up to max_retries times);
+# whatever the window and the bucket allow at once is sent as one batch
+class WindowedSender:
+
+    def __init__(self, sock, rate=0, burst=32, window=64, timeout=0.2, max_retries=5, batch=BATCH_SIZE):
+        self.sock = sock
+        self.sender = BatchSender(sock, batch)
+        self.batch = batch
+        self.bucket = TokenBucket(rate, burst)
+        # window = 0 means that acks are not expected (pacing only)
+        self.window = window
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+        self.cond = threading.Condition()
+        # seq -> [msg, addr, last send time, retries] ordered by last send time
+        self.outstanding = OrderedDict()
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.sent = 0
+        self.retransmitted = 0
+        self.acked = 0
+        self.lost = 0
+        self.start_time = 0.0
+        self.end_time = 0.0
+
+    def ack(self, seq):
+        with self.cond:
+            if self.outstanding.pop(seq, None) is not None:
+                self.acked += 1
+                self.cond.notify()
+
+    # send all messages to addr and return once every one of them has been
+    # acked or given up on
+    def send(self, messages, addr):
+        self.start_time = time.time()
+        messages = iter(messages)
+
+        while True:
+            limit = self.batch
+            if self.window > 0:
+                self._wait_for_window(self.window - 1)
+                with self.cond:
+                    limit = min(limit, self.window - len(self.outstanding))
+
+            batch = list(islice(messages, self.bucket.consume_up_to(limit)))
+            if not batch:
+                break
+
+            # register the packets before sending them, their acks may arrive
+            # before the send returns
+            with self.cond:
+                self.sent += len(batch)
+                if self.window > 0:
+                    now = time.monotonic()
+                    for msg in batch:
+                        seq = NETCACHE_HEADER.unpack_from(msg)[1]
+                        self.outstanding[seq] = [msg, addr, now, 0]
+
+            self.sender.send_batch(batch, addr)
+
+        if self.window > 0:
+            self._wait_for_window(0)
+
+        self.end_time = time.time()
+
+    # block until at most limit packets are in flight, retransmitting the
+    # ones whose ack timed out in the meantime
+    def _wait_for_window(self, limit):
+        while True:
+            with self.cond:
+                if len(self.outstanding) <= limit:
+                    return
+                resend = self._expired()
+                if not resend:
+                    self.cond.wait(self.timeout)
+            self._resend(resend)
+
+    # collect the packets that timed out (must be called holding the lock)
+    def _expired(self):
+        now = time.monotonic()
+
+        expired = []
+        for seq, entry in self.outstanding.items():
+            if now - entry[2] < self.timeout:
+                break
+            expired.append(seq)
+
+        resend = []
+        for seq in expired:
+            entry = self.outstanding[seq]
+            if entry[3] >= self.max_retries:
+                del self.outstanding[seq]
+                self.lost += 1
+            else:
+                entry[2] = now
+                entry[3] += 1
+                self.outstanding.move_to_end(seq)
+                resend.append((entry[0], entry[1]))
+        return resend
+
+    def _resend(self, entries):
+        while entries:
+            n = self.bucket.consume_up_to(len(entries))
+            batch, entries = entries[:n], entries[n:]
+
+            by_addr = {}
+            for msg, addr in batch:
+                by_addr.setdefault(addr, []).append(msg)
+            for addr, msgs in by_addr.items():
+                self.sender.send_batch(msgs, addr)
+
+            with self.cond:
+                self.retransmitted += n
+
+    def stats(self):
+        elapsed = self.end_time - self.start_time
+        delivered = self.acked if self.window > 0 else self.sent
+        return {
+            'sent': self.sent,
+            'retransmitted': self.retransmitted,
+            'acked': self.acked,
+            'lost': self.lost,
+            'elapsed': elapsed,
+            'throughput': delivered / elapsed if elapsed > 0 else 0.0,
+            # retransmissions per packet, and the share of packets given up on
+            'retransmit_rate': self.retransmitted / self.sent if self.sent > 0 else 0.0,
+            'loss_rate': self.lost / self.sent if self.sent > 0 else 0.0,
+        }
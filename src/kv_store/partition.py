@@ -0,0 +1,113 @@
+import bisect
+import hashlib
+import math
+
+# points of each server on the ring
+VIRTUAL_NODES = 128
+# bounded loads: no server holds more than load_factor times the mean load
+LOAD_FACTOR = 1.25
+
+
+# 64 bit hash of a key that is the same in every process (unlike hash(),
+# which is randomized per process for str and bytes)
+def stable_hash(key):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+# consistent hashing: every server is placed at vnodes points of a 64 bit
+# ring and a key belongs to the first server point clockwise from the hash
+# of the key, so that adding or removing a server only moves the keys of the
+# arcs it gains or loses (about 1/n of them); the virtual nodes even out the
+# arc lengths of the servers
+#
+# with bounded loads (consistent hashing with bounded loads, Mirrokni et
+# al.) keys are placed one at a time and skip the servers that already hold
+# ceil(load_factor * mean load) keys; the placement depends on the order of
+# the keys, so place() assigns a whole key set in the order of the key hashes
+# to get the same placement in every client
+class ConsistentHashRing(object):
+
+    def __init__(self, nodes=(), vnodes=VIRTUAL_NODES, load_factor=LOAD_FACTOR):
+        self.vnodes = vnodes
+        self.load_factor = load_factor
+        self.nodes = []
+        # sorted hashes of the server points and the server of each point
+        self.points = []
+        self.owners = []
+
+        # key -> server and server -> number of keys of the bounded placement
+        self.assigned = {}
+        self.loads = {}
+
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        self.loads[node] = 0
+        for i in range(self.vnodes):
+            point = stable_hash(f"{node}#{i}")
+            position = bisect.bisect_left(self.points, point)
+            self.points.insert(position, point)
+            self.owners.insert(position, node)
+
+    def remove_node(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        self.loads.pop(node)
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+        # the keys of the removed server are placed again on their next lookup
+        self.assigned = {key: owner for key, owner in self.assigned.items() if owner != node}
+
+    # position on the ring of the first server point clockwise from the key
+    def position(self, key):
+        position = bisect.bisect_right(self.points, stable_hash(key))
+        return position if position < len(self.points) else 0
+
+    def node_for(self, key):
+        if not self.points:
+            return None
+        return self.owners[self.position(key)]
+
+    def capacity(self, n_keys):
+        return math.ceil(self.load_factor * n_keys / len(self.nodes))
+
+    # bounded load placement of a key (kept until the key is released or its
+    # server is removed)
+    def assign(self, key):
+        node = self.assigned.get(key)
+        if node is not None:
+            return node
+        if not self.points:
+            return None
+
+        capacity = self.capacity(len(self.assigned) + 1)
+        position = self.position(key)
+        for i in range(len(self.points)):
+            node = self.owners[(position + i) % len(self.points)]
+            if self.loads[node] < capacity:
+                break
+        self.assigned[key] = node
+        self.loads[node] += 1
+        return node
+
+    def release(self, key):
+        node = self.assigned.pop(key, None)
+        if node is not None:
+            self.loads[node] -= 1
+
+    # bounded load placement of a whole key set, independent of the order of
+    # the keys (key -> server)
+    def place(self, keys):
+        self.assigned = {}
+        self.loads = {node: 0 for node in self.nodes}
+        for key in sorted(keys, key=stable_hash):
+            self.assign(key)
+        return dict(self.assigned)
@@ -0,0 +1,167 @@
+from collections import OrderedDict
+
+import hashlib
+import threading
+
+import torch
+from transformers.cache_utils import DynamicCache, DynamicLayer
+
+from codec import KV_TAG_LEN, kv_packet_keys
+
+
+# kv cache of a single system prompt, stored as one contiguous
+# [n_layers, 2, 1, n_heads, prompt_len, head_dim] tensor
+class PrefixEntry:
+
+    def __init__(self, digest, prompt, kv, tag=None):
+        self.digest = digest
+        # namespace of the switch keys of this prompt (see PrefixCache.free_tag)
+        self.tag = digest[:KV_TAG_LEN] if tag is None else tag
+        self.prompt = prompt
+        self.kv = kv.contiguous()
+        self.n_layers = kv.shape[0]
+        self.n_heads = kv.shape[3]
+        self.prompt_len = kv.shape[4]
+        self.nbytes = self.kv.numel() * self.kv.element_size()
+
+    # keys under which the vectors of this prompt are pushed to the switch
+    def switch_keys(self, pack=1):
+        return kv_packet_keys(self.n_layers, self.n_heads, self.prompt_len, pack, self.tag)
+
+    # legacy past_key_values layout made of views of the stored tensor
+    def past_key_values(self):
+        return tuple((self.kv[layer, 0], self.kv[layer, 1]) for layer in range(self.n_layers))
+
+
+# convert the past_key_values returned by the model (a legacy tuple or one of
+# the Cache classes of transformers) to a list of (key, value) per layer
+def legacy_kv(past_key_values):
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, 'layers'):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    return past_key_values
+
+
+# the other way around: a DynamicCache (generate() no longer takes legacy
+# tuples) whose layers start out as the given tensors themselves, where
+# DynamicCache(ddp_cache_data) would copy them; a layer grows by
+# concatenation, so generate() never writes into the tensors (e.g. the shared
+# buffer of a KVCacheBuffer)
+def dynamic_cache(past_key_values):
+    if not isinstance(past_key_values, (tuple, list)):
+        return past_key_values
+    cache = DynamicCache()
+    for key, value in past_key_values:
+        layer = DynamicLayer()
+        layer.lazy_initialization(key, value)
+        layer.keys, layer.values = key, value
+        cache.layers.append(layer)
+    return cache
+
+
+def stack_kv(past_key_values):
+    return torch.stack([torch.stack(tuple(layer)) for layer in legacy_kv(past_key_values)])
+
+
+# server side cache of system prompt kv caches keyed by the hash of the tokenized
+# prompt; kv caches are computed with the model on a miss and the least recently
+# used ones are evicted once their total size exceeds budget bytes
+class PrefixCache:
+
+    def __init__(self, tokenizer, model, device, budget=256 * 1024 * 1024):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.budget = budget
+
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.retags = 0
+
+    def token_ids(self, prompt):
+        return self.tokenizer(prompt, return_tensors="pt", add_special_tokens=True).input_ids
+
+    def digest(self, input_ids):
+        return hashlib.sha1(input_ids.to(torch.int64).cpu().numpy().tobytes()).hexdigest()
+
+    # return the entry of prompt, computing its kv cache if it is not cached
+    def get(self, prompt):
+        input_ids = self.token_ids(prompt)
+        digest = self.digest(input_ids)
+
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                self.entries.move_to_end(digest)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        with torch.no_grad():
+            output = self.model(input_ids=input_ids.to(self.device), use_cache=True)
+        kv = stack_kv(output.past_key_values).to('cpu', torch.float32)
+
+        return self.insert(digest, prompt, kv)
+
+    # add an already computed kv cache of prompt (e.g. loaded from disk)
+    def put(self, prompt, kv_cache):
+        if not isinstance(kv_cache, torch.Tensor):
+            kv_cache = stack_kv(kv_cache)
+        return self.insert(self.digest(self.token_ids(prompt)), prompt, kv_cache)
+
+    # tags are only KV_TAG_LEN hex digits of the digest, a prompt whose tag is
+    # taken by another cached prompt (whose kv vectors its readers would get)
+    # is tagged by the next window of its digest that is free
+    def free_tag(self, digest):
+        for start in range(len(digest) - KV_TAG_LEN + 1):
+            tag = digest[start:start + KV_TAG_LEN]
+            if tag not in self.tags:
+                if start > 0:
+                    self.retags += 1
+                return tag
+        raise RuntimeError(f"No free tag for the system prompt {digest}")
+
+    def insert(self, digest, prompt, kv):
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+                return self.entries[digest]
+
+            entry = PrefixEntry(digest, prompt, kv, self.free_tag(digest))
+            self.entries[digest] = entry
+            self.tags[entry.tag] = entry
+            self.nbytes += entry.nbytes
+
+            # never evict the entry that was just inserted
+            while self.nbytes > self.budget and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                if self.tags.get(evicted.tag) is evicted:
+                    del self.tags[evicted.tag]
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+        return entry
+
+    # entry whose switch keys are namespaced by tag (None if evicted)
+    def lookup_tag(self, tag):
+        with self.lock:
+            return self.tags.get(tag)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'retags': self.retags,
+            }
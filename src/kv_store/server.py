@@ -6,11 +6,20 @@ import threading
 import time
 import sys
 import os
-import struct
 import numpy as np
 import torch
 import transformers
 
+from codec import NETCACHE_HEADER_SIZE, KV_QUANT_MODES, build_kv_cache_messages, kv_key_tag
+from kv_buffer import KVCacheBuffer, KVBufferRegistry
+from kv_file import load_kv_cache
+from prefix_cache import PrefixCache, dynamic_cache
+from batch_io import BatchReceiver
+from pacing import WindowedSender
+from workers import SharedArray, reuseport_socket, start_workers
+from coherence import CoherenceChannel
+from instrumentation import Instruments
+
 STATISTICS_REFRESH_INTERVAL = 30.0
 
 NETCACHE_PORT = 50000
@@ -25,6 +34,22 @@ NETCACHE_REQUEST_SUCCESS = 10
 NETCACHE_KEY_NOT_FOUND = 20
 
 NETCACHE_VALUE_SIZE = 256
+# value and value2 of the netcache header, as written through to the switch
+NETCACHE_VALUE_BYTES = 512
+
+# unix socket of the coherence channel with the controller
+UNIX_CHANNEL = '/tmp/server_cont.s'
+# unix socket answered with a snapshot of the instruments (see instrumentation.py)
+STATS_SOCKET = '/tmp/server_stats.s'
+
+# names of the per op counters of the instruments
+OP_NAMES = {NETCACHE_READ_QUERY: 'read', NETCACHE_WRITE_QUERY: 'write', NETCACHE_READ_FAIL: 'read_fail',
+        NETCACHE_INIT_QUERY: 'init'}
+
+# shape of the gpt2 kv cache of the system prompt
+N_LAYERS = 12
+N_HEADS = 12
+PROMPT_LEN = 9
 
 SYSTEM_PROMPT = "You are a helpful and informative AI assistant."
 INPUT_PROMPT = "How does the concept of quantum entanglement reconcile with the theory of relativity, given that entangled particles appear to influence each other instantaneously across vast distances?"
@@ -45,30 +70,6 @@ def build_message(op, key, seq=0, value = ""):
 
     return msg
 
-def build_write_message(op, key, value, seq=0):
-    msg = bytearray()
-    msg += op.to_bytes(1, 'big')
-    msg += seq.to_bytes(4, 'big')
-    msg += convert(key).to_bytes(16, 'big')
-    for i in range(64):
-        cur_value = value[i]
-        msg += struct.pack('>f', cur_value)
-    return msg
-
-def unpack_message_to_tensor(value):
-    # Unpack the message into a list of 64 float32 values
-    values = []
-    
-    for i in range(64):
-        # Unpack each 4-byte float
-        cur_value = struct.unpack('>f', value[i*4:(i+1)*4])[0]
-        values.append(cur_value)
-    
-    # Convert the list to a torch tensor
-    tensor = torch.tensor(values, dtype=torch.float32)
-    
-    return tensor
-
 def set_seed(seed=42):
 	torch.manual_seed(seed)
 	if torch.cuda.is_available():
@@ -78,9 +79,12 @@ def set_seed(seed=42):
 
 class KVServer:
 
-    def __init__(self, host, nocache=False, suppress=False, max_listen=10):
+    def __init__(self, host, nocache=False, suppress=False, max_listen=10, cache=None, pack=1,
+            init_rate=1000, init_window=64, workers=1, worker_mode='thread', auto_inference=True,
+            prefix_cache_budget=256 * 1024 * 1024, quant='fp32', bind='0.0.0.0', trace=False, stats_interval=0,
+            stats_socket=STATS_SOCKET):
         # server ip address
-        self.host1 = '0.0.0.0'
+        self.host1 = bind
 
         self.name = 'server1'
 
@@ -92,140 +96,247 @@ class KVServer:
 
         # suppress printing messages
         self.suppress = suppress
+        # log every packet (debug level), off the fast path otherwise
+        self.trace = trace
+        # path to the kv cache file of the system prompt
+        self.cache = cache
+        # number of kv vectors carried by each packet pushed to the switch
+        self.pack = pack
+        # wire (and switch register) format of the kv vectors: fp32, fp16 or
+        # int8 with a per vector scale (see codec.encode_vectors)
+        self.quant = quant
+        # pacing of the packets that populate the switch cache (packets/sec
+        # and maximum number of packets not yet reflected back by the switch)
+        self.init_rate = init_rate
+        self.init_window = init_window
+        # number of receive loops (threads or processes) each one serving its
+        # own SO_REUSEPORT socket bound to the server port
+        self.workers = workers
+        self.worker_mode = worker_mode
+        self.worker_socks = []
+        # run inference as soon as the kv cache is reassembled from the switch
+        self.auto_inference = auto_inference
         # udp server socket
         self.udpss = None
         #tcp server socket
         self.tcpss = None
         # max clients to listen to
         self.max_listen = max_listen
-        # queue to store incoming requests while blocking
+        # queue to store incoming requests while blocking (the requests of
+        # keys whose new value is being written through to the switch)
         self.incoming_requests = deque()
-        self.success_count = 0
+        # vectors received from the switch, one counter per worker (in shared
+        # memory, see success_count)
+        self.success_counts = SharedArray((max(workers, 1), ), np.int64)
         # unix socket for out of band communication with controller
-        # (used for cache coherency purposes)
+        # (used for cache coherency purposes, see coherence.py)
         self.unixss = None
+        self.coherence = None
+        # latest value written to each key (raw 16 byte key -> 512 bytes),
+        # read misses of these keys are answered with it
+        self.values = {}
 
         self.total_time = 0
 
+        # kv cache reassembled from the vectors read from the switch, kept in
+        # shared memory so that it is shared by all the workers
+        self.kv_buffer = KVCacheBuffer(N_LAYERS, N_HEADS, PROMPT_LEN, quant=quant)
+
+        # kv caches of the system prompts served so far, keyed by the hash of
+        # the tokenized prompt (created on activation, it needs the model)
+        self.prefix_cache = None
+        self.prefix_cache_budget = prefix_cache_budget
+        # reassembly buffers of the prompts pushed to the switch, by key tag
+        self.kv_buffers = {}
+        self.kv_buffers_lock = threading.Lock()
+        # worker processes share the buffers they create through the registry
+        self.buffer_registry = KVBufferRegistry() if worker_mode == 'process' else None
+
+        # per op counters and timings of the stages of the hot paths (see
+        # instrumentation.py), dumped every stats_interval seconds to
+        # log/<name>.stats.json and served on the stats_socket unix socket
+        self.instruments = Instruments(self.name)
+        self.stats_interval = stats_interval
+        self.stats_socket = stats_socket
+
     def activate(self):
 
         # enable logging for debuggin purposes
         logging.basicConfig(
                 filename='log/{}.log'.format(self.name),
                 format='%(asctime)s %(levelname)-8s %(message)s',
-                level=logging.DEBUG,
+                level=logging.DEBUG if self.trace else logging.INFO,
                 datefmt='%d-%m-%Y %H:%M:%S')
 
-        # create udp socket server
-        self.udpss1 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udpss1.bind((self.host1, self.port))
-
-        # spawn new thread that serves incoming udp (read) queries
-        server_udp_t1 = threading.Thread(target=self.handle_client_udp_request, args=(self.udpss1, ))
-        server_udp_t1.start()
+        # seed the prefix cache with the precomputed kv cache of the default
+        # system prompt (mapped from its kv cache file, see kv_file.py), and
+        # allocate its reassembly buffer before the workers are forked so that
+        # all of them share it
+        self.prefix_cache = PrefixCache(tokenizer, model, device, self.prefix_cache_budget)
+        if self.cache is not None:
+            entry = self.prefix_cache.put(SYSTEM_PROMPT, load_kv_cache(self.cache).to(torch.float32))
+            self.kv_buffer_for_tag(entry.tag)
+
+        # create the udp server sockets (before spawning the workers so that
+        # binding errors are reported here)
+        self.worker_socks = [reuseport_socket(self.host1, self.port) for _ in range(self.workers)]
+        self.udpss = self.worker_socks[0]
+
+        # spawn the workers that serve incoming udp (read) queries (process
+        # workers report their own instruments, see serve_udp_worker)
+        self.instruments.start(self.stats_interval, 'log/{}.stats.json'.format(self.name), self.stats_socket)
+        self.worker_handles = start_workers(self.serve_udp_worker, self.workers, self.worker_mode)
         # starting time of serving requests (used for throughput calculation)
         self.start_time = time.time()
 
+        # writes (tcp) are written through to the switch by the controller,
+        # the channel is created after the workers are forked so that only
+        # thread workers hold the reads of the keys being updated
+        if self.port == NETCACHE_PORT:
+            self.create_controller_channel()
+        self.tcpss = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcpss.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcpss.bind((self.host1, self.port))
+        self.tcpss.listen(self.max_listen)
+        tcp_t = threading.Thread(target=self.handle_client_tcp_request)
+        tcp_t.start()
+
+    # release the shared memory of the buffers (the server does not serve
+    # any more, e.g. once a benchmark is done with it)
+    def close(self):
+        for kv_buffer in [self.kv_buffer] + list(self.kv_buffers.values()):
+            kv_buffer.close()
+        self.kv_buffers = {}
+        self.success_counts.close()
+        if self.buffer_registry is not None:
+            self.buffer_registry.close()
+
     def create_controller_channel(self):
+        self.coherence = CoherenceChannel(UNIX_CHANNEL, self.serve_buffered, self.incoming_requests, self.values)
         try:
-            os.unlink(UNIX_CHANNEL)
-        except:
-            if os.path.exists(UNIX_CHANNEL):
-                print('Error: unlinking unix socket')
-                sys.exit(1)
-
-        self.unixss = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.unixss.bind(UNIX_CHANNEL)
-        self.unixss.listen(1)
-
-        # spawn new thread that servers requests from controller (out-of-band communication)
-        server_cont_t = threading.Thread(target=self.handle_controller_request)
-        server_cont_t.start()
-
-    # handles incoming udp queries
-    def handle_client_udp_request(self):
+            self.unixss = self.coherence.listen()
+        except OSError as e:
+            print('Error: binding unix socket ' + UNIX_CHANNEL + ': ' + str(e))
+            sys.exit(1)
+
+        # spawn the threads that serve the controller (out-of-band communication):
+        # the handshake, the updates sent to it and its INSERT_OK acks
+        self.coherence.start()
+        self.instruments.add_source('coherence', self.coherence.stats)
+
+    def serve_udp_worker(self, worker_id):
+        if self.worker_mode == 'process':
+            self.instruments.reset()
+            self.instruments.start(self.stats_interval, 'log/{}.{}.stats.json'.format(self.name, worker_id),
+                    self.stats_socket and self.stats_socket + '.' + str(worker_id))
+        sock = self.worker_socks[worker_id]
+        sender = WindowedSender(sock, rate=self.init_rate, window=self.init_window)
+        self.handle_client_udp_request(sock, sender, worker_id)
+
+    # handles incoming udp queries on sock (sender paces the packets of the
+    # switch cache population started by this worker)
+    def handle_client_udp_request(self, sock, sender, worker_id=0):
+
+        receiver = BatchReceiver(sock)
+        received = deque()
+        instruments = self.instruments
+        trace = self.trace
+        verbose = not self.suppress
+        success_counts = self.success_counts.array
 
         while True:
 
-            # if server is not currently blocking updates/writes then if there are
-            # requests waiting in the queue then serve those requests, elsewise
-            # serve the new incoming packet
-            if len(self.incoming_requests) > 0:
-                netcache_pkt, addr = self.incoming_requests.popleft()
-            else:
-                netcache_pkt, addr = self.udpss.recvfrom(1024)
+            # the requests buffered in incoming_requests while their key was
+            # being updated are served by the coherence channel once the
+            # update is acked (see serve_buffered)
+
+            # drain every datagram queued on the socket at once (they are
+            # views into the receive ring, valid until the next recv_batch)
+            if not received:
+                received.extend(receiver.recv_batch())
+                instruments.count('batches')
+            netcache_pkt, addr = received.popleft()
+            start = time.perf_counter_ns()
 
             # netcache_pkt is an array of bytes belonging to incoming packet's data
             # the data portion of the packet represents the netcache header, so we
             # can extract all the fields defined in the netcache custom protocol
             op = netcache_pkt[0]
             seq = netcache_pkt[1:5]
-            key = netcache_pkt[5:21]
+            key_raw = bytes(netcache_pkt[5:21])
             value = netcache_pkt[21:]
             #transform key to int
-            key_s = int.from_bytes(key,'big')
-            key = key.decode('utf-8').lstrip('\x00')
+            key_s = int.from_bytes(key_raw,'big')
+            key = key_raw.decode('utf-8').lstrip('\x00')
             seq = int.from_bytes(seq,'big')
             #transform val to string
+            instruments.add('decode', time.perf_counter_ns() - start)
+            instruments.count(OP_NAMES.get(op, 'invalid'))
 
             if op == NETCACHE_READ_FAIL:
-                logging.info('Received READ_FAIL(' + key + ') from client ' + addr[0])
+                if trace:
+                    logging.debug('Received READ_FAIL(%s) from client %s', key, addr[0])
 
-                if not self.suppress:
+                if verbose:
                     print('[{}] Received READ_FAIL({}) from client {}'.format(self.name, key, addr[0]))
 
-                #simulate operation
-                op_res = 'aaaaaaaabbbbbbbbccccccccddddddddeeeeeeeeffffffffgggggggghhhhhhhhiiiiiiiijjjjjjjjkkkkkkkkllllllllmmmmmmmmnnnnnnnnooooooooppppppppqqqqqqqqrrrrrrrrssssssssttttttttuuuuuuuuvvvvvvvvwwwwwwwwxxxxxxxxyyyyyyyyzzzzzzzz111111112222222233333333444444445555555566666666'
-
-                msg = build_message(NETCACHE_WRITE_QUERY, key_s, seq, op_res)
-                self.udpss.sendto(msg, addr)
+                # a read of a key being updated waits until the switch has
+                # its new value (the switch forwards the reads of invalid entries)
+                if self.coherence is not None and self.coherence.hold(key_raw, ('read', seq, addr, sock)):
+                    instruments.count('held')
+                    continue
+                self.answer_read(sock, key_raw, seq, addr)
 
             elif op == NETCACHE_INIT_QUERY:
-                value = value.decode("utf-8")
+                # the value carries the system prompt (the default one if empty)
+                value = bytes(value).decode("utf-8").strip('\x00')
                 logging.info('Received INIT_QUERY(' + key + ') from client ' + addr[0] + " with value " + value)
 
-                if not self.suppress:
+                if verbose:
                     print('[{}] Received INIT_QUERY({}) from client {} with value {}'.format(self.name, key, addr[0], value))
 
-                
-                kv_cache = torch.load(self.cache)
-                prompt_len = 9
+                # populate the switch from a separate thread so that this loop
+                # keeps receiving the write packets reflected by the switch
+                # (which acknowledge the packets of the paced sender)
                 self.total_time = 0
-                for i in range(12):
-                    for j in range(2):
-                        for k in range(12):
-                            for p in range(prompt_len):
-                                res = kv_cache[i][j][0][k][p]
-                                custom_key = f"{i:02}{j}{k:02}{p}"
-                                msg = build_write_message(NETCACHE_WRITE_QUERY, custom_key, res, seq)
-                                self.udpss.sendto(msg, addr)
-                                time.sleep(0.05)
-                
-                msg = build_message(NETCACHE_REQUEST_SUCCESS, key_s, seq, "Prompt written to KV Cache")
-                self.udpss.sendto(msg, addr)
+                init_t = threading.Thread(target=self.populate_switch_cache, args=(sock, sender, key_s, seq, addr, value or SYSTEM_PROMPT))
+                init_t.start()
 
 
             elif op == NETCACHE_READ_QUERY:
                 self.total_time += float(time.time())
-                self.success_count += 1
-                value = unpack_message_to_tensor(value)
-                logging.info('Received READ_SUCCESS(' + str(self.total_time) + ') from client ' + addr[0] + ' success rate ' + str(self.success_count))
+                kv_buffer = self.kv_buffer_for_key(key)
+                if kv_buffer is None:
+                    instruments.count('evicted')
+                    if trace:
+                        logging.debug('Dropped READ_SUCCESS(%s) of an evicted system prompt', key)
+                    continue
+
+                # a packet may carry several consecutive vectors (see codec.kv_packed_key)
+                # which are decoded straight into their slice of the kv buffer
+                start = time.perf_counter_ns()
+                success_counts[worker_id] += kv_buffer.store(key, memoryview(netcache_pkt)[NETCACHE_HEADER_SIZE:])
+                instruments.add('reassembly', time.perf_counter_ns() - start)
+                if trace:
+                    logging.debug('Received READ_SUCCESS(%s) from client %s success rate %d', self.total_time,
+                            addr[0], self.success_count())
+
+                if verbose:
+                    print('[{}] Received READ_SUCCESS({}) from client {} success rate {}'.format(self.name, str(self.total_time), addr[0], str(self.success_count())))
+
+                # fire the inference stage once every vector has been received
+                # (off this thread so that the receive loop keeps going)
+                if self.auto_inference and kv_buffer.claim_completion():
+                    inference_t = threading.Thread(target=self.run_cached_inference,
+                            args=(INPUT_PROMPT, kv_buffer, self.buffer_prompt(key)))
+                    inference_t.start()
 
-                if not self.suppress:
-                    print('[{}] Received READ_SUCCESS({}) from client {} success rate {}'.format(self.name, str(self.total_time), addr[0], str(self.success_count)))
-                layer = int(key[0:2])
-                kv_toggle = int(key[2])
-                head = int(key[3:5])
-                pos = int(key[5])
-                self.kv_vectors[layer][kv_toggle][0][head][pos] = value
-
-                #if self.success_count == 2592:
-                    #self.compute_inference(INPUT_PROMPT, 9)
                 #msg = build_message(NETCACHE_REQUEST_SUCCESS, key_s, seq, value)
                 #self.udpss.sendto(msg, addr)
 
             elif op == NETCACHE_WRITE_QUERY:
-                val = 1
+                # the switch returns every write packet to its sender
+                sender.ack(seq)
                 #logging.info('Received WRITE_SUCCESS(' + key + ') from client ' + addr[0])
 
                 #if not self.suppress:
@@ -235,6 +346,147 @@ class KVServer:
                 logging.info('Unsupported/Invalid query type received from client ' + addr[0])
                 print('Unsupported query type (received op = ' + str(op) + ')')
 
+    # answer a read miss with the latest value written to the key
+    def answer_read(self, sock, key_raw, seq, addr):
+        value = self.values.get(key_raw)
+        if value is None:
+            #simulate operation
+            op_res = 'aaaaaaaabbbbbbbbccccccccddddddddeeeeeeeeffffffffgggggggghhhhhhhhiiiiiiiijjjjjjjjkkkkkkkkllllllllmmmmmmmmnnnnnnnnooooooooppppppppqqqqqqqqrrrrrrrrssssssssttttttttuuuuuuuuvvvvvvvvwwwwwwwwxxxxxxxxyyyyyyyyzzzzzzzz111111112222222233333333444444445555555566666666'
+            msg = build_message(NETCACHE_WRITE_QUERY, int.from_bytes(key_raw, 'big'), seq, op_res)
+        else:
+            msg = build_message(NETCACHE_WRITE_QUERY, int.from_bytes(key_raw, 'big'), seq)[:NETCACHE_HEADER_SIZE] + value
+        start = time.perf_counter_ns()
+        sock.sendto(msg, addr)
+        self.instruments.add('send', time.perf_counter_ns() - start)
+
+    # the write of a key becomes visible to the reads served by the server
+    # right away and to the ones served by the switch once the controller
+    # has written it through, after which the client gets its ack (the
+    # writes of a key whose previous write is still in flight are buffered
+    # behind it)
+    def write_through(self, key_raw, value, conn, key_s, seq):
+        value = bytes(value[:NETCACHE_VALUE_BYTES]).ljust(NETCACHE_VALUE_BYTES, b'\x00')
+        start = time.perf_counter_ns()
+
+        def done():
+            self.instruments.add('write_through', time.perf_counter_ns() - start)
+            try:
+                conn.sendall(build_message(NETCACHE_REQUEST_SUCCESS, key_s, seq))
+            except OSError:
+                pass
+            conn.close()
+
+        if self.coherence is None:
+            self.values[key_raw] = value
+            done()
+            return
+        self.coherence.write(key_raw, value, done)
+
+    # requests buffered while their key was being updated, served once the
+    # controller acked the update (from the thread of the coherence channel)
+    def serve_buffered(self, key_raw, request):
+        if request[0] == 'read':
+            _, seq, addr, sock = request
+            self.answer_read(sock, key_raw, seq, addr)
+
+    # reassembly buffer of the vectors of a key read back from the switch (the
+    # legacy untagged keys always carry the default system prompt)
+    def kv_buffer_for_key(self, key):
+        tag = kv_key_tag(key)
+        if not tag:
+            return self.kv_buffer
+        return self.kv_buffer_for_tag(tag)
+
+    def success_count(self):
+        return int(self.success_counts.array.sum())
+
+    # threads share the buffers of all the prompts; worker processes attach to
+    # the buffers of the prompts pushed by another worker after the fork (the
+    # prefix cache of a worker only holds the prompts it was asked for), which
+    # the worker creating a buffer publishes in the buffer registry
+    def kv_buffer_for_tag(self, tag):
+        kv_buffer = self.kv_buffers.get(tag)
+        if kv_buffer is not None:
+            return kv_buffer
+
+        registry = self.buffer_registry
+        shared = registry.lookup(tag) if registry is not None else None
+        entry = self.prefix_cache.lookup_tag(tag) if shared is None else None
+        if shared is None and entry is None:
+            return None
+
+        with self.kv_buffers_lock:
+            if tag not in self.kv_buffers:
+                self.release_stale_buffers()
+                if shared is not None:
+                    n_layers, n_heads, prompt_len, names, _ = shared
+                    kv_buffer = KVCacheBuffer(n_layers, n_heads, prompt_len, quant=self.quant, names=names,
+                            lock=registry.lock)
+                else:
+                    kv_buffer = KVCacheBuffer(entry.n_layers, entry.n_heads, entry.prompt_len, quant=self.quant,
+                            lock=registry.lock if registry is not None else None)
+                    if registry is not None and not registry.publish(tag, kv_buffer, entry.prompt):
+                        logging.warning('Buffer registry full, the kv cache of ' + tag + ' is private to '
+                                + str(os.getpid()))
+                self.kv_buffers[tag] = kv_buffer
+            return self.kv_buffers[tag]
+
+    # release the idle buffers of the prompts evicted since they were created
+    # (buffers attached from the registry once their creator released them),
+    # must be called holding kv_buffers_lock
+    def release_stale_buffers(self):
+        registry = self.buffer_registry
+        for tag, kv_buffer in list(self.kv_buffers.items()):
+            if kv_buffer.data.owner:
+                stale = self.prefix_cache.lookup_tag(tag) is None
+            else:
+                stale = registry.lookup(tag) is None
+            if stale and not kv_buffer.received.any():
+                if kv_buffer.data.owner and registry is not None:
+                    registry.remove(tag)
+                self.kv_buffers.pop(tag).close()
+
+    # system prompt whose kv cache a key belongs to
+    def buffer_prompt(self, key):
+        tag = kv_key_tag(key)
+        if not tag:
+            return SYSTEM_PROMPT
+        entry = self.prefix_cache.lookup_tag(tag)
+        if entry is not None:
+            return entry.prompt
+        shared = self.buffer_registry.lookup(tag) if self.buffer_registry is not None else None
+        return SYSTEM_PROMPT if shared is None else shared[4]
+
+    # push the kv cache of the system prompt to the switch (as write queries that
+    # the switch clones to the controller) and notify the client when done; the
+    # kv cache comes from the prefix cache (computed on a miss) and its keys are
+    # namespaced by the tag of the prompt, which is returned to the client
+    # together with the prompt length so that it can derive the keys to read
+    def populate_switch_cache(self, sock, sender, key_s, seq, addr, prompt=SYSTEM_PROMPT):
+        entry = self.prefix_cache.get(prompt)
+        self.kv_buffer_for_tag(entry.tag)
+        logging.info('Prefix cache: ' + str(self.prefix_cache.stats()))
+
+        sender.reset_stats()
+        start = time.perf_counter_ns()
+        sender.send(build_kv_cache_messages(NETCACHE_WRITE_QUERY, entry.kv, entry.prompt_len, seq, self.pack,
+                entry.tag, self.quant), addr)
+        self.instruments.add('populate', time.perf_counter_ns() - start)
+
+        stats = sender.stats()
+        self.instruments.count('populate_packets', stats['sent'])
+        self.instruments.count('populate_retransmitted', stats['retransmitted'])
+        self.instruments.count('populate_lost', stats['lost'])
+        logging.info('Populated switch cache: ' + str(stats))
+
+        if not self.suppress:
+            print('[{}] Populated switch cache: {} packets in {:.3f} sec ({:.0f} packets/sec), '
+                    '{} retransmitted, {} lost'.format(self.name, stats['sent'], stats['elapsed'],
+                    stats['throughput'], stats['retransmitted'], stats['lost']))
+
+        msg = build_message(NETCACHE_REQUEST_SUCCESS, key_s, seq, entry.tag + ':' + str(entry.prompt_len))
+        sock.sendto(msg, addr)
+
     # serves incoming tcp queries (i.e. put/delete)
     def handle_client_tcp_request(self):
 
@@ -242,41 +494,96 @@ class KVServer:
 
             conn, addr = self.tcpss.accept()
 
-            netcache_pkt = conn.recv(1024)
+            # the header and the value may arrive in several segments
+            netcache_pkt = b''
+            while len(netcache_pkt) < NETCACHE_HEADER_SIZE + NETCACHE_VALUE_BYTES:
+                chunk = conn.recv(NETCACHE_HEADER_SIZE + NETCACHE_VALUE_BYTES - len(netcache_pkt))
+                if not chunk:
+                    break
+                netcache_pkt += chunk
+            if len(netcache_pkt) < NETCACHE_HEADER_SIZE:
+                conn.close()
+                continue
 
             op = netcache_pkt[0]
             seq = netcache_pkt[1:5]
-            key = netcache_pkt[5:21]
+            key_raw = netcache_pkt[5:21]
             value = netcache_pkt[21:]
 
             #transform key to int
-            key_s = int.from_bytes(key,'big')
+            key_s = int.from_bytes(key_raw,'big')
             seq = int.from_bytes(seq, 'big')
 
-            #transform val to string
-            value = value.decode("utf-8")
             #transform key to string
-            key = key.decode("utf-8").lstrip('\x00')
+            key = key_raw.decode("utf-8", errors='replace').lstrip('\x00')
 
 
+            self.instruments.count('tcp_' + OP_NAMES.get(op, 'invalid'))
             if op == NETCACHE_WRITE_QUERY:
-                logging.info('Received WRITE_SUCCESS(' + key + ') from client ' + addr[0])
+                if self.trace:
+                    logging.debug('Received WRITE(%s) from client %s', key, addr[0])
 
                 if not self.suppress:
-                    print('[{}] Received WRITE_SUCCES({}) from client {}'.format(self.name, key, addr[0]))
+                    print('[{}] Received WRITE({}) from client {}'.format(self.name, key, addr[0]))
+
+                # acked once the switch cache is coherent with the new value
+                self.write_through(key_raw, value, conn, key_s, seq)
 
             else:
                 logging.info('Unsupported query type received from client '
                         + addr[0] + ":" + str(addr[1]))
-
-    def baseline_inference(self, probe):
+                conn.close()
+
+    # completion stage of the read pipeline: run inference over the reassembled
+    # kv cache and the baseline (no cache) inference of the same probe, and
+    # report the time-to-first-token breakdown of the cached path
+    def run_cached_inference(self, probe, kv_buffer=None, system_prompt=SYSTEM_PROMPT):
+        if kv_buffer is None:
+            kv_buffer = self.kv_buffer
+
+        start = time.perf_counter()
+        cached_kv = kv_buffer.past_key_values()
+        handoff_time = time.perf_counter() - start
+
+        model_time, first_token = self.compute_inference(system_prompt + probe, kv_buffer.prompt_len, cached_kv)
+        breakdown = kv_buffer.fetch_breakdown()
+        ttft = time.time() - breakdown['first_store']
+
+        baseline_time, baseline_token = self.baseline_inference(probe, system_prompt)
+
+        report = {
+            'fetch': breakdown['fetch'],
+            'decode': breakdown['decode'],
+            'assembly': breakdown['assembly'] + handoff_time,
+            'model': model_time,
+            'ttft': ttft,
+            'baseline': baseline_time,
+            'first_token': first_token,
+            'baseline_first_token': baseline_token,
+        }
+        logging.info('Time to first token breakdown: ' + str(report))
+
+        print(f"Network fetch time: {report['fetch']:.6f} seconds")
+        print(f"Decode time: {report['decode']:.6f} seconds")
+        print(f"Cache assembly time: {report['assembly']:.6f} seconds")
+        print(f"Model time: {report['model']:.6f} seconds")
+        print(f"Time to first token (from first switch read): {report['ttft']:.6f} seconds")
+        print(f"Baseline time to first token: {report['baseline']:.6f} seconds")
+        if first_token != baseline_token:
+            print(f"Warning: first tokens differ ({first_token!r} vs {baseline_token!r})")
+
+        # get ready for the next fetch of the kv cache
+        kv_buffer.reset()
+        return report
+
+    def baseline_inference(self, probe, system_prompt=SYSTEM_PROMPT):
         """
-        Baseline inference: concatenate the fixed system prompt with the probe,
+        Baseline inference: concatenate the system prompt with the probe,
         then run inference without any precomputed cache.
         """
         set_seed(42)
 
-        input_text = SYSTEM_PROMPT + probe
+        input_text = system_prompt + probe
         encoded_full = tokenizer(input_text, return_tensors="pt", add_special_tokens=True)
 
         input_ids = encoded_full.input_ids.to(device)
@@ -288,7 +595,7 @@ class KVServer:
             output_ids = model.generate(
             input_ids=input_ids,
             attention_mask=attention_mask,
-            max_new_tokens=20,
+            max_new_tokens=1,
             pad_token_id=tokenizer.eos_token_id,
             do_sample=False
         )
@@ -297,15 +604,19 @@ class KVServer:
         first_token = tokenizer.decode(output_ids[0, -1], skip_special_tokens=True)
 
         print(f"Baseline inference time: {elapsed:.6f} seconds, with first token: {first_token}")
+        return elapsed, first_token
     
-    def compute_inference(self, input_prompt, prompt_len):
+    def compute_inference(self, input_prompt, prompt_len, cached_kv=None):
         """
         KV Cache inference: use the provided serialized kv cache for the system prompt,
         then process only the probe.
         """
         set_seed(42)
 
-        cached_kv = self.kv_vectors
+        # views of the reassembled kv buffer, no copies are made
+        if cached_kv is None:
+            cached_kv = self.kv_buffer.past_key_values()
+        cached_kv = dynamic_cache(cached_kv)
         full_enc = tokenizer(input_prompt, return_tensors="pt", add_special_tokens=True)
 
         input_ids = full_enc.input_ids.to(device)
@@ -336,15 +647,20 @@ class KVServer:
         first_token = tokenizer.decode(output_ids[0, -1], skip_special_tokens=True)
 
         print(f"KV Cache inference time: {elapsed:.6f} seconds, with first token: {first_token}")
+        return elapsed, first_token
 
 
-def main(disable_cache, suppress_output, input_files, cache):
+def main(disable_cache, suppress_output, input_files, cache, pack, init_rate, init_window, workers, worker_mode,
+        prefix_cache_mb, quant, bind, trace=False, stats_interval=0, stats_socket=STATS_SOCKET):
 
     from subprocess import check_output
 
     # dynamically get the IP address of the server
     server_ip = check_output(['hostname', '--all-ip-addresses']).decode('utf-8').rstrip()
-    server = KVServer(server_ip, nocache=disable_cache, suppress=suppress_output, cache=cache)
+    server = KVServer(server_ip, nocache=disable_cache, suppress=suppress_output, cache=cache, pack=pack,
+            init_rate=init_rate, init_window=init_window, workers=workers, worker_mode=worker_mode,
+            prefix_cache_budget=int(prefix_cache_mb * 1024 * 1024), quant=quant, bind=bind, trace=trace,
+            stats_interval=stats_interval, stats_socket=stats_socket)
 
     server.activate()
 
@@ -357,8 +673,19 @@ if __name__ == "__main__":
     parser.add_argument('--disable-cache', help='do not use netcache', action='store_true')
     parser.add_argument('--suppress-output', help='supress output printing messages', action='store_true')
     parser.add_argument('--input', help='input files to prepopulate server', required=False, nargs="*")
-    parser.add_argument('--cache', type=str, required=True, help='Path to the kv_cache file')
+    parser.add_argument('--cache', type=str, required=True, help='Path to the kv cache file (see kv_file.py, legacy .pt files are unpickled)')
     parser.add_argument('--model', type=str, required=True)
+    parser.add_argument('--pack', type=int, required=False, default=1, help='kv vectors per packet pushed to the switch (up to 2 fp32, 4 fp16 or 7 int8 vectors)')
+    parser.add_argument('--init-rate', type=float, required=False, default=1000, help='packets/sec when populating the switch cache (0 = unlimited)')
+    parser.add_argument('--init-window', type=int, required=False, default=64, help='max unacknowledged packets when populating the switch cache (0 = no acks)')
+    parser.add_argument('--workers', type=int, required=False, default=1, help='number of receive loops sharing the server port')
+    parser.add_argument('--worker-mode', choices=['thread', 'process'], required=False, default='thread')
+    parser.add_argument('--quant', choices=KV_QUANT_MODES, required=False, default='fp32', help='format of the kv vectors on the wire and in the switch')
+    parser.add_argument('--prefix-cache-mb', type=float, required=False, default=256, help='memory budget of the system prompt kv caches kept by the server (MB)')
+    parser.add_argument('--bind', type=str, required=False, default='0.0.0.0', help='address the server listens on (e.g. 127.0.0.2 behind soft_switch.py)')
+    parser.add_argument('--trace', help='log every packet (slows down the receive loops)', action='store_true')
+    parser.add_argument('--stats-interval', type=float, required=False, default=0, help='seconds between dumps of the instruments to log/server1.stats.json (0 = never)')
+    parser.add_argument('--stats-socket', type=str, required=False, default=STATS_SOCKET, help='unix socket serving the instruments (see instrumentation.py)')
     args = parser.parse_args()
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -367,4 +694,6 @@ if __name__ == "__main__":
     model.to(device)
     model.eval()
 
-    main(args.disable_cache, args.suppress_output, args.input, args.cache)
+    main(args.disable_cache, args.suppress_output, args.input, args.cache, args.pack,
+            args.init_rate, args.init_window, args.workers, args.worker_mode, args.prefix_cache_mb, args.quant, args.bind,
+            args.trace, args.stats_interval, args.stats_socket)
@@ -0,0 +1,109 @@
+import glob
+import os
+
+import numpy as np
+
+from partition import ConsistentHashRing, stable_hash, VIRTUAL_NODES, LOAD_FACTOR
+
+
+# keys of the data files written by produce_keyvals.sh (key=value lines),
+# or the same keys generated in place when there are none: n_values keys
+# per server, all of them starting with the letter that range partitioning
+# maps to that server
+def load_keys(data_dir, n_values, n_servers):
+    files = sorted(glob.glob(os.path.join(data_dir, 'server*.txt')))
+    if files:
+        keys = []
+        for path in files:
+            with open(path) as f:
+                keys += [line.split('=', 1)[0] for line in f if '=' in line]
+        return keys, f"{len(files)} data files of {data_dir}"
+
+    letters = [chr(c) for c in range(ord('a'), ord('z') + 1)] + [chr(c) for c in range(ord('A'), ord('Z') + 1)]
+    keys = []
+    for i in range(n_servers):
+        start_char = next((letter for letter in letters if ord(letter) % n_servers == i), '')
+        keys += [f"{start_char}_{j}" for j in range(1, n_values + 1)]
+    return keys, f"produce_keyvals.sh keys for {n_servers} servers (-n {n_values})"
+
+
+def server_names(n):
+    return ["10.0.0." + str(i + 1) for i in range(n)]
+
+
+# key -> server for each partitioning scheme (as in NetCacheClient.get_node)
+def placement(scheme, keys, servers, vnodes, load_factor):
+    if scheme == 'range':
+        return {key: servers[ord(key[0]) % len(servers)] for key in keys}
+    if scheme == 'hash':
+        return {key: servers[stable_hash(key) % len(servers)] for key in keys}
+    if scheme == 'consistent-hash':
+        ring = ConsistentHashRing(servers, vnodes=vnodes)
+        return {key: ring.node_for(key) for key in keys}
+    if scheme == 'bounded-hash':
+        return ConsistentHashRing(servers, vnodes=vnodes, load_factor=load_factor).place(keys)
+    raise ValueError("Invalid partitioning scheme " + scheme)
+
+
+# max / mean keys per server (1.0 is a perfect balance, servers without
+# keys count as well)
+def imbalance(assignment, servers):
+    loads = np.array([0] * len(servers))
+    index = {server: i for i, server in enumerate(servers)}
+    for server in assignment.values():
+        loads[index[server]] += 1
+    return loads.max() / loads.mean(), loads.std() / loads.mean()
+
+
+def moved(before, after):
+    return sum(before[key] != after[key] for key in before) / len(before)
+
+
+# imbalance of each scheme over n_servers servers and the fraction of keys
+# that change server when a server joins (the best possible is 1/(n+1)) or
+# leaves (1/n, the keys of the server that left)
+def simulate(keys, n_servers, schemes, vnodes, load_factor):
+    servers = server_names(n_servers)
+    joined = server_names(n_servers + 1)
+    # the leaving server is not the last one, which would favour range
+    left = servers[:n_servers // 2] + servers[n_servers // 2 + 1:]
+
+    rows = []
+    for scheme in schemes:
+        base = placement(scheme, keys, servers, vnodes, load_factor)
+        max_mean, cv = imbalance(base, servers)
+        join = moved(base, placement(scheme, keys, joined, vnodes, load_factor))
+        leave = moved(base, placement(scheme, keys, left, vnodes, load_factor)) if left else float('nan')
+        rows.append((scheme, max_mean, cv, join, leave))
+    return rows
+
+
+def main(data_dir, n_values, gen_servers, servers, schemes, vnodes, load_factor):
+    keys, source = load_keys(data_dir, n_values, gen_servers)
+    print(f"{len(keys)} keys from {source}, {vnodes} virtual nodes per server, load factor {load_factor}")
+    print(f"{'servers':<9}{'scheme':<17}{'max/mean':>10}{'cv':>8}{'join moved':>12}{'leave moved':>13}")
+    for n_servers in servers:
+        for scheme, max_mean, cv, join, leave in simulate(keys, n_servers, schemes, vnodes, load_factor):
+            print(f"{n_servers:<9}{scheme:<17}{max_mean:>10.3f}{cv:>8.3f}{join:>12.3f}{leave:>13.3f}")
+        print(f"{'':<9}{'(optimal)':<17}{1.0:>10.3f}{0.0:>8.3f}{1 / (n_servers + 1):>12.3f}"
+                f"{1 / n_servers:>13.3f}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--data-dir', type=str, required=False, default='data', help='data files of produce_keyvals.sh')
+    parser.add_argument('--values', type=int, required=False, default=1000,
+            help='keys per server generated when there are no data files (produce_keyvals.sh -n)')
+    parser.add_argument('--gen-servers', type=int, required=False, default=4,
+            help='servers the keys are generated for (produce_keyvals.sh -s)')
+    parser.add_argument('--servers', type=int, nargs='+', required=False, default=[2, 4, 8, 16])
+    parser.add_argument('--schemes', nargs='+', choices=['range', 'hash', 'consistent-hash', 'bounded-hash'],
+            required=False, default=['range', 'hash', 'consistent-hash', 'bounded-hash'])
+    parser.add_argument('--vnodes', type=int, required=False, default=VIRTUAL_NODES)
+    parser.add_argument('--load-factor', type=float, required=False, default=LOAD_FACTOR)
+    args = parser.parse_args()
+
+    main(args.data_dir, args.values, args.gen_servers, args.servers, args.schemes, args.vnodes, args.load_factor)
@@ -0,0 +1,48 @@
+from async_client import AsyncNetCacheClient
+import asyncio
+import time
+
+
+async def run(server, no_cache, pack, timeout, retries):
+    client = AsyncNetCacheClient(server=server, no_cache=no_cache, timeout=timeout, retries=retries)
+    await client.connect()
+
+    # the server pushes the keys of a system prompt namespaced by its tag
+    tag, prompt_len = await client.send_system_prompt()
+    print(f"Prompt written to KV Cache (tag = {tag}, {prompt_len} tokens)")
+
+    # fetch the entire 12 x 2 x 12 x prompt_len kv grid of the system prompt concurrently
+    start = time.time()
+    values = await client.read_kv_cache(prompt_len=prompt_len, pack=pack, tag=tag)
+    elapsed = time.time() - start
+    client.close()
+
+    report = client.latency_report()
+    missing = sum(1 for v in values.values() if v is None)
+
+    print(f"Fetched {len(values) - missing}/{len(values)} packets in {elapsed:.6f} seconds")
+    print(f"Retried requests: {report['retried']}")
+    if client.latencies:
+        print(f"Avg latency: {report['mean']:.6f} seconds")
+        for p in ('p50', 'p90', 'p99', 'p99.9'):
+            print(f"{p} latency: {report[p]:.6f} seconds")
+        print(f"Max latency: {report['max']:.6f} seconds")
+
+
+def main(server, no_cache, pack, timeout, retries):
+    asyncio.run(run(server, no_cache, pack, timeout, retries))
+
+
+if __name__=="__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--server', help='address of the server', required=False, default='10.0.0.1')
+    parser.add_argument('--disable-cache', help='do not use netcache', action='store_true')
+    parser.add_argument('--pack', help='kv vectors per packet the cache was populated with', type=int, required=False, default=1)
+    parser.add_argument('--timeout', help='seconds before a read is retried', type=float, required=False, default=1.0)
+    parser.add_argument('--retries', help='retries per read', type=int, required=False, default=3)
+    args = parser.parse_args()
+
+    main(args.server, args.disable_cache, args.pack, args.timeout, args.retries)
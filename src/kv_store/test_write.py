@@ -0,0 +1,58 @@
+from client_api import NetCacheClient, NETCACHE_WRITE_QUERY, build_message
+import socket
+import time
+
+NETCACHE_READ_FAIL = 3
+
+
+# write a key through the server that owns it and read it back from that
+# server (the way it answers the reads that miss the switch)
+def main(n_servers, servers, no_cache, partition, key, value, timeout):
+    client = NetCacheClient(n_servers=n_servers, no_cache=no_cache, interface=None)
+    if servers:
+        client.servers = list(servers)
+    node = client.get_node(key, partition)
+
+    start = time.time()
+    acked = client.write(key, value, partition_scheme=partition)
+    print(f"Write of {key} to {node} {'acked' if acked else 'failed'} in {time.time() - start:.6f} seconds")
+    if not acked:
+        return False
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    sock.sendto(build_message(NETCACHE_READ_FAIL, key, 1), (node, client.port))
+    try:
+        data = sock.recv(2048)
+    except socket.timeout:
+        print(f"No reply from {node} to the read of {key}")
+        return False
+    finally:
+        sock.close()
+
+    # the value field as the server stored it
+    expected = build_message(NETCACHE_WRITE_QUERY, key, 0, value)[21:]
+    ok = data[0] == NETCACHE_WRITE_QUERY and data[21:21 + len(expected)] == expected
+    print(f"Read back {key}: {'value matches' if ok else 'value differs'}")
+    return ok
+
+
+if __name__=="__main__":
+
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--n-servers', help='number of servers', type=int, required=False, default=1)
+    parser.add_argument('--servers', nargs='+', required=False, default=None,
+            help='server addresses (the addresses of the topology by default)')
+    parser.add_argument('--disable-cache', help='do not use netcache', action='store_true')
+    parser.add_argument('--partition', choices=['range', 'hash', 'consistent-hash', 'bounded-hash'], required=False,
+            default='range')
+    parser.add_argument('--key', type=str, required=False, default='12345678')
+    parser.add_argument('--value', type=str, required=False, default='written over tcp')
+    parser.add_argument('--timeout', help='seconds to wait for the read back', type=float, required=False, default=1.0)
+    args = parser.parse_args()
+
+    ok = main(args.n_servers, args.servers, args.disable_cache, args.partition, args.key, args.value, args.timeout)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,61 @@
+from multiprocessing import shared_memory
+
+import multiprocessing
+import socket
+import threading
+
+import numpy as np
+
+
+# udp socket that shares its port with the sockets of the other workers, the
+# kernel balances incoming flows (by their address/port tuple) across them
+def reuseport_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+# numpy array backed by a shared memory block, so that it is visible to all
+# the worker processes forked after its creation (and to every thread); a
+# process forked before can attach to the block by its name instead
+class SharedArray:
+
+    def __init__(self, shape, dtype=np.float32, name=None):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        # only the creator of the block unlinks it
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        if self.owner:
+            self.array.view(np.uint8)[...] = 0
+
+    def close(self):
+        # drop our view first, the block can not be closed while exported
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# run target(i, *args) for i in range(n) in n threads or n forked processes
+# and return the started workers
+def start_workers(target, n, mode='thread', args=(), daemon=False):
+    if mode == 'thread':
+        factory = threading.Thread
+    elif mode == 'process':
+        factory = multiprocessing.get_context('fork').Process
+    else:
+        raise ValueError("Invalid worker mode " + str(mode))
+
+    workers = []
+    for i in range(n):
+        worker = factory(target=target, args=(i, ) + tuple(args), daemon=daemon)
+        worker.start()
+        workers.append(worker)
+    return workers